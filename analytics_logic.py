@@ -1,11 +1,11 @@
-import time
 import json
 from datetime import date, timedelta, datetime, timezone
 from collections import defaultdict, namedtuple
 from decimal import Decimal
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
+from flask import current_app
 from sqlalchemy import func
 
 from extensions import db
@@ -14,188 +14,364 @@ from models import ( # noqa
     JsonCache
 )
 from securities_logic import (
-    fetch_moex_historical_prices, fetch_moex_securities_metadata, fetch_moex_historical_price_range
+    fetch_moex_historical_prices, fetch_moex_securities_metadata
 )
-from api_clients import fetch_bybit_historical_price_range, fetch_bybit_spot_tickers, PRICE_TICKER_DISPATCHER
+from api_clients import fetch_bybit_spot_tickers, PRICE_TICKER_DISPATCHER
+from logic.price_history_logic import get_daily_prices, get_moex_daily_prices, first_uncovered_dates, MOEX_COVERAGE_CACHE_KEY
+from db_utils import bulk_upsert
 
-def refresh_securities_portfolio_history():
+CRYPTO_STABLECOINS = {'USDT', 'USDC', 'DAI'}
+CRYPTO_HISTORY_CHECKPOINT_KEY = 'crypto_portfolio_history_checkpoint'
+SECURITIES_HISTORY_CHECKPOINT_KEY = 'securities_portfolio_history_checkpoint'
+# Сколько дней назад искать последнюю цену, если на дату нет торгов (включая саму дату)
+PRICE_LOOKBACK_DAYS = 7
+CRYPTO_PRICE_CHANGE_PERIODS = {'24h': 1, '7d': 7, '30d': 30, '90d': 90, '180d': 180, '365d': 365}
+MOEX_PRICE_CHANGE_PERIODS = {'1d': 1, '7d': 7, '30d': 30, '90d': 90, '180d': 180, '365d': 365}
+
+# Состояние для пересчета истории портфеля: с какой даты считать, холдинги на начало этой даты,
+# транзакции начиная с нее, а также данные для новой контрольной точки.
+HistoryReplay = namedtuple('HistoryReplay', ['start_date', 'holdings', 'txs', 'is_full', 'tx_count', 'max_tx_id', 'checkpoint'])
+
+
+def _load_json_cache(cache_key: str) -> dict | None:
+    cache_entry = JsonCache.query.filter_by(cache_key=cache_key).first()
+    if not cache_entry:
+        return None
+    try:
+        return json.loads(cache_entry.json_data)
+    except (json.JSONDecodeError, TypeError):
+        return None
+
+
+def _save_json_cache(cache_key: str, data: dict):
+    cache_entry = JsonCache.query.filter_by(cache_key=cache_key).first()
+    if not cache_entry:
+        cache_entry = JsonCache(cache_key=cache_key)
+        db.session.add(cache_entry)
+    cache_entry.json_data = json.dumps(data, default=str)
+    cache_entry.last_updated = datetime.now(timezone.utc)
+
+
+def _crypto_tx_deltas(tx) -> list[tuple[str, Decimal]]:
+    """Изменения холдингов крипто-портфеля от одной транзакции: [(тикер, +/-количество)]."""
+    deltas = []
+    if tx.type == 'buy':
+        if tx.asset1_ticker: deltas.append((tx.asset1_ticker, tx.asset1_amount))
+        if tx.asset2_ticker: deltas.append((tx.asset2_ticker, -tx.asset2_amount))
+    elif tx.type in ['sell', 'exchange']:
+        if tx.asset1_ticker: deltas.append((tx.asset1_ticker, -tx.asset1_amount))
+        if tx.asset2_ticker: deltas.append((tx.asset2_ticker, tx.asset2_amount))
+    elif tx.type in ['deposit', 'transfer']: # Учитываем и переводы
+        if tx.asset1_ticker: deltas.append((tx.asset1_ticker, tx.asset1_amount))
+    elif tx.type == 'withdrawal':
+        if tx.asset1_ticker: deltas.append((tx.asset1_ticker, -tx.asset1_amount))
+    return deltas
+
+
+def _securities_tx_deltas(tx) -> list[tuple[str, Decimal]]:
+    """Изменения холдингов портфеля ЦБ (ключ - ISIN) от одной транзакции."""
+    if not tx.asset1_ticker:
+        return []
+    return [(tx.asset1_ticker, tx.asset1_amount if tx.type == 'buy' else -tx.asset1_amount)]
+
+
+def _platform_tx_query(platform_type: str, *columns):
+    return db.session.query(*columns).join(InvestmentPlatform, Transaction.platform_id == InvestmentPlatform.id).filter(
+        InvestmentPlatform.platform_type == platform_type
+    )
+
+
+def _platform_tx_rows(platform_type: str, from_date: date = None, before_date: date = None) -> list:
+    """Легковесные строки транзакций (без ORM-объектов), отсортированные по времени."""
+    query = _platform_tx_query(
+        platform_type,
+        Transaction.timestamp, Transaction.type,
+        Transaction.asset1_ticker, Transaction.asset1_amount,
+        Transaction.asset2_ticker, Transaction.asset2_amount
+    )
+    if from_date:
+        query = query.filter(Transaction.timestamp >= datetime.combine(from_date, datetime.min.time()))
+    if before_date:
+        query = query.filter(Transaction.timestamp < datetime.combine(before_date, datetime.min.time()))
+    return query.order_by(Transaction.timestamp.asc()).all()
+
+
+def _prepare_history_replay(platform_type: str, checkpoint_key: str, tx_deltas, full_rebuild: bool) -> HistoryReplay | None:
     """
-    Пересчитывает и сохраняет ежедневную стоимость портфеля ценных бумаг. 
-    Оптимизированная версия с пакетной загрузкой исторических цен.
+    Определяет, с какой даты нужно пересчитать историю портфеля.
+    Контрольная точка (JsonCache) хранит холдинги на конец последнего закрытого дня и максимальный
+    ID учтенной транзакции. Новые транзакции (ID больше сохраненного) с более ранней датой
+    (загружены задним числом) сдвигают начало пересчета на свою дату. Если количество транзакций
+    не сходится (что-то удалили), выполняется полный пересчет. Возвращает None, если транзакций нет.
     """
-    print("--- [Analytics] Начало обновления истории портфеля ЦБ (оптимизированная версия) ---")
+    tx_count, max_tx_id = _platform_tx_query(platform_type, func.count(Transaction.id), func.max(Transaction.id)).one()
+    if not tx_count:
+        return None
 
-    first_tx = Transaction.query.join(InvestmentPlatform).filter(
-        InvestmentPlatform.platform_type == 'stock_broker'
-    ).order_by(Transaction.timestamp.asc()).first()
+    end_date = date.today()
+    checkpoint = None if full_rebuild else _load_json_cache(checkpoint_key)
+    holdings = defaultdict(Decimal)
 
-    if not first_tx:
-        print("--- [Analytics] Нет транзакций по ЦБ, обновление истории отменено.")
-        return False, "Нет транзакций для расчета истории."
+    if checkpoint:
+        new_tx_count, earliest_new_ts = _platform_tx_query(platform_type, func.count(Transaction.id), func.min(Transaction.timestamp)).filter(
+            Transaction.id > checkpoint['max_tx_id']
+        ).one()
+        if tx_count != checkpoint['tx_count'] + new_tx_count:
+            print("--- [Analytics] Транзакции изменились (удаление/перенос), выполняется полный пересчет.")
+            checkpoint = None
+
+    if not checkpoint:
+        all_txs = _platform_tx_rows(platform_type)
+        return HistoryReplay(all_txs[0].timestamp.date(), holdings, all_txs, True, tx_count, max_tx_id, None)
+
+    start_date = date.fromisoformat(checkpoint['base_date']) + timedelta(days=1)
+    earliest_new_date = earliest_new_ts.date() if earliest_new_ts else None
+    if earliest_new_date and earliest_new_date < start_date:
+        # Транзакция задним числом: восстанавливаем холдинги на начало ее дня
+        start_date = earliest_new_date
+        for tx in _platform_tx_rows(platform_type, before_date=start_date):
+            for key, amount in tx_deltas(tx):
+                holdings[key] += amount
+    else:
+        for ticker, quantity in checkpoint['holdings'].items():
+            holdings[ticker] = Decimal(quantity)
+    start_date = min(start_date, end_date)
+    return HistoryReplay(start_date, holdings, _platform_tx_rows(platform_type, from_date=start_date), False, tx_count, max_tx_id, checkpoint)
+
+
+def _save_history_checkpoint(checkpoint_key: str, replay: HistoryReplay, base_date: date, base_holdings: dict, extra: dict = None):
+    """Сохраняет холдинги на конец последнего закрытого дня. Сегодняшний день пересчитывается при каждом запуске."""
+    data = {
+        'base_date': base_date.isoformat(),
+        'holdings': {ticker: str(qty) for ticker, qty in base_holdings.items() if qty != 0},
+        'max_tx_id': replay.max_tx_id,
+        'tx_count': replay.tx_count,
+    }
+    data.update(extra or {})
+    _save_json_cache(checkpoint_key, data)
+
+
+def _value_portfolio_by_day(replay: HistoryReplay, tx_deltas, prices_by_key: dict, end_date: date,
+                            constant_prices: dict = None, min_quantity: float = 0.0, fx_rate: Decimal = Decimal(1),
+                            uncovered_since: dict = None):
+    """
+    Векторизованная оценка портфеля по дням с replay.start_date по end_date.
+    Матрица холдингов (даты x активы) строится кумулятивной суммой дневных дельт транзакций,
+    матрица цен - протяжкой последней известной цены вперед не более чем на PRICE_LOOKBACK_DAYS дней,
+    стоимость по дням - построчным скалярным произведением матриц. Расчет идет во float64,
+    в Decimal переводятся только итоговые суммы.
+    `uncovered_since` - {актив: первый день, за который цены не загружены (сбой загрузки)}:
+    контрольная точка не переходит через первый такой день, в который актив был в портфеле,
+    чтобы следующий запуск пересчитал его, когда цены появятся.
+    Возвращает ([(дата, стоимость)], дату контрольной точки, точные Decimal-холдинги на конец этой даты).
+    """
+    start_date = replay.start_date
+    base_date = end_date - timedelta(days=1)
+    dates = pd.date_range(start=start_date, end=end_date)
+
+    delta_records = []
+    exact_deltas = []
+    for tx in replay.txs:
+        tx_date = tx.timestamp.date()
+        for key, amount in tx_deltas(tx):
+            delta_records.append((pd.Timestamp(tx_date), key, float(amount)))
+            exact_deltas.append((tx_date, key, amount))
+
+    def _exact_holdings(as_of: date) -> dict:
+        # Точный Decimal-проход только для контрольной точки, чтобы не накапливать ошибку float
+        result = defaultdict(Decimal, replay.holdings)
+        for tx_date, key, amount in exact_deltas:
+            if tx_date <= as_of:
+                result[key] += amount
+        return dict(result)
+
+    keys = sorted({key for key, qty in replay.holdings.items() if qty != 0} | {record[1] for record in delta_records})
+    if not keys:
+        return [(d.date(), Decimal(0)) for d in dates], base_date, _exact_holdings(base_date)
+
+    # 1. Холдинги: начальный вектор + кумулятивная сумма дельт по дням
+    if delta_records:
+        daily_deltas = pd.DataFrame(delta_records, columns=['date', 'key', 'amount']).pivot_table(
+            index='date', columns='key', values='amount', aggfunc='sum'
+        )
+        daily_deltas = daily_deltas.reindex(index=dates, columns=keys).fillna(0.0)
+    else:
+        daily_deltas = pd.DataFrame(0.0, index=dates, columns=keys)
+    initial_holdings = pd.Series({key: float(replay.holdings.get(key, 0)) for key in keys})
+    holdings = daily_deltas.cumsum() + initial_holdings
+    holdings = holdings.where(holdings > min_quantity, 0.0)
+
+    # 2. Цены: последняя известная цена действует еще PRICE_LOOKBACK_DAYS - 1 дней (дни без торгов)
+    full_index = pd.date_range(start=start_date - timedelta(days=PRICE_LOOKBACK_DAYS), end=end_date)
+    price_matrix = pd.DataFrame(
+        {key: pd.Series({pd.Timestamp(d): float(p) for d, p in prices_by_key.get(key, {}).items()}, dtype='float64') for key in keys}
+    ).reindex(index=full_index, columns=keys)
+    price_matrix = price_matrix.ffill(limit=PRICE_LOOKBACK_DAYS - 1).reindex(dates)
+    for key, price in (constant_prices or {}).items():
+        if key in price_matrix.columns:
+            price_matrix[key] = float(price)
+
+    missing = (holdings > 0) & price_matrix.isna()
+    for key in missing.columns[missing.any()]:
+        missing_dates = missing.index[missing[key]]
+        print(f"--- [Analytics Warning] Не найдена историческая цена для {key} на {len(missing_dates)} дн. (первый: {missing_dates[0].date()}).")
+
+    # Контрольная точка - не позже дня перед первым днем, когда актив в портфеле, а его цены не загружены
+    for key, since in (uncovered_since or {}).items():
+        if key not in holdings.columns:
+            continue
+        held_days = holdings.index[(holdings.index >= pd.Timestamp(since)) & (holdings[key] > 0)]
+        if len(held_days) and held_days[0].date() <= base_date:
+            base_date = held_days[0].date() - timedelta(days=1)
+            print(f"--- [Analytics Warning] Цены {key} не загружены с {held_days[0].date()}, контрольная точка остается на {base_date}.")
 
-    start_date = first_tx.timestamp.date()
-    end_date = date.today()
-    
-    all_txs = Transaction.query.join(InvestmentPlatform).filter(
-        InvestmentPlatform.platform_type == 'stock_broker'
-    ).order_by(Transaction.timestamp.asc()).all()
+    # 3. Стоимость по дням: построчное скалярное произведение холдингов и цен
+    totals = np.einsum('ij,ij->i', holdings.to_numpy(), price_matrix.fillna(0.0).to_numpy())
+    fx = float(fx_rate)
+    return [(d.date(), Decimal(str(round(value * fx, 2)))) for d, value in zip(dates, totals)], base_date, _exact_holdings(base_date)
 
-    # 1. Определяем все уникальные ISIN-коды за всю историю
-    all_isins = set(tx.asset1_ticker for tx in all_txs if tx.asset1_ticker)
-    print(f"--- [Analytics] Найдены уникальные ISIN: {all_isins}")
 
-    # 2. Получаем метаданные (включая SECID) для всех ISIN
-    securities_meta = fetch_moex_securities_metadata(list(all_isins))
-    isin_to_secid_map = {isin: meta.get('ticker') for isin, meta in securities_meta.items() if meta.get('ticker')}
-    secids_to_fetch = list(isin_to_secid_map.values())
-    print(f"--- [Analytics] Будут запрошены исторические цены для SECID: {secids_to_fetch}")
+def compute_price_changes(prices_by_key: dict, current_prices: dict, periods: dict, as_of: date) -> dict[str, dict[str, float | None]]:
+    """
+    Считает изменение цены в процентах для всех тикеров и периодов сразу.
+    prices_by_key - дневные цены {тикер: {дата: цена}}, current_prices - {тикер: текущая цена},
+    periods - {название: дней назад}. Цена на дату берется as-of: последняя известная цена
+    не старше PRICE_LOOKBACK_DAYS дней (включая саму дату).
+    Возвращает {тикер: {период: изменение в % или None}} для тикеров с текущей ценой.
+    """
+    keys = sorted(key for key, price in current_prices.items() if price)
+    if not keys:
+        return {}
 
-    # 3. Загружаем всю историю цен для каждого SECID
-    historical_prices_by_secid = fetch_moex_historical_price_range(secids_to_fetch, start_date, end_date)
+    target_dates = pd.DatetimeIndex([pd.Timestamp(as_of - timedelta(days=days_ago)) for days_ago in periods.values()])
+    full_index = pd.date_range(start=target_dates.min() - timedelta(days=PRICE_LOOKBACK_DAYS), end=as_of)
+    price_matrix = pd.DataFrame(
+        {key: pd.Series({pd.Timestamp(d): float(p) for d, p in prices_by_key.get(key, {}).items()}, dtype='float64') for key in keys}
+    ).reindex(index=full_index, columns=keys)
+    past_prices = price_matrix.ffill(limit=PRICE_LOOKBACK_DAYS - 1).reindex(target_dates).to_numpy()
 
-    # 4. Проходим по дням и считаем портфель, используя кэш цен
-    SecuritiesPortfolioHistory.query.delete() # noqa
-    db.session.commit()
+    current = np.array([float(current_prices[key]) for key in keys])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        changes = np.where(past_prices > 0, (current - past_prices) / past_prices * 100, np.nan)
 
-    holdings = defaultdict(Decimal)
-    tx_index = 0
-    
-    for current_date_dt in pd.date_range(start=start_date, end=end_date):
-        current_date = current_date_dt.date()
-        
-        while tx_index < len(all_txs) and all_txs[tx_index].timestamp.date() <= current_date:
-            tx = all_txs[tx_index]
-            if tx.asset1_ticker:
-                amount = tx.asset1_amount if tx.type == 'buy' else -tx.asset1_amount
-                holdings[tx.asset1_ticker] += amount
-            tx_index += 1
-
-        current_holdings = {isin: qty for isin, qty in holdings.items() if qty > 0}
-        
-        if not current_holdings:
-            db.session.add(SecuritiesPortfolioHistory(date=current_date, total_value_rub=Decimal(0)))
-            continue
+    period_names = list(periods.keys())
+    return {
+        key: {period_names[i]: (None if np.isnan(changes[i, j]) else float(changes[i, j])) for i in range(len(period_names))}
+        for j, key in enumerate(keys)
+    }
+
+
+def _price_change_rows(changes: dict) -> list[dict]:
+    now = datetime.now(timezone.utc)
+    return [
+        {'ticker': ticker, 'period': period_name, 'change_percent': change_pct, 'last_updated': now}
+        for ticker, by_period in changes.items() for period_name, change_pct in by_period.items()
+    ]
 
-        total_value = Decimal(0)
-        for isin, quantity in current_holdings.items():
-            secid = isin_to_secid_map.get(isin)
-            if not secid:
-                continue
-
-            price_rub = None
-            # Искать цену за последнюю неделю, если на дату нет торгов
-            for i in range(7):
-                check_date = current_date - timedelta(days=i)
-                if secid in historical_prices_by_secid and check_date in historical_prices_by_secid[secid]:
-                    price_rub = historical_prices_by_secid[secid][check_date]
-                    break
-            
-            if price_rub is not None:
-                total_value += quantity * price_rub
-            else:
-                print(f"--- [Analytics Warning] Не найдена историческая цена для {isin} ({secid}) на {current_date} или ранее.")
 
-        db.session.add(SecuritiesPortfolioHistory(date=current_date, total_value_rub=total_value))
+def refresh_securities_portfolio_history(full_rebuild: bool = False):
+    """
+    Пересчитывает и сохраняет ежедневную стоимость портфеля ценных бумаг.
+    Инкрементальный режим: пересчет идет от контрольной точки или от самой ранней даты,
+    затронутой новым отчетом брокера; цены берутся из MoexHistoricalPrice, метаданные
+    запрашиваются только для новых ISIN.
+    """
+    print(f"--- [Analytics] Начало обновления истории портфеля ЦБ ({'полный пересчет' if full_rebuild else 'инкрементально'}) ---")
+
+    replay = _prepare_history_replay('stock_broker', SECURITIES_HISTORY_CHECKPOINT_KEY, _securities_tx_deltas, full_rebuild)
+    if not replay:
+        print("--- [Analytics] Нет транзакций по ЦБ, обновление истории отменено.")
+        return False, "Нет транзакций для расчета истории."
 
+    start_date = replay.start_date
+    end_date = date.today()
+    all_txs = replay.txs
+    holdings = replay.holdings
+
+    # 1. Определяем ISIN-коды: текущие холдинги + пересчитываемые транзакции
+    all_isins = set(isin for isin, qty in holdings.items() if qty != 0)
+    all_isins.update(tx.asset1_ticker for tx in all_txs if tx.asset1_ticker)
+    print(f"--- [Analytics] Пересчет с {start_date} по {end_date}, ISIN: {all_isins}")
+
+    # 2. SECID для ISIN: известные берем из контрольной точки, метаданные запрашиваем только для новых
+    isin_to_secid_map = dict((replay.checkpoint or {}).get('isin_to_secid', {}))
+    new_isins = [isin for isin in all_isins if isin not in isin_to_secid_map]
+    if new_isins:
+        securities_meta = fetch_moex_securities_metadata(new_isins)
+        isin_to_secid_map.update({isin: meta.get('ticker') for isin, meta in securities_meta.items() if meta.get('ticker')})
+    active_secids = {isin: isin_to_secid_map[isin] for isin in all_isins if isin in isin_to_secid_map}
+    print(f"--- [Analytics] Цены MOEX для SECID: {list(active_secids.values())}")
+
+    # 3. История цен из MoexHistoricalPrice (с MOEX догружаются только недостающие дни).
+    # Запас в 7 дней нужен для поиска последней цены на начало периода.
+    historical_prices_by_isin = get_moex_daily_prices(active_secids, start_date - timedelta(days=7), end_date)
+
+    # 4. Векторизованная оценка затронутых дней (бумаги без SECID остаются без цены и не оцениваются).
+    # Бумаги без SECID или с незагруженными ценами не дают контрольной точке уйти дальше дня,
+    # с которого они оценены нулем: эти дни пересчитаются, когда SECID или цены появятся.
+    uncovered_since = first_uncovered_dates(active_secids.keys(), start_date, end_date - timedelta(days=1), MOEX_COVERAGE_CACHE_KEY)
+    uncovered_since.update({isin: start_date for isin in all_isins if isin not in active_secids})
+    daily_values, base_date, base_holdings = _value_portfolio_by_day(
+        replay, _securities_tx_deltas, historical_prices_by_isin, end_date, uncovered_since=uncovered_since
+    )
+
+    if replay.is_full:
+        SecuritiesPortfolioHistory.query.delete() # noqa
+    bulk_upsert(SecuritiesPortfolioHistory, [{'date': d, 'total_value_rub': v} for d, v in daily_values], ['date'], ['total_value_rub'])
+    _save_history_checkpoint(SECURITIES_HISTORY_CHECKPOINT_KEY, replay, base_date, base_holdings, extra={'isin_to_secid': isin_to_secid_map})
     db.session.commit()
     print(f"--- [Analytics] История портфеля ЦБ обновлена с {start_date} по {end_date}. ---")
     return True, "История портфеля ценных бумаг успешно обновлена."
 
-def refresh_crypto_portfolio_history():
+def refresh_crypto_portfolio_history(full_rebuild: bool = False):
     """
-    Пересчитывает и сохраняет ежедневную стоимость крипто-портфеля. Оптимизированная версия.
+    Пересчитывает и сохраняет ежедневную стоимость крипто-портфеля.
+    Инкрементальный режим: пересчитываются только дни начиная с контрольной точки
+    или с даты самой ранней новой (в т.ч. задним числом) транзакции, затронутые дни
+    записываются через upsert.
     """
-    print("--- [Analytics] Начало обновления истории крипто-портфеля (оптимизированная версия) ---")
-    
-    first_tx = Transaction.query.join(InvestmentPlatform).filter( # noqa
-        InvestmentPlatform.platform_type == 'crypto_exchange'
-    ).order_by(Transaction.timestamp.asc()).first()
+    print(f"--- [Analytics] Начало обновления истории крипто-портфеля ({'полный пересчет' if full_rebuild else 'инкрементально'}) ---")
 
-    if not first_tx:
+    replay = _prepare_history_replay('crypto_exchange', CRYPTO_HISTORY_CHECKPOINT_KEY, _crypto_tx_deltas, full_rebuild)
+    if not replay:
         print("--- [Analytics] Нет транзакций по крипто, обновление истории отменено.")
         return False, "Нет транзакций для расчета истории."
 
-    start_date = first_tx.timestamp.date()
+    start_date = replay.start_date
     end_date = date.today()
-    
-    all_txs = Transaction.query.join(InvestmentPlatform).filter(
-        InvestmentPlatform.platform_type == 'crypto_exchange'
-    ).order_by(Transaction.timestamp.asc()).all()
+    all_txs = replay.txs
+    holdings = replay.holdings
 
-    # 1. Определяем все уникальные тикеры за всю историю
-    all_tickers = set()
+    # 1. Определяем тикеры: текущие холдинги + все тикеры из пересчитываемых транзакций
+    all_tickers = set(ticker for ticker, qty in holdings.items() if qty != 0)
     for tx in all_txs:
         if tx.asset1_ticker: all_tickers.add(tx.asset1_ticker)
         if tx.asset2_ticker: all_tickers.add(tx.asset2_ticker)
-    
-    stablecoins = {'USDT', 'USDC', 'DAI'}
-    tickers_to_fetch = [t for t in all_tickers if t not in stablecoins]
-    print(f"--- [Analytics] Будут запрошены исторические цены для: {tickers_to_fetch}")
-
-    # 2. Загружаем всю историю цен для каждого тикера одним пакетным запросом
-    historical_prices_cache = defaultdict(dict)
-    for ticker in tickers_to_fetch:
-        symbol = f"{ticker}USDT"
-        print(f"--- [Analytics] Загрузка истории для {symbol}...")
-        prices = fetch_bybit_historical_price_range(symbol, start_date, end_date)
-        historical_prices_cache[ticker] = prices
-        time.sleep(0.2) # Небольшая задержка между запросами по тикерам
-
-    # 3. Проходим по дням и считаем портфель, используя кэш цен
-    CryptoPortfolioHistory.query.delete()
-    db.session.commit()
 
-    holdings = defaultdict(Decimal)
-    tx_index = 0
-    currency_rates_to_rub = {'USDT': Decimal('90.0')}
+    stablecoins = CRYPTO_STABLECOINS
+    tickers_to_fetch = [t for t in all_tickers if t not in stablecoins]
+    print(f"--- [Analytics] Пересчет с {start_date} по {end_date}, тикеры с ценами: {tickers_to_fetch}")
 
-    for current_date_dt in pd.date_range(start=start_date, end=end_date):
-        current_date = current_date_dt.date()
-        
-        while tx_index < len(all_txs) and all_txs[tx_index].timestamp.date() <= current_date:
-            tx = all_txs[tx_index]
-            # Логика обновления холдингов
-            if tx.type == 'buy':
-                if tx.asset1_ticker: holdings[tx.asset1_ticker] += tx.asset1_amount
-                if tx.asset2_ticker: holdings[tx.asset2_ticker] -= tx.asset2_amount
-            elif tx.type == 'sell':
-                if tx.asset1_ticker: holdings[tx.asset1_ticker] -= tx.asset1_amount
-                if tx.asset2_ticker: holdings[tx.asset2_ticker] += tx.asset2_amount
-            elif tx.type == 'exchange':
-                if tx.asset1_ticker: holdings[tx.asset1_ticker] -= tx.asset1_amount
-                if tx.asset2_ticker: holdings[tx.asset2_ticker] += tx.asset2_amount
-            elif tx.type in ['deposit', 'transfer']: # Учитываем и переводы
-                if tx.asset1_ticker: holdings[tx.asset1_ticker] += tx.asset1_amount
-            elif tx.type == 'withdrawal':
-                if tx.asset1_ticker: holdings[tx.asset1_ticker] -= tx.asset1_amount
-            tx_index += 1
-        
-        current_holdings = {ticker: qty for ticker, qty in holdings.items() if qty > 0.000001}
-        
-        total_value_usdt = Decimal(0)
-        for stable in stablecoins:
-            if stable in current_holdings:
-                total_value_usdt += current_holdings[stable]
-
-        for ticker, quantity in current_holdings.items():
-            if ticker in stablecoins:
-                continue
-
-            price_usdt = None
-            for i in range(7): # Искать цену за последнюю неделю, если на дату нет торгов
-                check_date = current_date - timedelta(days=i)
-                if check_date in historical_prices_cache[ticker]:
-                    price_usdt = historical_prices_cache[ticker][check_date]
-                    break
-            
-            if price_usdt is not None:
-                total_value_usdt += quantity * price_usdt
-            else:
-                print(f"--- [Analytics Warning] Не найдена историческая цена для {ticker} на {current_date} или ранее.")
-        
-        total_value_rub = total_value_usdt * currency_rates_to_rub.get('USDT', Decimal(1.0))
-        db.session.add(CryptoPortfolioHistory(date=current_date, total_value_rub=total_value_rub))
+    # 2. Берем историю цен из локального хранилища (с биржи догружаются только недостающие дни).
+    # Запас в 7 дней нужен для поиска последней известной цены на начало периода.
+    historical_prices_cache = get_daily_prices(tickers_to_fetch, start_date - timedelta(days=7), end_date)
 
+    # 3. Векторизованная оценка затронутых дней; стейблкоины оцениваются по 1 USDT
+    currency_rates_to_rub = {'USDT': Decimal('90.0')}
+    # Тикеры, цены которых не удалось загрузить: дни с ними пересчитаются при следующем запуске
+    uncovered_since = first_uncovered_dates(tickers_to_fetch, start_date, end_date - timedelta(days=1))
+    daily_values, base_date, base_holdings = _value_portfolio_by_day(
+        replay, _crypto_tx_deltas, historical_prices_cache, end_date,
+        constant_prices={stable: Decimal(1) for stable in stablecoins},
+        min_quantity=0.000001,
+        fx_rate=currency_rates_to_rub.get('USDT', Decimal(1.0)),
+        uncovered_since=uncovered_since
+    )
+
+    if replay.is_full:
+        CryptoPortfolioHistory.query.delete()
+    bulk_upsert(CryptoPortfolioHistory, [{'date': d, 'total_value_rub': v} for d, v in daily_values], ['date'], ['total_value_rub'])
+    _save_history_checkpoint(CRYPTO_HISTORY_CHECKPOINT_KEY, replay, base_date, base_holdings)
     db.session.commit()
     print(f"--- [Analytics] История крипто-портфеля обновлена с {start_date} по {end_date}. ---")
     return True, "История крипто-портфеля успешно обновлена."
@@ -211,33 +387,17 @@ def refresh_securities_price_change_data():
         return False, "Нет ценных бумаг для обновления."
 
     today = date.today()
-    periods = {'1d': 1, '7d': 7, '30d': 30, '90d': 90, '180d': 180, '365d': 365}
-    
-    # Кэшируем запросы, чтобы не запрашивать одну и ту же дату несколько раз
-    price_cache_by_date = {}
+    periods = MOEX_PRICE_CHANGE_PERIODS
 
-    for isin in all_isins:
-        if today not in price_cache_by_date:
-            price_cache_by_date[today] = fetch_moex_historical_prices(all_isins, today)
-        today_price = price_cache_by_date[today].get(isin)
-        
-        if not today_price: continue
-
-        for period_name, days_ago in periods.items():
-            past_date = today - timedelta(days=days_ago)
-            if past_date not in price_cache_by_date:
-                # Запрашиваем цены для всех ISIN на эту дату, чтобы кэшировать
-                price_cache_by_date[past_date] = fetch_moex_historical_prices(all_isins, past_date)
-            
-            past_price = price_cache_by_date[past_date].get(isin)
-            change_pct = float(((today_price - past_price) / past_price) * 100) if past_price and past_price > 0 else None
-            cache_entry = HistoricalPriceCache.query.filter_by(ticker=isin, period=period_name).first()
-            if cache_entry: 
-                cache_entry.change_percent = change_pct
-                cache_entry.last_updated = datetime.now(timezone.utc)
-            else: 
-                db.session.add(HistoricalPriceCache(ticker=isin, period=period_name, change_percent=change_pct))
-            
+    # Цены загружаются один раз на каждую дату сразу для всех ISIN (по запросу на доску)
+    prices_by_isin = defaultdict(dict)
+    for target_date in sorted({today} | {today - timedelta(days=days_ago) for days_ago in periods.values()}):
+        for isin, price in fetch_moex_historical_prices(all_isins, target_date).items():
+            prices_by_isin[isin][target_date] = price
+    current_prices = {isin: prices[today] for isin, prices in prices_by_isin.items() if today in prices}
+
+    changes = compute_price_changes(prices_by_isin, current_prices, periods, today)
+    bulk_upsert(HistoricalPriceCache, _price_change_rows(changes), ['ticker', 'period'], ['change_percent', 'last_updated'])
     db.session.commit()
     return True, f"Кэш изменений цен для {len(all_isins)} активов MOEX обновлен."
 
@@ -252,40 +412,19 @@ def refresh_crypto_price_change_data():
         return False, "Нет криптоактивов для обновления."
 
     today = date.today()
-    start_date_fetch = today - timedelta(days=366)
-    periods = {'24h': 1, '7d': 7, '30d': 30, '90d': 90, '180d': 180, '365d': 365}
-    
-    historical_prices_cache = defaultdict(dict)
-    for ticker in all_tickers:
-        if ticker.upper() in ['USDT', 'USDC', 'DAI']: continue
-        symbol_usdt = f"{ticker}USDT"
-        prices = fetch_bybit_historical_price_range(symbol_usdt, start_date_fetch, today)
-        historical_prices_cache[ticker] = prices
-        time.sleep(0.2)
-
-    for ticker in all_tickers:
-        asset = db.session.query(InvestmentAsset.current_price).filter(InvestmentAsset.ticker == ticker, InvestmentAsset.quantity > 0).order_by(InvestmentAsset.current_price.desc()).first()
-        if not asset or not asset.current_price: continue
-        
-        today_price = asset.current_price
-
-        for period_name, days_ago in periods.items():
-            past_date = today - timedelta(days=days_ago)
-            past_price = None
-            for i in range(7):
-                check_date = past_date - timedelta(days=i)
-                if check_date in historical_prices_cache.get(ticker, {}):
-                    past_price = historical_prices_cache[ticker][check_date]
-                    break
-
-            change_pct = float(((today_price - past_price) / past_price) * 100) if past_price and past_price > 0 else None
-            cache_entry = HistoricalPriceCache.query.filter_by(ticker=ticker, period=period_name).first()
-            if cache_entry:
-                cache_entry.change_percent = change_pct
-                cache_entry.last_updated = datetime.now(timezone.utc)
-            else:
-                db.session.add(HistoricalPriceCache(ticker=ticker, period=period_name, change_percent=change_pct))
-            
+    periods = CRYPTO_PRICE_CHANGE_PERIODS
+    start_date_fetch = today - timedelta(days=max(periods.values()) + PRICE_LOOKBACK_DAYS)
+
+    tickers_to_fetch = [ticker for ticker in all_tickers if ticker.upper() not in CRYPTO_STABLECOINS]
+    historical_prices_cache = get_daily_prices(tickers_to_fetch, start_date_fetch, today)
+
+    # Текущая цена тикера - максимальная среди его активов на разных платформах, одним запросом
+    current_prices = dict(db.session.query(InvestmentAsset.ticker, func.max(InvestmentAsset.current_price)).filter(
+        InvestmentAsset.ticker.in_(all_tickers), InvestmentAsset.quantity > 0
+    ).group_by(InvestmentAsset.ticker).all())
+
+    changes = compute_price_changes(historical_prices_cache, current_prices, periods, today)
+    bulk_upsert(HistoricalPriceCache, _price_change_rows(changes), ['ticker', 'period'], ['change_percent', 'last_updated'])
     db.session.commit()
     return True, f"Кэш изменений цен для {len(all_tickers)} криптоактивов обновлен."
 
@@ -294,7 +433,8 @@ def _generate_performance_chart_data(tickers: list[str]) -> dict:
     (Внутренняя функция) Собирает и обрабатывает исторические данные для списка 
     крипто-тикеров для отображения нормализованной производительности за последние три года.
     Данные нормализуются к максимальной цене соответствующего годового периода.
-    Оптимизировано с использованием параллельных запросов.
+    История берется из хранилища дневных цен (с биржи догружается только недостающий хвост),
+    нормализация считается одной матрицей цен для всех тикеров сразу.
     """
     chart_data = {}
     today = date.today()
@@ -306,61 +446,42 @@ def _generate_performance_chart_data(tickers: list[str]) -> dict:
     current_prices_data = fetch_bybit_spot_tickers(symbols_for_api)
     current_prices = {item['ticker']: item['price'] for item in current_prices_data}
 
-    # --- Оптимизация 2: Получаем исторические данные параллельно ---
-    def fetch_history_for_ticker(ticker):
-        """Вспомогательная функция для выполнения в отдельном потоке."""
-        symbol = f"{ticker}USDT"
-        prices = fetch_bybit_historical_price_range(symbol, start_date_3y_ago, today)
-        if ticker in current_prices:
-            prices[today] = current_prices[ticker]
-        return ticker, prices
-
-    with ThreadPoolExecutor(max_workers=len(tickers) or 1) as executor:
-        future_to_ticker = {executor.submit(fetch_history_for_ticker, ticker): ticker for ticker in tickers}
-        for future in as_completed(future_to_ticker):
-            ticker = future_to_ticker[future]
-            try:
-                _ticker, prices_by_date = future.result()
-                if not prices_by_date:
-                    print(f"--- [Performance Chart] No data for {ticker}")
-                    continue
-
-                # --- Этап 3: Обработка и нормализация данных для каждого тикера ---
-                periods = {'0-365': {}, '365-730': {}, '730-1095': {}}
-                date_1y_ago = today - timedelta(days=365)
-                date_2y_ago = today - timedelta(days=365 * 2)
-
-                for d, price in prices_by_date.items():
-                    if d > date_1y_ago: periods['0-365'][d] = price
-                    elif d > date_2y_ago: periods['365-730'][d] = price
-                    else: periods['730-1095'][d] = price
-
-                ticker_performance = {"labels": list(range(1, 366))}
-
-                def normalize_period(prices: dict, base_date: date) -> list:
-                    normalized_data = []
-                    if not prices: return [None] * 365
-                    max_price = max(prices.values()) if prices else Decimal(0)
-                    if max_price > 0:
-                        for i in range(364, -1, -1):
-                            check_date = base_date - timedelta(days=i)
-                            price_found = next((prices.get(check_date - timedelta(days=j)) for j in range(7) if (check_date - timedelta(days=j)) in prices), None)
-                            if price_found:
-                                normalized_data.append(float(price_found / max_price * 100))
-                            else:
-                                normalized_data.append(None)
-                    else:
-                        normalized_data = [0.0] * 365
-                    return normalized_data
-
-                ticker_performance['0-365'] = normalize_period(periods['0-365'], today)
-                ticker_performance['365-730'] = normalize_period(periods['365-730'], date_1y_ago)
-                ticker_performance['730-1095'] = normalize_period(periods['730-1095'], date_2y_ago)
-
-                chart_data[ticker] = ticker_performance
-
-            except Exception as exc:
-                print(f'--- [Performance Chart] Ticker {ticker} сгенерировал исключение: {exc}')
+    # --- Оптимизация 2: Берем историю из хранилища цен (недостающие дни догружаются параллельно) ---
+    history_by_ticker = get_daily_prices(tickers, start_date_3y_ago, today)
+    for ticker, price in current_prices.items():
+        if ticker in tickers:
+            history_by_ticker[ticker][today] = price
+
+    tickers_with_data = [ticker for ticker in tickers if history_by_ticker.get(ticker)]
+    for ticker in tickers:
+        if ticker not in tickers_with_data:
+            print(f"--- [Performance Chart] No data for {ticker}")
+    if not tickers_with_data:
+        return chart_data
+
+    # --- Этап 3: Нормализация всех тикеров одной матрицей (даты x тикеры) ---
+    dates = pd.date_range(start=start_date_3y_ago, end=today)
+    price_matrix = pd.DataFrame(
+        {ticker: pd.Series({pd.Timestamp(d): float(p) for d, p in history_by_ticker[ticker].items()}, dtype='float64') for ticker in tickers_with_data}
+    ).reindex(index=dates, columns=tickers_with_data)
+
+    labels = list(range(1, 366))
+    for ticker in tickers_with_data:
+        chart_data[ticker] = {"labels": labels}
+
+    for period_name, years_back in (('0-365', 0), ('365-730', 1), ('730-1095', 2)):
+        period_end = pd.Timestamp(today - timedelta(days=365 * years_back))
+        window = price_matrix.loc[period_end - pd.Timedelta(days=364):period_end]
+        max_prices = window.max()
+        # Дни без цены берут последнюю цену внутри периода, но не старше PRICE_LOOKBACK_DAYS дней
+        normalized = window.ffill(limit=PRICE_LOOKBACK_DAYS - 1).div(max_prices.where(max_prices > 0)) * 100
+        for ticker in tickers_with_data:
+            if pd.isna(max_prices[ticker]):
+                chart_data[ticker][period_name] = [None] * 365
+            elif max_prices[ticker] <= 0:
+                chart_data[ticker][period_name] = [0.0] * 365
+            else:
+                chart_data[ticker][period_name] = [None if pd.isna(value) else float(value) for value in normalized[ticker]]
 
     return chart_data
 
@@ -370,7 +491,7 @@ def refresh_performance_chart_data():
     """
     print("--- [Analytics] Начало обновления данных для графика производительности ---")
     try:
-        performance_tickers = ['BTC', 'ETH', 'SOL', 'TON', 'SUI', 'NEAR', 'XRP']
+        performance_tickers = current_app.config['PERFORMANCE_CHART_TICKERS']
         chart_data = _generate_performance_chart_data(performance_tickers)
 
         cache_key = 'performance_chart_data'
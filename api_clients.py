@@ -2,13 +2,16 @@ import hmac
 import hashlib
 import base64
 import json
+import queue
+import threading
 import time
 import requests
+from collections import defaultdict, deque, namedtuple
 from datetime import datetime, timedelta, timezone, date # noqa
 import xml.etree.ElementTree as ET
-from urllib.parse import urlencode
-from decimal import Decimal
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, urlparse
+from decimal import Decimal, InvalidOperation
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- Константы базовых URL API ---
 BYBIT_BASE_URL = "https://api.bybit.com"
@@ -19,27 +22,44 @@ OKX_BASE_URL = "https://www.okx.com"
 
 from flask import current_app
 from extensions import db
+from http_transport import get_http_session
+import rate_limiter
+from ticker_cache import get_ticker_snapshot
 
 # --- Вспомогательные функции для аутентификации и запросов ---
 
-def _make_request(method, url, headers=None, params=None, data=None):
-    """Универсальная функция для выполнения HTTP-запросов."""
+def _make_request(method, url, headers=None, params=None, data=None, exchange=None, rate_limit_acquired=False):
+    """
+    Универсальная функция для выполнения HTTP-запросов через общий пул keep-alive соединений.
+    Если указана биржа (`exchange`), запрос проходит через token bucket из rate_limiter,
+    а заголовки лимитов и Retry-After из ответа учитываются для всех потоков сразу.
+    Подписанные запросы занимают квоту до вычисления подписи (`rate_limit_acquired=True`),
+    чтобы ожидание в очереди не делало timestamp запроса устаревшим.
+    """
     MAX_RETRIES = 5
-    retry_delay_seconds = 5 # Начальная задержка
+    retry_delay_seconds = 5 # Начальная задержка (если биржа не указана и нет Retry-After)
+    path = urlparse(url).path
 
     for attempt in range(MAX_RETRIES):
         try:
             full_url_with_params = url
             if params:
                 full_url_with_params += '?' + urlencode(params)
+            if exchange and (attempt > 0 or not rate_limit_acquired):
+                rate_limiter.acquire(exchange, path)
             current_app.logger.debug(f"--- [Raw Request Debug] Requesting URL: {full_url_with_params}")
-            response = requests.request(method, url, headers=headers, params=params, data=data, timeout=20)
+            response = get_http_session().request(method, url, headers=headers, params=params, data=data, timeout=20)
             current_app.logger.debug(f"--- [Raw Request Debug] Response status for {url}: {response.status_code}")
 
+            pause_seconds = rate_limiter.observe_response(exchange, path, response.status_code, response.headers) if exchange else None
             if response.status_code == 429:
-                current_app.logger.warning(f"--- [Rate Limit] Получен статус 429 от {url}. Попытка {attempt + 1}/{MAX_RETRIES}. Пауза на {retry_delay_seconds} секунд...")
-                time.sleep(retry_delay_seconds)
-                retry_delay_seconds *= 2 # Увеличиваем задержку для следующей попытки
+                if exchange:
+                    # Bucket уже поставлен на паузу: следующий acquire() дождется окончания окна лимита
+                    current_app.logger.warning(f"--- [Rate Limit] Получен статус 429 от {url}. Попытка {attempt + 1}/{MAX_RETRIES}. Запросы к {exchange} приостановлены на {pause_seconds:.1f} с.")
+                else:
+                    current_app.logger.warning(f"--- [Rate Limit] Получен статус 429 от {url}. Попытка {attempt + 1}/{MAX_RETRIES}. Пауза на {retry_delay_seconds} секунд...")
+                    time.sleep(retry_delay_seconds)
+                    retry_delay_seconds *= 2 # Увеличиваем задержку для следующей попытки
                 continue
 
             response.raise_for_status()
@@ -77,14 +97,126 @@ def _convert_bybit_timestamp(timestamp_val):
     except (ValueError, TypeError) as e:
         current_app.logger.error(f"Error converting Bybit timestamp '{timestamp_val}': {e}. Returning Unix epoch start.")
         return datetime(1970, 1, 1, tzinfo=timezone.utc) # Возвращаем начало эпохи Unix для невалидных timestamp'ов
-def _bingx_api_get(api_key: str, api_secret: str, endpoint: str, params: dict = None):
-    """Внутренняя функция для выполнения GET-запросов к BingX с подписью."""
+
+# --- Потоковая загрузка истории транзакций ---
+# Страница истории одного эндпоинта: категория для процессора (deposits, trades, ...), сырые записи
+# и водяной знак - момент, до которого история эндпоинта уже выдана полностью (None, если страница
+# не завершает временное окно). Окна обходятся от старых к новым, поэтому водяной знак только растет
+# и по нему можно продолжить прерванную загрузку. Если эндпоинт завершился ошибкой, последней
+# его страницей приходит пустая страница с текстом ошибки в `error`.
+HistoryPage = namedtuple('HistoryPage', ['category', 'records', 'watermark', 'error'], defaults=(None,))
+MAX_BUFFERED_HISTORY_PAGES = 8
+
+def _time_windows(start_dt: datetime, end_dt: datetime, window: timedelta) -> list:
+    """Делит [start_dt, end_dt] на последовательные окна не длиннее `window`, от старых к новым."""
+    windows = []
+    window_start = start_dt
+    while window_start < end_dt:
+        window_end = min(end_dt, window_start + window)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+def _iter_ordered_parallel(func, items, max_workers: int):
+    """
+    Выполняет func(item) в пуле потоков (с контекстом приложения) и выдает результаты в исходном
+    порядке элементов. Одновременно в работе не больше 2 * max_workers задач, поэтому результаты
+    не накапливаются в памяти, пока вызывающий код их не заберет.
+    """
+    app = current_app._get_current_object()
+    items = list(items)
+
+    def _worker(item):
+        with app.app_context():
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        next_index = 0
+        try:
+            while next_index < len(items) or in_flight:
+                while next_index < len(items) and len(in_flight) < max_workers * 2:
+                    in_flight.append(executor.submit(_worker, items[next_index]))
+                    next_index += 1
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+def _stream_endpoints_concurrently(exchange_label: str, tasks: dict):
+    """
+    Параллельно загружает независимые эндпоинты истории одной биржи (депозиты, выводы, сделки и т.д.).
+    `tasks` - словарь {категория: (описание для лога, функция без аргументов, возвращающая
+    итератор пар (записи, водяной знак))}.
+    Эндпоинты загружаются параллельно, а страницы передаются вызывающему потоку через ограниченную
+    очередь: в памяти одновременно не больше MAX_BUFFERED_HISTORY_PAGES страниц, и вызывающий код
+    может записывать их в БД по мере поступления. Ошибка одного эндпоинта не прерывает остальные,
+    а передается вызывающему коду страницей с заполненным `error`.
+    """
+    app = current_app._get_current_object()
+    pages = queue.Queue(maxsize=MAX_BUFFERED_HISTORY_PAGES)
+    stop = threading.Event()
+    endpoint_done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(category, description, iter_pages):
+        with app.app_context():
+            try:
+                for records, watermark in iter_pages():
+                    if not _put(HistoryPage(category, records, watermark)):
+                        return
+            except Exception as e:
+                current_app.logger.error(f"Не удалось получить {description} {exchange_label}: {e}")
+                _put(HistoryPage(category, [], None, str(e)))
+            finally:
+                _put(endpoint_done)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, len(tasks)))
+    try:
+        for category, (description, iter_pages) in tasks.items():
+            executor.submit(_worker, category, description, iter_pages)
+        remaining = len(tasks)
+        while remaining:
+            item = pages.get()
+            if item is endpoint_done:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        # Если вызывающий код прервал чтение, воркеры завершатся на следующей странице
+        stop.set()
+        executor.shutdown(wait=True)
+
+def _collect_history_pages(pages) -> dict:
+    """Собирает потоковые страницы в словарь {категория: [записи]} (для вызывающего кода, которому нужен весь объем сразу)."""
+    all_txs = defaultdict(list)
+    for page in pages:
+        all_txs[page.category].extend(page.records)
+    return all_txs
+
+class BingXApiError(Exception):
+    """Ошибка, которую BingX вернул в теле ответа (code != 0); текст - поле msg."""
+
+def _bingx_api_get(api_key: str, api_secret: str, endpoint: str, params: dict = None, raise_errors: bool = False):
+    """
+    Внутренняя функция для выполнения GET-запросов к BingX с подписью.
+    При ошибке возвращает None, а с `raise_errors=True` - выбрасывает исключение с текстом ошибки API.
+    """
     # ИСПРАВЛЕНО: Логика генерации подписи полностью переписана для точного соответствия
     # требованиям BingX и решения проблемы "Signature verification failed".
     # Ключевое изменение: используется ручное формирование строки для подписи,
     # чтобы избежать расхождений, которые могут возникнуть при использовании urlencode.
     
-    # 1. Подготовка параметров для подписи.
+    # 1. Подготовка параметров для подписи. Квоту занимаем до генерации timestamp.
+    rate_limiter.acquire('bingx', endpoint)
     params_for_signing = params.copy() if params else {}
     params_for_signing['timestamp'] = _get_timestamp_ms()
     params_for_signing['apiKey'] = api_key
@@ -104,7 +236,7 @@ def _bingx_api_get(api_key: str, api_secret: str, endpoint: str, params: dict =
 
     try:
         # 6. Выполнение запроса. Передаем None в params, так как они уже включены в URL.
-        response_data = _make_request('GET', final_url, headers=headers, params=None)
+        response_data = _make_request('GET', final_url, headers=headers, params=None, exchange='bingx', rate_limit_acquired=True)
         
         # ИЗМЕНЕНО: Обрабатываем случай, когда API возвращает список напрямую, а не объект.
         # Это делает обработку ответов от BingX единообразной.
@@ -117,13 +249,21 @@ def _bingx_api_get(api_key: str, api_secret: str, endpoint: str, params: dict =
                 current_app.logger.error(f"Ошибка API BingX для {endpoint}: {response_data.get('msg')}. Проверьте права API-ключа (требуется 'Read' для Wallet и Spot).")
             else:
                 current_app.logger.warning(f"Предупреждение API BingX для {endpoint}: {response_data.get('msg')}")
+            if raise_errors:
+                raise BingXApiError(response_data.get('msg', ''))
             return None
         return response_data
+    except BingXApiError:
+        raise
     except Exception as e:
         current_app.logger.error(f"Исключение при запросе к BingX {endpoint}: {e}", exc_info=True)
+        if raise_errors:
+            raise
         return None
+
 def _bitget_api_get(api_key: str, api_secret: str, passphrase: str, endpoint: str, params: dict = None):
     """Внутренняя функция для выполнения GET-запросов к Bitget с подписью."""
+    rate_limiter.acquire('bitget', endpoint)
     timestamp = _get_timestamp_ms()
     method = 'GET'
     
@@ -149,7 +289,7 @@ def _bitget_api_get(api_key: str, api_secret: str, passphrase: str, endpoint: st
     
     url = f"{BITGET_BASE_URL}{request_path}"
     try:
-        response_data = _make_request(method, url, headers=headers)
+        response_data = _make_request(method, url, headers=headers, exchange='bitget', rate_limit_acquired=True)
         if response_data.get('code') != '00000':
             current_app.logger.warning(f"Предупреждение API Bitget для {endpoint}: {response_data.get('msg')}")
             return None
@@ -159,17 +299,18 @@ def _bitget_api_get(api_key: str, api_secret: str, passphrase: str, endpoint: st
         return None
 # --- Функции для получения публичных данных о курсах ---
 
+def _load_bybit_spot_tickers() -> dict:
+    url = f"{BYBIT_BASE_URL}/v5/market/tickers"
+    response_data = _make_request('GET', url, params={'category': 'spot'}, exchange='bybit')
+    if response_data.get('retCode') != 0:
+        raise Exception(f"Ошибка API Bybit: {response_data.get('retMsg')}")
+    return {item['symbol']: item for item in response_data.get('result', {}).get('list', [])}
+
 def fetch_bybit_spot_tickers(target_symbols: list) -> list:
-    """Получает данные о курсах с Bybit."""
+    """Получает данные о курсах с Bybit (из общего снимка тикеров, см. ticker_cache)."""
     current_app.logger.info(f"Получение реальных данных с Bybit (прямой API) для символов: {target_symbols}")
-    endpoint = "/v5/market/tickers"
-    url = f"{BYBIT_BASE_URL}{endpoint}"
     try:
-        response_data = _make_request('GET', url, params={'category': 'spot'})
-        if response_data.get('retCode') != 0:
-            raise Exception(f"Ошибка API Bybit: {response_data.get('retMsg')}")
-        
-        all_tickers = {item['symbol']: item for item in response_data.get('result', {}).get('list', [])}
+        all_tickers = get_ticker_snapshot('bybit', _load_bybit_spot_tickers)
         formatted_data = []
         for symbol in target_symbols:
             if symbol in all_tickers:
@@ -185,75 +326,78 @@ def fetch_bybit_spot_tickers(target_symbols: list) -> list:
         current_app.logger.error(f"Ошибка при получении тикеров Bybit: {e}")
         return []
 
-def fetch_bybit_historical_price_range(symbol: str, start_date: date, end_date: date) -> dict[date, Decimal]:
+def fetch_bybit_historical_price_range(symbol: str, start_date: date, end_date: date, raise_errors: bool = False) -> dict[date, Decimal]:
     """
     Получает диапазон исторических цен закрытия для символа с Bybit.
     Возвращает словарь {дата: цена}. 
-    ИСПРАВЛЕНО: Добавлена пагинация для запроса данных за периоды > 1000 дней.
+    Диапазон запрашивается окнами по 1000 дней (лимит API) с явными start/end,
+    поэтому порядок свечей в ответе не влияет на пагинацию.
+    При raise_errors=True ошибки API/сети пробрасываются вызывающему коду
+    (нужно хранилищу цен, чтобы не считать диапазон загруженным).
     """
     endpoint = "/v5/market/kline"
     prices = {}
     current_start_date = start_date
 
     while current_start_date <= end_date:
+        window_end_date = min(end_date, current_start_date + timedelta(days=999))
         start_ts_ms = int(datetime.combine(current_start_date, datetime.min.time(), tzinfo=timezone.utc).timestamp() * 1000)
+        end_ts_ms = int(datetime.combine(window_end_date, datetime.max.time(), tzinfo=timezone.utc).timestamp() * 1000)
         
         params = {
             'category': 'spot',
             'symbol': symbol,
             'interval': 'D', # Дневной интервал
             'start': start_ts_ms,
+            'end': end_ts_ms,
             'limit': 1000 # Максимальный лимит за один запрос
         }
 
         try:
-            current_app.logger.info(f"--- [Bybit History Fetch] Запрос для {symbol} с {current_start_date.isoformat()}...")
-            response_data = _make_request('GET', f"{BYBIT_BASE_URL}{endpoint}", params=params)
-            
-            if response_data.get('retCode') == 0 and response_data.get('result', {}).get('list'):
-                kline_list = response_data['result']['list']
-                if not kline_list:
-                    # Если API вернул пустой список, значит, данных больше нет
-                    current_app.logger.info(f"--- [Bybit History Fetch] Получен пустой список для {symbol} с {current_start_date.isoformat()}, завершение.")
-                    break
-
-                last_kline_date = None
-                for kline in kline_list:
-                    # kline[0] - timestamp в мс, kline[4] - цена закрытия
-                    kline_date = datetime.fromtimestamp(int(kline[0]) / 1000, tz=timezone.utc).date()
-                    if start_date <= kline_date <= end_date:
-                        prices[kline_date] = Decimal(kline[4])
-                    last_kline_date = kline_date
-                
-                # Перемещаемся на следующий день после последней полученной даты
-                if last_kline_date:
-                    current_start_date = last_kline_date + timedelta(days=1)
-                else:
-                    break
-                
-                time.sleep(0.2) # Пауза между запросами, чтобы не попасть под rate limit
-            else:
-                current_app.logger.warning(f"--- [Bybit History Fetch] Ошибка API или нет данных для {symbol} с {current_start_date.isoformat()}. Код: {response_data.get('retCode')}, Сообщение: {response_data.get('retMsg')}")
-                break
+            current_app.logger.info(f"--- [Bybit History Fetch] Запрос для {symbol} с {current_start_date.isoformat()} по {window_end_date.isoformat()}...")
+            response_data = _make_request('GET', f"{BYBIT_BASE_URL}{endpoint}", params=params, exchange='bybit')
         except Exception as e:
             current_app.logger.error(f"--- [API Error] Не удалось получить историю цен для {symbol} с {current_start_date.isoformat()}: {e}")
+            if raise_errors:
+                raise
             break # Прерываем цикл при ошибке сети
 
+        if response_data.get('retCode') == 10001 and 'symbol' in str(response_data.get('retMsg', '')).lower():
+            # Пара не торгуется на Bybit: это не сбой, а отсутствие данных (диапазон считается загруженным)
+            current_app.logger.info(f"--- [Bybit History Fetch] Пара {symbol} не поддерживается Bybit: {response_data.get('retMsg')}")
+            return prices
+
+        if response_data.get('retCode') != 0:
+            message = f"Ошибка API Bybit для {symbol} с {current_start_date.isoformat()}. Код: {response_data.get('retCode')}, Сообщение: {response_data.get('retMsg')}"
+            current_app.logger.warning(f"--- [Bybit History Fetch] {message}")
+            if raise_errors:
+                raise Exception(message)
+            break
+
+        # kline[0] - timestamp начала свечи в мс, kline[4] - цена закрытия.
+        # Пустой список означает, что в этом окне торгов не было (например, до листинга).
+        for kline in response_data.get('result', {}).get('list') or []:
+            kline_date = datetime.fromtimestamp(int(kline[0]) / 1000, tz=timezone.utc).date()
+            if start_date <= kline_date <= end_date:
+                prices[kline_date] = Decimal(kline[4])
+
+        current_start_date = window_end_date + timedelta(days=1)
+
     return prices
 
+def _load_bitget_spot_tickers() -> dict:
+    url = f"{BITGET_BASE_URL}/api/v2/spot/market/tickers"
+    # Bitget public tickers do not require a timestamp parameter.
+    response_data = _make_request('GET', url, exchange='bitget')
+    if response_data.get('code') != '00000':
+        raise Exception(f"Ошибка API Bitget: {response_data.get('msg')}")
+    return {item['symbol']: item for item in response_data.get('data', [])}
+
 def fetch_bitget_spot_tickers(target_symbols: list) -> list:
-    """Получает данные о курсах с Bitget."""
+    """Получает данные о курсах с Bitget (из общего снимка тикеров, см. ticker_cache)."""
     current_app.logger.info(f"Получение реальных данных с Bitget (прямой API) для символов: {target_symbols}")
-    endpoint = "/api/v2/spot/market/tickers"
-    url = f"{BITGET_BASE_URL}{endpoint}"
     try:
-        # Bitget public tickers do not require a timestamp parameter.
-        # Fetch all tickers and filter locally.
-        response_data = _make_request('GET', url)
-        if response_data.get('code') != '00000':
-            raise Exception(f"Ошибка API Bitget: {response_data.get('msg')}")
-        
-        all_tickers = {item['symbol']: item for item in response_data.get('data', [])}
+        all_tickers = get_ticker_snapshot('bitget', _load_bitget_spot_tickers)
         formatted_data = []
         for symbol in target_symbols:
             # Символ в target_symbols уже должен быть в формате API (например, BTCUSDT)
@@ -270,19 +414,20 @@ def fetch_bitget_spot_tickers(target_symbols: list) -> list:
         current_app.logger.error(f"Ошибка при получении тикеров Bitget: {e}")
         return []
 
+def _load_bingx_spot_tickers() -> dict:
+    url = f"{BINGX_BASE_URL}/openApi/spot/v1/ticker/24hr"
+    # ИСПРАВЛЕНО: Этот публичный эндпоинт не требует подписи, но, судя по логам, требует timestamp.
+    params = {'timestamp': _get_timestamp_ms()}
+    response_data = _make_request('GET', url, params=params, exchange='bingx')
+    if response_data.get('code') != 0:
+        raise Exception(f"Ошибка API BingX: {response_data.get('msg')}")
+    return {item['symbol']: item for item in response_data.get('data', [])}
+
 def fetch_bingx_spot_tickers(target_symbols: list) -> list:
-    """Получает данные о курсах с BingX."""
+    """Получает данные о курсах с BingX (из общего снимка тикеров, см. ticker_cache)."""
     current_app.logger.info(f"Получение реальных данных с BingX (прямой API) для символов: {target_symbols}")
-    endpoint = "/openApi/spot/v1/ticker/24hr"
-    url = f"{BINGX_BASE_URL}{endpoint}"
     try:
-        # ИСПРАВЛЕНО: Этот публичный эндпоинт не требует подписи, но, судя по логам, требует timestamp.
-        params = {'timestamp': _get_timestamp_ms()}
-        response_data = _make_request('GET', url, params=params)
-        if response_data.get('code') != 0:
-            raise Exception(f"Ошибка API BingX: {response_data.get('msg')}")
-        
-        all_tickers = {item['symbol']: item for item in response_data.get('data', [])}
+        all_tickers = get_ticker_snapshot('bingx', _load_bingx_spot_tickers)
         formatted_data = []
         for symbol in target_symbols:
             if symbol in all_tickers:
@@ -303,17 +448,61 @@ def fetch_bingx_spot_tickers(target_symbols: list) -> list:
         current_app.logger.error(f"Ошибка при получении тикеров BingX: {e}")
         return []
 
+# Каталог спотовых пар BingX (публичный эндпоинт symbols) хранится в JsonCache: список пар меняется
+# редко, а по нему история сделок запрашивается только для существующих пар.
+BINGX_SYMBOLS_CACHE_KEY = 'bingx_spot_symbols'
+BINGX_SYMBOLS_CACHE_TTL = timedelta(hours=24)
+
+def _load_bingx_symbol_catalogue() -> set[str]:
+    url = f"{BINGX_BASE_URL}/openApi/spot/v1/common/symbols"
+    response_data = _make_request('GET', url, params={'timestamp': _get_timestamp_ms()}, exchange='bingx')
+    if not response_data or response_data.get('code') != 0:
+        raise Exception(f"Ошибка API BingX: {(response_data or {}).get('msg')}")
+    # Берем пары в любом статусе: приостановленные и снятые с торгов пары тоже могли иметь сделки
+    return {item['symbol'] for item in response_data.get('data', {}).get('symbols', []) if item.get('symbol')}
+
+def get_bingx_symbol_catalogue() -> set[str] | None:
+    """
+    Возвращает множество спотовых пар BingX ('BTC-USDT', ...) из кэша, обновляя его раз в сутки.
+    Если обновить не удалось, используется устаревший каталог; без каталога возвращается None.
+    """
+    cache_entry = JsonCache.query.filter_by(cache_key=BINGX_SYMBOLS_CACHE_KEY).first()
+    if cache_entry:
+        last_updated = cache_entry.last_updated
+        if last_updated and last_updated.tzinfo is None:
+            last_updated = last_updated.replace(tzinfo=timezone.utc)
+        if last_updated and datetime.now(timezone.utc) - last_updated < BINGX_SYMBOLS_CACHE_TTL:
+            return set(json.loads(cache_entry.json_data))
+
+    try:
+        symbols = _load_bingx_symbol_catalogue()
+    except Exception as e:
+        current_app.logger.warning(f"--- [BingX Symbols] Не удалось обновить каталог пар: {e}")
+        return set(json.loads(cache_entry.json_data)) if cache_entry else None
+    if not symbols:
+        return set(json.loads(cache_entry.json_data)) if cache_entry else None
+
+    if not cache_entry:
+        cache_entry = JsonCache(cache_key=BINGX_SYMBOLS_CACHE_KEY)
+        db.session.add(cache_entry)
+    cache_entry.json_data = json.dumps(sorted(symbols))
+    cache_entry.last_updated = datetime.now(timezone.utc)
+    db.session.commit()
+    current_app.logger.info(f"--- [BingX Symbols] Каталог обновлен: {len(symbols)} пар.")
+    return symbols
+
+def _load_kucoin_spot_tickers() -> dict:
+    url = f"{KUCOIN_BASE_URL}/api/v1/market/allTickers"
+    response_data = _make_request('GET', url, exchange='kucoin')
+    if response_data.get('code') != '200000':
+        raise Exception(f"Ошибка API KuCoin: {response_data.get('msg')}")
+    return {item['symbol']: item for item in response_data.get('data', {}).get('ticker', [])}
+
 def fetch_kucoin_spot_tickers(target_symbols: list) -> list:
-    """Получает данные о курсах с KuCoin."""
+    """Получает данные о курсах с KuCoin (из общего снимка тикеров, см. ticker_cache)."""
     current_app.logger.info(f"Получение реальных данных с KuCoin (прямой API) для символов: {target_symbols}")
-    endpoint = "/api/v1/market/allTickers"
-    url = f"{KUCOIN_BASE_URL}{endpoint}"
     try:
-        response_data = _make_request('GET', url)
-        if response_data.get('code') != '200000':
-            raise Exception(f"Ошибка API KuCoin: {response_data.get('msg')}")
-        
-        all_tickers = {item['symbol']: item for item in response_data.get('data', {}).get('ticker', [])}
+        all_tickers = get_ticker_snapshot('kucoin', _load_kucoin_spot_tickers)
         formatted_data = []
         for symbol in target_symbols:
             if symbol in all_tickers:
@@ -329,17 +518,18 @@ def fetch_kucoin_spot_tickers(target_symbols: list) -> list:
         current_app.logger.error(f"Ошибка при получении тикеров KuCoin: {e}")
         return []
 
+def _load_okx_spot_tickers() -> dict:
+    url = f"{OKX_BASE_URL}/api/v5/market/tickers"
+    response_data = _make_request('GET', url, params={'instType': 'SPOT'}, exchange='okx')
+    if response_data.get('code') != '0':
+        raise Exception(f"Ошибка API OKX: {response_data.get('msg')}")
+    return {item['instId']: item for item in response_data.get('data', [])}
+
 def fetch_okx_spot_tickers(target_symbols: list) -> list:
-    """Получает данные о курсах с OKX."""
+    """Получает данные о курсах с OKX (из общего снимка тикеров, см. ticker_cache)."""
     current_app.logger.info(f"Получение реальных данных с OKX (прямой API) для символов: {target_symbols}")
-    endpoint = "/api/v5/market/tickers"
-    url = f"{OKX_BASE_URL}{endpoint}"
     try:
-        response_data = _make_request('GET', url, params={'instType': 'SPOT'})
-        if response_data.get('code') != '0':
-            raise Exception(f"Ошибка API OKX: {response_data.get('msg')}")
-        
-        all_tickers = {item['instId']: item for item in response_data.get('data', [])}
+        all_tickers = get_ticker_snapshot('okx', _load_okx_spot_tickers)
         formatted_data = []
         for symbol in target_symbols:
             if symbol in all_tickers:
@@ -362,7 +552,7 @@ def fetch_cbr_usd_rub_rate() -> Decimal | None:
         today_str = datetime.now(timezone.utc).strftime('%d/%m/%Y')
         url = f"https://www.cbr.ru/scripts/XML_daily.asp?date_req={today_str}"
         current_app.logger.info(f"--- [Exchange Rate] Запрос курса USD/RUB с ЦБ РФ: {url}")
-        response = requests.get(url, timeout=10)
+        response = get_http_session().get(url, timeout=10)
         response.raise_for_status()
 
         # Парсим XML
@@ -420,7 +610,7 @@ def fetch_cryptocompare_news(limit: int = 50, categories: str = None) -> list:
         # Логируем параметры без API ключа для безопасности
         log_params = {k: v for k, v in params.items() if k != 'api_key'}
         current_app.logger.info(f"--- [CryptoCompare] Запрос новостей с параметрами: {log_params}")
-        response = requests.get(url, params=params, timeout=15)
+        response = get_http_session().get(url, params=params, timeout=15)
         response.raise_for_status()
         response_data = response.json()
         if response_data.get('Type') == 100: # 100 is success for CryptoCompare
@@ -455,10 +645,10 @@ def fetch_bingx_account_assets(api_key: str, api_secret: str, passphrase: str =
     spot_data = _bingx_api_get(api_key, api_secret, '/openApi/spot/v1/account/balance')
     if spot_data and spot_data.get('code') == 0 and spot_data.get('data', {}).get('balances'):
         for asset_data in spot_data['data']['balances']:
-            quantity = float(asset_data.get('free', 0)) + float(asset_data.get('locked', 0))
-            if quantity > 1e-9:
+            quantity = _to_decimal(asset_data.get('free')) + _to_decimal(asset_data.get('locked'))
+            if quantity > MIN_BALANCE:
                 key = (asset_data['asset'], 'Spot')
-                assets_map[key] = assets_map.get(key, 0.0) + quantity
+                assets_map[key] = assets_map.get(key, Decimal('0')) + quantity
     else:
         current_app.logger.debug(f"[BingX Debug] Raw spot_data response: {json.dumps(spot_data, indent=2) if spot_data else 'No response'}")
         current_app.logger.warning("[BingX] Не удалось получить баланс Spot Account или он пуст.")
@@ -477,8 +667,77 @@ def fetch_bingx_account_assets(api_key: str, api_secret: str, passphrase: str =
     return all_assets
 
 
+# --- Параллельный сбор балансов по кошелькам биржи ---
+# Бюджет времени на все кошельки одной биржи: медленный эндпоинт не задерживает остальные,
+# а его счета помечаются как незагруженные, чтобы синхронизация не обнулила их активы.
+WALLET_FETCH_TIMEOUT = 15  # секунд
+
+MIN_BALANCE = Decimal('1e-9')
+
+def _to_decimal(value) -> Decimal:
+    """Переводит число из ответа биржи (обычно строку) в Decimal без промежуточного float; пустое/битое значение - 0."""
+    try:
+        return Decimal(str(value)) if value not in (None, '') else Decimal('0')
+    except InvalidOperation:
+        return Decimal('0')
+
+class WalletBalances(list):
+    """Список балансов [{'ticker', 'quantity', 'account_type'}] с типами счетов, которые загрузить не удалось."""
+    def __init__(self, assets=(), incomplete_account_types=()):
+        super().__init__(assets)
+        self.incomplete_account_types = set(incomplete_account_types)
+
+def _fetch_wallets_concurrently(exchange_label: str, collectors: list, timeout: float = WALLET_FETCH_TIMEOUT) -> WalletBalances:
+    """
+    Параллельно опрашивает кошельки биржи и сводит балансы в карту {(тикер, тип счета): количество}.
+    `collectors` - список (описание, тип счета, функция без аргументов -> [(тикер, количество Decimal)]).
+    Исключение или превышение общего бюджета времени помечает тип счета как незагруженный;
+    балансы такого типа счета в результат не попадают.
+    """
+    app = current_app._get_current_object()
+
+    def _worker(collect):
+        with app.app_context():
+            return collect()
+
+    assets_map = {}
+    incomplete = set()
+    executor = ThreadPoolExecutor(max_workers=len(collectors))
+    try:
+        futures = {executor.submit(_worker, collect): (description, account_type) for description, account_type, collect in collectors}
+        done, not_done = wait(futures, timeout=timeout)
+        for future in not_done:
+            description, account_type = futures[future]
+            current_app.logger.warning(f"--- [{exchange_label}] Баланс {description} не получен за {timeout} с, пропускаем.")
+            incomplete.add(account_type)
+        for future in done:
+            description, account_type = futures[future]
+            try:
+                balances = future.result()
+            except Exception as e:
+                current_app.logger.error(f"Исключение при получении баланса {exchange_label} {description}: {e}")
+                incomplete.add(account_type)
+                continue
+            for ticker, quantity in balances:
+                if quantity > MIN_BALANCE:
+                    assets_map[(ticker, account_type)] = assets_map.get((ticker, account_type), Decimal('0')) + quantity
+    finally:
+        # Не ждем зависшие запросы: их результат уже не нужен
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Частичные суммы незагруженного типа счета (например, Earn из двух категорий Bybit, одна из которых
+    # не ответила) не возвращаем: иначе синхронизация записала бы заниженный баланс поверх сохраненного.
+    assets = [{'ticker': t, 'quantity': str(q), 'account_type': at} for (t, at), q in assets_map.items() if q > MIN_BALANCE and at not in incomplete]
+    return WalletBalances(assets, incomplete)
+
 # --- РЕФАКТОРИНГ: Классы для API клиентов ---
 
+# Реестр клиентов процесса: {(класс клиента, API ключ): клиент}. Клиенты не хранят изменяемого
+# состояния запроса (подпись считается для каждого запроса отдельно), поэтому один экземпляр
+# безопасно используется из нескольких потоков.
+_client_registry = {}
+_client_registry_lock = threading.Lock()
+
 class BaseApiClient:
     """Базовый класс для всех API клиентов."""
     def __init__(self, api_key, api_secret, passphrase=None, base_url=None):
@@ -487,40 +746,87 @@ class BaseApiClient:
         self.passphrase = passphrase
         self.base_url = base_url
 
+    @classmethod
+    def for_credentials(cls, api_key, api_secret, passphrase=None):
+        """Возвращает общий клиент для ключа из реестра процесса; при смене секрета клиент пересоздается."""
+        registry_key = (cls, api_key)
+        with _client_registry_lock:
+            client = _client_registry.get(registry_key)
+            if client is None or client.api_secret != api_secret or client.passphrase != passphrase:
+                client = cls(api_key, api_secret, passphrase)
+                _client_registry[registry_key] = client
+            return client
+
     def _get(self, path, params=None):
         raise NotImplementedError
 
     def _post(self, path, data=None, params=None):
         raise NotImplementedError
 
+# Параллельная загрузка окон истории Bybit: число одновременно загружаемых окон одного эндпоинта,
+# максимальная длина окна по эндпоинтам (ограничение API, по умолчанию 7 дней) и нижняя граница
+# сужения окна в плотные периоды.
+BYBIT_HISTORY_WORKERS = 3
+# Окна берутся чуть короче документированного лимита в 30 дней, чтобы не упираться в его границу.
+BYBIT_MAX_HISTORY_WINDOW = {
+    '/v5/asset/deposit/query-record': timedelta(days=29),
+    '/v5/asset/deposit/query-internal-record': timedelta(days=29),
+    '/v5/asset/withdraw/query-record': timedelta(days=29),
+}
+BYBIT_HISTORY_RETENTION = timedelta(days=2*365)  # глубина истории, которую отдает Bybit
+BYBIT_MIN_HISTORY_WINDOW = timedelta(hours=6)
+# Общие ошибки запроса Bybit (timestamp, подпись/ключ, права, лимит запросов, сбой сервера): при них
+# баланс кошелька неизвестен, в отличие от ответа Earn об отсутствии продукта.
+BYBIT_ACCOUNT_ERROR_CODES = {10002, 10003, 10004, 10005, 10006, 10016, 10018}
+BYBIT_TIME_SYNC_INTERVAL = 600  # секунд между синхронизациями часов с сервером Bybit
+
 class BybitClient(BaseApiClient):
-    """Клиент для работы с Bybit API v5."""
+    """
+    Клиент для работы с Bybit API v5.
+    Смещение часов относительно сервера Bybit общее для всех экземпляров (не зависит от ключа):
+    оно синхронизируется при первом подписанном запросе и обновляется раз в BYBIT_TIME_SYNC_INTERVAL.
+    """
+    _time_offset = 0
+    _time_synced_at = None
+    _time_lock = threading.Lock()
+
     def __init__(self, api_key, api_secret, passphrase=None):
         super().__init__(api_key, api_secret, passphrase, BYBIT_BASE_URL)
-        self.time_offset = 0
-        self.sync_time()
 
     def sync_time(self):
         """Синхронизирует локальное время с временем сервера Bybit."""
         try:
             url = f"{self.base_url}/v5/market/time"
             # Public endpoint, no auth needed
-            response = _make_request('GET', url)
+            response = _make_request('GET', url, exchange='bybit')
             if response and response.get('retCode') == 0:
                 server_time_ms = int(response['result']['timeNano']) // 1_000_000
                 local_time_ms = int(time.time() * 1000)
-                self.time_offset = server_time_ms - local_time_ms
-                current_app.logger.info(f"[Bybit Time Sync] Server time synced. Offset is {self.time_offset} ms.")
+                BybitClient._time_offset = server_time_ms - local_time_ms
+                current_app.logger.info(f"[Bybit Time Sync] Server time synced. Offset is {BybitClient._time_offset} ms.")
             else:
                 current_app.logger.warning(f"[Bybit Time Sync] Failed to sync server time. Using local time.")
-                self.time_offset = 0
+                BybitClient._time_offset = 0
         except Exception as e:
             current_app.logger.error(f"[Bybit Time Sync] Error syncing time: {e}. Using local time.")
-            self.time_offset = 0
+            BybitClient._time_offset = 0
+        # Неудачная синхронизация тоже откладывает следующую попытку, чтобы не повторять ее перед каждым запросом
+        BybitClient._time_synced_at = time.monotonic()
+
+    def _timestamp_ms(self) -> int:
+        """Текущее время сервера Bybit в мс; смещение обновляется одним потоком, остальные его ждут."""
+        synced_at = BybitClient._time_synced_at
+        if synced_at is None or time.monotonic() - synced_at > BYBIT_TIME_SYNC_INTERVAL:
+            with BybitClient._time_lock:
+                synced_at = BybitClient._time_synced_at
+                if synced_at is None or time.monotonic() - synced_at > BYBIT_TIME_SYNC_INTERVAL:
+                    self.sync_time()
+        return int(time.time() * 1000) + BybitClient._time_offset
 
     def _request(self, method, path, params=None):
         """Выполняет подписанный запрос к Bybit."""
-        timestamp = str(int(time.time() * 1000) + self.time_offset) # Use synchronized time
+        rate_limiter.acquire('bybit', path)
+        timestamp = str(self._timestamp_ms()) # Use synchronized time
         recv_window = "20000"
         
         params_with_recv_window = params.copy() if params else {}
@@ -539,116 +845,137 @@ class BybitClient(BaseApiClient):
             'Content-Type': 'application/json'
         }
         current_app.logger.info(f"\n--- [Bybit] Запрос к: {path} с параметрами {params} ---")
-        return _make_request(method, url, headers=headers)
+        return _make_request(method, url, headers=headers, exchange='bybit', rate_limit_acquired=True)
 
     def _get(self, path, params=None):
         return self._request('GET', path, params)
 
     def get_account_assets(self):
-        """Получает балансы активов с Bybit, включая Funding и Earn."""
-        assets_map = {}
-
-        # 1. Unified Trading Account
-        current_app.logger.info("\n--- [Bybit] Попытка получить баланс Unified Trading Account ---")
-        try:
-            unified_data = self._get('/v5/account/wallet-balance', {'accountType': 'UNIFIED'})
-            if unified_data.get('retCode') == 0 and unified_data.get('result', {}).get('list'):
-                for coin_balance in unified_data['result']['list'][0].get('coin', []):
-                    balance = float(coin_balance.get('walletBalance', 0))
-                    if balance > 0:
-                        key = (coin_balance['coin'], 'Unified Trading')
-                        assets_map[key] = assets_map.get(key, 0.0) + balance
-        except Exception as e:
-            current_app.logger.error(f"Исключение при получении баланса Unified Account: {e}")
-
-        # 2. Funding Account
-        current_app.logger.info("\n--- [Bybit] Попытка получить баланс Funding Account ---")
-        try:
-            funding_data = self._get('/v5/asset/transfer/query-account-coins-balance', {'accountType': 'FUND'})
-            if funding_data.get('retCode') == 0 and funding_data.get('result', {}).get('balance'):
-                for coin_balance in funding_data['result']['balance']:
-                    balance = float(coin_balance.get('walletBalance', 0))
-                    if balance > 0:
-                        key = (coin_balance['coin'], 'Funding')
-                        assets_map[key] = assets_map.get(key, 0.0) + balance
-        except Exception as e:
-            current_app.logger.error(f"Исключение при получении баланса Funding Account: {e}")
-
-        # 3. Earn Account
-        current_app.logger.info("\n--- [Bybit] Попытка получить баланс Earn ---")
-        earn_categories = ['FlexibleSaving', 'OnChain']
-        for category in earn_categories:
-            try:
-                earn_data = self._get('/v5/earn/position', {'category': category})
-                if earn_data.get('retCode') == 0 and earn_data.get('result', {}).get('list'):
-                    for pos in earn_data['result']['list']:
-                        principal = float(pos.get('amount', 0))
-                        if principal > 1e-9:
-                            key = (pos['coin'], 'Earn')
-                            assets_map[key] = assets_map.get(key, 0.0) + principal
-                elif earn_data.get('retCode') != 0:
-                    current_app.logger.info(f"[Bybit] Информация: не удалось получить баланс Earn для категории {category}: {earn_data.get('retMsg')}.")
-            except Exception as e:
-                current_app.logger.error(f"Исключение при получении баланса Earn для категории {category}: {e}")
-
-        return [{'ticker': t, 'quantity': str(q), 'account_type': at} for (t, at), q in assets_map.items() if q > 1e-9]
+        """Получает балансы активов с Bybit, включая Funding и Earn (все кошельки опрашиваются параллельно)."""
+        def _wallet_result(response_data, description):
+            # Ошибка API (лимит запросов, timestamp, права ключа) - это не пустой кошелек:
+            # исключение помечает тип счета незагруженным, и его активы не обнуляются.
+            if response_data.get('retCode') != 0:
+                raise Exception(f"Ошибка API Bybit для {description}: {response_data.get('retMsg')} (retCode {response_data.get('retCode')})")
+            return response_data.get('result', {})
+
+        def _unified():
+            result = _wallet_result(self._get('/v5/account/wallet-balance', {'accountType': 'UNIFIED'}), "Unified Trading Account")
+            if not result.get('list'):
+                return []
+            return [(c['coin'], _to_decimal(c.get('walletBalance'))) for c in result['list'][0].get('coin', [])]
+
+        def _funding():
+            result = _wallet_result(self._get('/v5/asset/transfer/query-account-coins-balance', {'accountType': 'FUND'}), "Funding Account")
+            return [(c['coin'], _to_decimal(c.get('walletBalance'))) for c in result.get('balance') or []]
+
+        def _earn(category):
+            earn_data = self._get('/v5/earn/position', {'category': category})
+            if earn_data.get('retCode') in BYBIT_ACCOUNT_ERROR_CODES:
+                _wallet_result(earn_data, f"Earn ({category})")
+            if earn_data.get('retCode') == 0 and earn_data.get('result', {}).get('list'):
+                return [(pos['coin'], _to_decimal(pos.get('amount'))) for pos in earn_data['result']['list']]
+            if earn_data.get('retCode') != 0:
+                # Прочие ошибки - ожидаемый ответ для аккаунта без продукта Earn этой категории: кошелек пуст
+                current_app.logger.info(f"[Bybit] Информация: не удалось получить баланс Earn для категории {category}: {earn_data.get('retMsg')}.")
+            return []
 
-    def _fetch_paginated_history(self, endpoint, start_time_dt, end_time_dt, extra_params=None):
-        """Общая функция для получения истории с пагинацией по времени и курсору."""
-        # ИЗМЕНЕНО: Добавлена поддержка extra_params для гибкости
-        all_records = []
+        return _fetch_wallets_concurrently('Bybit', [
+            ("Unified Trading Account", 'Unified Trading', _unified),
+            ("Funding Account", 'Funding', _funding),
+            # Earn: категории FlexibleSaving и OnChain складываются в один тип счета
+            ("Earn (FlexibleSaving)", 'Earn', lambda: _earn('FlexibleSaving')),
+            ("Earn (OnChain)", 'Earn', lambda: _earn('OnChain')),
+        ])
+
+    def _fetch_history_window(self, endpoint, window_start, window_end, extra_params=None) -> list:
+        """Загружает все страницы одного временного окна по курсору. Возвращает список страниц (списков записей)."""
+        start_ts_ms = int(window_start.timestamp() * 1000)
+        end_ts_ms = int(window_end.timestamp() * 1000)
+        current_app.logger.info(f"--- [Bybit History: {endpoint}] Запрос за период: {window_start.strftime('%Y-%m-%d %H:%M')} -> {window_end.strftime('%Y-%m-%d %H:%M')}")
+
+        pages = []
+        cursor = ""
+        while True:
+            params = {'limit': 50, 'startTime': start_ts_ms, 'endTime': end_ts_ms}
+            if extra_params:
+                params.update(extra_params)
+            if cursor:
+                params['cursor'] = cursor
+
+            response_data = self._get(endpoint, params)
+            ret_code = response_data.get('retCode')
+
+            if ret_code == 10001 and window_start < datetime.now(timezone.utc) - BYBIT_HISTORY_RETENTION:
+                # Окно старше доступной истории (2 года): считаем его пустым. В остальных случаях
+                # 10001 - отказ по параметрам, и окно нельзя отмечать загруженным.
+                current_app.logger.info(f"--- [Bybit History: {endpoint}] Окно за пределом истории в 2 года, пропускаем.")
+                pages.append([])
+                return pages
+            if ret_code != 0:
+                raise Exception(f"Ошибка API Bybit для {endpoint}: {response_data.get('retMsg')}")
+
+            result = response_data.get('result', {})
+            pages.append(result.get('rows', []) or result.get('list', []))
+            cursor = result.get('nextPageCursor')
+            if not cursor:
+                return pages
+
+    def iter_history_pages(self, endpoint, start_time_dt, end_time_dt, extra_params=None):
+        """
+        Постранично выдает историю эндпоинта парами (записи, водяной знак).
+        Период обходится окнами от старых к новым: по BYBIT_HISTORY_WORKERS окон загружаются
+        параллельно (под общим rate limiter), а результаты выдаются строго по порядку, так что
+        водяной знак (конец окна, приходит с последней страницей окна) только растет.
+        Размер окна адаптивный: после пустой серии окон он удваивается до лимита API эндпоинта,
+        а если окно не поместилось в одну страницу - уменьшается, чтобы плотные периоды
+        тоже делились между воркерами, а не листались курсором последовательно.
+        """
         end_time = end_time_dt if end_time_dt else datetime.now(timezone.utc)
-        limit_date = start_time_dt or (end_time - timedelta(days=2*365))
-
-        while end_time > limit_date:
-            start_time = end_time - timedelta(days=7)
-            start_ts_ms = int(start_time.timestamp() * 1000)
-            end_ts_ms = int(end_time.timestamp() * 1000)
-            
-            current_app.logger.info(f"--- [Bybit History: {endpoint}] Запрос за период: {start_time.strftime('%Y-%m-%d')} -> {end_time.strftime('%Y-%m-%d')}")
-            
-            cursor = ""
-            history_limit_reached = False
-            while True:
-                params = {'limit': 50, 'startTime': start_ts_ms, 'endTime': end_ts_ms}
-                if extra_params:
-                    params.update(extra_params)
-                if cursor:
-                    params['cursor'] = cursor
-                
-                response_data = self._get(endpoint, params)
-                ret_code = response_data.get('retCode')
-
-                if ret_code == 10001:
-                    current_app.logger.info(f"--- [Bybit History: {endpoint}] Достигнут предел истории в 2 года.")
-                    history_limit_reached = True
-                    break
-                elif ret_code != 0:
-                    raise Exception(f"Ошибка API Bybit для {endpoint}: {response_data.get('retMsg')}")
+        start_time = start_time_dt or (end_time - timedelta(days=2*365))
+        max_window = BYBIT_MAX_HISTORY_WINDOW.get(endpoint, timedelta(days=7))
+        window = min(max_window, timedelta(days=7))
+
+        def _fetch(bounds):
+            return self._fetch_history_window(endpoint, bounds[0], bounds[1], extra_params)
+
+        window_start = start_time
+        while window_start < end_time:
+            batch = []
+            while len(batch) < BYBIT_HISTORY_WORKERS and window_start < end_time:
+                window_end = min(end_time, window_start + window)
+                batch.append((window_start, window_end))
+                window_start = window_end
+
+            max_pages, has_records = 0, False
+            for (_, window_end), pages in zip(batch, _iter_ordered_parallel(_fetch, batch, max_workers=len(batch))):
+                max_pages = max(max_pages, len(pages))
+                has_records = has_records or any(pages)
+                for i, records in enumerate(pages):
+                    yield records, (window_end if i == len(pages) - 1 else None)
+
+            if max_pages > 1:
+                window = max(BYBIT_MIN_HISTORY_WINDOW, window / max_pages)
+            elif not has_records:
+                window = min(max_window, window * 2)
 
-                result = response_data.get('result', {})
-                records = result.get('rows', []) or result.get('list', [])
-                if records:
-                    all_records.extend(records)
-                
-                cursor = result.get('nextPageCursor')
-                if not cursor:
-                    break
-            
-            if history_limit_reached:
-                break
-            end_time = start_time
-            time.sleep(0.2)
-        return all_records
+    def _fetch_paginated_history(self, endpoint, start_time_dt, end_time_dt, extra_params=None):
+        """Общая функция для получения всей истории эндпоинта одним списком."""
+        return [record for records, _ in self.iter_history_pages(endpoint, start_time_dt, end_time_dt, extra_params) for record in records]
 
 # --- Функции для получения балансов аккаунтов (требуют аутентификации) ---
 
 def fetch_bybit_account_assets(api_key: str, api_secret: str, passphrase: str = None) -> list:
     """Получает балансы активов с Bybit, включая Funding и Earn."""
     current_app.logger.info(f"Получение реальных балансов с Bybit (прямой API, включая Funding и Earn) с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     return client.get_account_assets()
 
+# Глубина хранения сделок в REST API OKX: /trade/fills - 3 дня, /trade/fills-history - 3 месяца.
+OKX_RECENT_FILLS_DEPTH = timedelta(days=3)
+OKX_FILLS_HISTORY_DEPTH = timedelta(days=90)
+OKX_FILLS_WINDOW = timedelta(days=7)
+
 class OKXClient(BaseApiClient):
     """Клиент для работы с OKX API v5."""
     def __init__(self, api_key, api_secret, passphrase):
@@ -656,6 +983,7 @@ class OKXClient(BaseApiClient):
 
     def _request(self, method, path, params=None, data=None):
         """Выполняет подписанный запрос к OKX."""
+        rate_limiter.acquire('okx', path)
         timestamp = datetime.utcnow().isoformat()[:-3] + 'Z'
         
         request_path = path
@@ -678,7 +1006,7 @@ class OKXClient(BaseApiClient):
         }
         
         url = f"{self.base_url}{path}"
-        response_data = _make_request(method, url, headers=headers, params=params, data=body_str)
+        response_data = _make_request(method, url, headers=headers, params=params, data=body_str, exchange='okx', rate_limit_acquired=True)
         
         if response_data.get('code') != '0':
             raise Exception(f"Ошибка API OKX для {path}: {response_data.get('msg')}")
@@ -689,73 +1017,102 @@ class OKXClient(BaseApiClient):
         return self._request('GET', path, params)
 
     def get_account_assets(self):
-        """Получает балансы активов с OKX, включая Trading, Funding и Financial (Earn)."""
-        assets_map = {}
-        try:
+        """Получает балансы активов с OKX, включая Trading, Funding и Financial (Earn) (параллельно)."""
+        def _trading():
             trading_data = self._get('/api/v5/account/balance')
-            if trading_data:
-                for asset_data in trading_data[0].get('details', []):
-                    quantity = float(asset_data.get('cashBal', 0))
-                    if quantity > 1e-9:
-                        assets_map[(asset_data['ccy'], 'Trading')] = assets_map.get((asset_data['ccy'], 'Trading'), 0.0) + quantity
-        except Exception as e:
-            current_app.logger.error(f"Исключение при получении баланса OKX Trading Account: {e}")
-        try:
-            funding_data = self._get('/api/v5/asset/balances')
-            if funding_data:
-                for asset_data in funding_data:
-                    quantity = float(asset_data.get('bal', 0))
-                    if quantity > 1e-9:
-                        assets_map[(asset_data['ccy'], 'Funding')] = assets_map.get((asset_data['ccy'], 'Funding'), 0.0) + quantity
-        except Exception as e:
-            current_app.logger.error(f"Исключение при получении баланса OKX Funding Account: {e}")
-        try:
-            financial_data = self._get('/api/v5/finance/savings/balance')
-            if financial_data:
-                for asset_data in financial_data:
-                    quantity = float(asset_data.get('amt', 0))
-                    if quantity > 1e-9:
-                        assets_map[(asset_data['ccy'], 'Earn')] = assets_map.get((asset_data['ccy'], 'Earn'), 0.0) + quantity
-        except Exception as e:
-            current_app.logger.error(f"Исключение при получении баланса OKX Financial Account: {e}")
-        return [{'ticker': t, 'quantity': str(q), 'account_type': at} for (t, at), q in assets_map.items()]
+            return [(a['ccy'], _to_decimal(a.get('cashBal'))) for a in trading_data[0].get('details', [])] if trading_data else []
 
-    def _fetch_paginated_data(self, endpoint, id_key, start_ts_ms, end_ts_ms, params=None):
-        all_records = []
-        last_id = None
-        if params is None: params = {}
-        if endpoint in ['/api/v5/asset/deposit-history', '/api/v5/asset/withdrawal-history']:
-            if start_ts_ms: params['begin'] = start_ts_ms
-            if end_ts_ms: params['end'] = end_ts_ms
+        def _funding():
+            return [(a['ccy'], _to_decimal(a.get('bal'))) for a in self._get('/api/v5/asset/balances') or []]
+
+        def _financial():
+            return [(a['ccy'], _to_decimal(a.get('amt'))) for a in self._get('/api/v5/finance/savings/balance') or []]
+
+        return _fetch_wallets_concurrently('OKX', [
+            ("Trading Account", 'Trading', _trading),
+            ("Funding Account", 'Funding', _funding),
+            ("Financial Account", 'Earn', _financial),
+        ])
+
+    def iter_paginated_pages(self, endpoint, id_key, start_ts_ms, end_ts_ms, params=None):
+        """
+        Постранично выдает записи эндпоинта в границах [start_ts_ms, end_ts_ms], которые OKX
+        применяет на сервере (`begin`/`end`). Пагинация назад по `after`: для депозитов и выводов
+        это время записи (`ts`), для сделок - `billId`.
+        """
+        params = dict(params or {})
+        params['limit'] = 100
+        if start_ts_ms: params['begin'] = start_ts_ms
+        if end_ts_ms: params['end'] = end_ts_ms
         while True:
-            if last_id: params['after'] = last_id
             records = self._get(endpoint, params)
-            if not records: break
-            all_records.extend(records)
-            if len(records) < 100: break
-            last_id = records[-1][id_key]
-            time.sleep(0.2)
-        return all_records
+            if not records: return
+            yield records
+            if len(records) < params['limit']: return
+            params['after'] = records[-1][id_key]
+
+    def _fetch_paginated_data(self, endpoint, id_key, start_ts_ms, end_ts_ms, params=None):
+        return [record for records in self.iter_paginated_pages(endpoint, id_key, start_ts_ms, end_ts_ms, params) for record in records]
+
+    def _fetch_fills_window(self, window) -> list:
+        """Загружает сделки за одно окно: последние 3 дня - из /trade/fills, более ранние - из /trade/fills-history."""
+        window_start, window_end = window
+        endpoint = '/api/v5/trade/fills' if window_start >= datetime.now(timezone.utc) - OKX_RECENT_FILLS_DEPTH else '/api/v5/trade/fills-history'
+        return self._fetch_paginated_data(endpoint, 'billId', int(window_start.timestamp() * 1000), int(window_end.timestamp() * 1000), params={'instType': 'SPOT'})
+
+    def iter_fills_pages(self, start_time_dt, end_time_dt):
+        """
+        Постранично выдает спотовые сделки окнами от старых к новым (конец окна - водяной знак).
+        Окна загружаются параллельно; REST API хранит сделки только за 3 месяца, более ранний
+        период доступен лишь выгрузкой архива файлом, поэтому он пропускается с предупреждением.
+        """
+        end_time = end_time_dt or datetime.now(timezone.utc)
+        retention_start = datetime.now(timezone.utc) - OKX_FILLS_HISTORY_DEPTH
+        start_time = start_time_dt or retention_start
+        if start_time < retention_start:
+            current_app.logger.warning(f"--- [OKX Trades] Сделки ранее {retention_start.strftime('%Y-%m-%d')} недоступны через REST API (только архивная выгрузка), период пропущен.")
+            start_time = retention_start
+
+        windows = _time_windows(start_time, end_time, OKX_FILLS_WINDOW)
+        for (_, window_end), records in zip(windows, _iter_ordered_parallel(self._fetch_fills_window, windows, max_workers=2)):
+            yield records, window_end
+        if not windows:
+            yield [], end_time
+
+    def stream_transaction_pages(self, start_time_dt, end_time_dt, start_times=None):
+        """
+        Потоково выдает историю транзакций OKX страницами HistoryPage.
+        Депозиты, выводы и сделки загружаются параллельно, границы периода применяются на сервере,
+        поэтому инкрементальная синхронизация загружает только записи после водяного знака.
+        """
+        end_time = end_time_dt or datetime.now(timezone.utc)
+        end_ts_ms = int(end_time.timestamp() * 1000)
+        start_times = start_times or {}
+
+        def _start_ts_ms(category):
+            start_time = start_times.get(category, start_time_dt)
+            return int(start_time.timestamp() * 1000) if start_time else None
+
+        def _iter_pages(category, endpoint, id_key, params=None):
+            for records in self.iter_paginated_pages(endpoint, id_key, _start_ts_ms(category), end_ts_ms, params):
+                yield records, None
+            yield [], end_time
+
+        return _stream_endpoints_concurrently('OKX', {
+            'deposits': ("историю депозитов", lambda: _iter_pages('deposits', '/api/v5/asset/deposit-history', 'ts')),
+            'withdrawals': ("историю выводов", lambda: _iter_pages('withdrawals', '/api/v5/asset/withdrawal-history', 'ts')),
+            'trades': ("историю сделок", lambda: self.iter_fills_pages(start_times.get('trades', start_time_dt), end_time)),
+        })
 
     def get_all_transactions(self, start_time_dt, end_time_dt):
-        start_ts_ms = int(start_time_dt.timestamp() * 1000) if start_time_dt else None
-        end_ts_ms = int(end_time_dt.timestamp() * 1000) if end_time_dt else None
-        all_txs = {'deposits': [], 'withdrawals': [], 'trades': []}
-        try: all_txs['deposits'] = self._fetch_paginated_data('/api/v5/asset/deposit-history', 'depId', start_ts_ms, end_ts_ms)
-        except Exception as e: current_app.logger.error(f"Не удалось получить историю депозитов OKX: {e}")
-        try: all_txs['withdrawals'] = self._fetch_paginated_data('/api/v5/asset/withdrawal-history', 'wdId', start_ts_ms, end_ts_ms)
-        except Exception as e: current_app.logger.error(f"Не удалось получить историю выводов OKX: {e}")
-        try:
-            all_trades_raw = self._fetch_paginated_data('/api/v5/trade/fills-history', 'tradeId', start_ts_ms, end_ts_ms, params={'instType': 'SPOT'})
-            all_txs['trades'] = [t for t in all_trades_raw if (not start_ts_ms or int(t.get('ts', 0)) >= start_ts_ms) and (not end_ts_ms or int(t.get('ts', 0)) <= end_ts_ms)]
-        except Exception as e: current_app.logger.error(f"Не удалось получить историю сделок OKX: {e}")
+        all_txs = _collect_history_pages(self.stream_transaction_pages(start_time_dt, end_time_dt))
         current_app.logger.info(f"--- [OKX History] Найдено: {len(all_txs['deposits'])} депозитов, {len(all_txs['withdrawals'])} выводов, {len(all_txs['trades'])} сделок.")
         return all_txs
 
 def fetch_bybit_deposit_history(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None) -> list:
     """Получает всю историю депозитов (зачислений) с Bybit."""
     current_app.logger.info(f"Получение истории депозитов с Bybit с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     all_deposits = client._fetch_paginated_history('/v5/asset/deposit/query-record', start_time_dt, end_time_dt)
     unique_deposits = list({d['txID']: d for d in all_deposits}.values())
     current_app.logger.info(f"--- [Bybit Deposits] Всего найдено {len(all_deposits)} депозитов, уникальных: {len(unique_deposits)}.")
@@ -764,7 +1121,7 @@ def fetch_bybit_deposit_history(api_key: str, api_secret: str, passphrase: str =
 def fetch_bybit_internal_deposit_history(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None) -> list:
     """Получает всю историю внутренних депозитов (зачислений от других пользователей Bybit)."""
     current_app.logger.info(f"Получение истории внутренних депозитов с Bybit с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     all_deposits = client._fetch_paginated_history('/v5/asset/deposit/query-internal-record', start_time_dt, end_time_dt)
     unique_deposits = list({d['id']: d for d in all_deposits}.values())
     current_app.logger.info(f"--- [Bybit Internal Deposits] Всего найдено {len(all_deposits)} внутренних депозитов, уникальных: {len(unique_deposits)}.")
@@ -773,7 +1130,7 @@ def fetch_bybit_internal_deposit_history(api_key: str, api_secret: str, passphra
 def fetch_bybit_trade_history(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None) -> list: # Renamed from fetch_bybit_withdrawal_history
     """Получает всю историю спотовых сделок (покупок/продаж) с Bybit."""
     current_app.logger.info(f"Получение истории спотовых сделок с Bybit с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     # ИСПРАВЛЕНО: Передаем обязательный параметр 'category' для получения спотовых сделок.
     all_trades = client._fetch_paginated_history('/v5/execution/list', start_time_dt, end_time_dt, extra_params={'category': 'spot'})
     # Используем execId как уникальный идентификатор для сделок
@@ -784,7 +1141,7 @@ def fetch_bybit_trade_history(api_key: str, api_secret: str, passphrase: str = N
 def fetch_bybit_withdrawal_history(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None) -> list:
     """Получает всю историю выводов средств с Bybit."""
     current_app.logger.info(f"Получение истории выводов с Bybit с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     all_withdrawals = client._fetch_paginated_history('/v5/asset/withdraw/query-record', start_time_dt, end_time_dt)
     unique_withdrawals = list({w['txID']: w for w in all_withdrawals}.values())
     current_app.logger.info(f"--- [Bybit Withdrawals] Всего найдено {len(all_withdrawals)} выводов, уникальных: {len(unique_withdrawals)}.")
@@ -793,50 +1150,45 @@ def fetch_bybit_withdrawal_history(api_key: str, api_secret: str, passphrase: st
 def fetch_bybit_transfer_history(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None) -> list:
     """Получает историю внутренних переводов с Bybit."""
     current_app.logger.info(f"Получение истории переводов с Bybit с ключом: {api_key[:5]}...")
-    client = BybitClient(api_key, api_secret)
+    client = BybitClient.for_credentials(api_key, api_secret)
     all_transfers = client._fetch_paginated_history('/v5/asset/transfer/query-inter-transfer-list', start_time_dt, end_time_dt)
     # Удаляем дубликаты на случай пересечения временных рамок или особенностей API
     unique_transfers = list({t['transferId']: t for t in all_transfers}.values())
     current_app.logger.info(f"--- [Bybit History] Всего найдено {len(all_transfers)} транзакций, уникальных: {len(unique_transfers)}.")
     return unique_transfers
 
+# {категория: (описание для лога, эндпоинт, дополнительные параметры)}
+BYBIT_HISTORY_ENDPOINTS = {
+    'transfers': ("историю переводов", '/v5/asset/transfer/query-inter-transfer-list', None),
+    'deposits': ("историю депозитов", '/v5/asset/deposit/query-record', None), # Внешние депозиты (on-chain)
+    'internal_deposits': ("историю внутренних депозитов", '/v5/asset/deposit/query-internal-record', None), # От других пользователей Bybit
+    'withdrawals': ("историю выводов", '/v5/asset/withdraw/query-record', None),
+    'trades': ("историю сделок", '/v5/execution/list', {'category': 'spot'}),
+}
+
+def stream_bybit_transaction_pages(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None, start_times: dict = None):
+    """
+    Потоково выдает историю транзакций Bybit страницами HistoryPage.
+    `start_times` - необязательное начало периода для отдельных категорий (продолжение прерванной загрузки).
+    """
+    start_times = start_times or {}
+    client = BybitClient.for_credentials(api_key, api_secret)
+
+    def _task(category, endpoint, extra_params):
+        return lambda: client.iter_history_pages(endpoint, start_times.get(category, start_time_dt), end_time_dt, extra_params)
+
+    return _stream_endpoints_concurrently('Bybit', {
+        category: (description, _task(category, endpoint, extra_params))
+        for category, (description, endpoint, extra_params) in BYBIT_HISTORY_ENDPOINTS.items()
+    })
+
 def fetch_bybit_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
     """
     Агрегатор для получения всех типов транзакций с Bybit (переводы, депозиты).
     Возвращает словарь, где ключи - типы транзакций.
     """
-    all_txs = {
-        'transfers': [],
-        'deposits': [], # Внешние депозиты (on-chain)
-        'internal_deposits': [], # Внутренние депозиты (от других пользователей Bybit)
-        'withdrawals': [], # Выводы средств
-        'trades': [] # Новое поле для сделок
-    }
-    try:
-        all_txs['transfers'] = fetch_bybit_transfer_history(api_key, api_secret, passphrase, start_time_dt, end_time_dt)
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю переводов Bybit: {e}")
-    try:
-        all_txs['deposits'] = fetch_bybit_deposit_history(api_key, api_secret, passphrase, start_time_dt, end_time_dt)
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю депозитов Bybit: {e}")
-    try:
-        all_txs['internal_deposits'] = fetch_bybit_internal_deposit_history(api_key, api_secret, passphrase, start_time_dt, end_time_dt)
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю внутренних депозитов Bybit: {e}")
-        current_app.logger.error(f"--- [ERROR] Failed to fetch Bybit internal deposit history: {e}")
-    try:
-        all_txs['withdrawals'] = fetch_bybit_withdrawal_history(api_key, api_secret, passphrase, start_time_dt, end_time_dt) # Correctly call and assign
-    except Exception as e:
-        current_app.logger.error(f"--- [ERROR] Failed to fetch Bybit withdrawal history: {e}")
-        current_app.logger.error(f"Не удалось получить историю выводов Bybit: {e}")
-    try:
-        all_txs['trades'] = fetch_bybit_trade_history(api_key, api_secret, passphrase, start_time_dt, end_time_dt) # Вызываем новую функцию
-    except Exception as e:
-        current_app.logger.error(f"--- [ERROR] Failed to fetch Bybit trade history: {e}")
-        current_app.logger.error(f"Не удалось получить историю сделок Bybit: {e}")
- 
-    return all_txs
+    return _collect_history_pages(stream_bybit_transaction_pages(api_key, api_secret, passphrase, start_time_dt, end_time_dt, platform))
+
 def fetch_bitget_account_assets(api_key: str, api_secret: str, passphrase: str = None) -> list:
     """Получает балансы активов с Bitget, включая Spot и Earn."""
     current_app.logger.info(f"Получение реальных балансов с Bitget (прямой API, включая Spot и Earn) с ключом: {api_key[:5]}...")
@@ -844,151 +1196,100 @@ def fetch_bitget_account_assets(api_key: str, api_secret: str, passphrase: str =
         raise Exception("Для Bitget необходимы API ключ, секрет и парольная фраза.") # noqa
 
 
-    assets_map = {}
+    def _wallet(endpoint, quantity_fields):
+        def _collect():
+            response_data = _bitget_api_get(api_key, api_secret, passphrase, endpoint)
+            if response_data is None:
+                raise Exception(f"Запрос {endpoint} не выполнен.")
+            return [(a['coin'], sum((_to_decimal(a.get(field)) for field in quantity_fields), Decimal('0'))) for a in response_data.get('data', [])]
+        return _collect
 
-    # 1. Получаем баланс Spot Account
-    current_app.logger.info("\n--- [Bitget] Попытка получить баланс Spot Account ---")
-    spot_data = _bitget_api_get(api_key, api_secret, passphrase, '/api/v2/spot/account/assets')
-    if spot_data:
-        for asset_data in spot_data.get('data', []):
-            quantity = float(asset_data.get('available', 0)) + float(asset_data.get('frozen', 0))
-            if quantity > 1e-9:
-                key = (asset_data['coin'], 'Spot')
-                assets_map[key] = assets_map.get(key, 0.0) + quantity
-
-    # 2. Получаем баланс Earn Account
-    current_app.logger.info("\n--- [Bitget] Попытка получить баланс Earn Account ---")
-    earn_data = _bitget_api_get(api_key, api_secret, passphrase, '/api/v2/earn/account/assets')
-    if earn_data:
-        for asset_data in earn_data.get('data', []):
-            quantity = float(asset_data.get('amount', 0))
-            if quantity > 1e-9:
-                key = (asset_data['coin'], 'Earn')
-                assets_map[key] = assets_map.get(key, 0.0) + quantity
+    # Spot и Earn запрашиваются параллельно
+    return _fetch_wallets_concurrently('Bitget', [
+        ("Spot Account", 'Spot', _wallet('/api/v2/spot/account/assets', ('available', 'frozen'))),
+        ("Earn Account", 'Earn', _wallet('/api/v2/earn/account/assets', ('amount',))),
+    ])
 
-    all_assets = []
-    for (ticker, account_type), quantity in assets_map.items():
-        all_assets.append({'ticker': ticker, 'quantity': str(quantity), 'account_type': account_type})
-    return all_assets
-def fetch_bitget_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
+# Максимальная длина периода startTime..endTime в эндпоинтах истории Bitget
+BITGET_HISTORY_WINDOW = timedelta(days=90)
+
+def stream_bitget_transaction_pages(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None, start_times: dict = None):
     """
-    Агрегатор для получения всех типов транзакций с Bitget (депозиты, выводы, сделки).
+    Потоково выдает историю транзакций Bitget (депозиты, выводы, переводы, сделки) страницами HistoryPage.
     """
     current_app.logger.info(f"Получение истории транзакций с Bitget с ключом: {api_key[:5]}...")
     if not api_key or not api_secret or not passphrase:
         raise Exception("Для Bitget необходимы API ключ, секрет и парольная фраза.")
 
-    start_ts_ms = int(start_time_dt.timestamp() * 1000) if start_time_dt else None
-    end_ts_ms = int(end_time_dt.timestamp() * 1000) if end_time_dt else None
+    end_time = end_time_dt or datetime.now(timezone.utc)
+    start_times = start_times or {}
 
-    def _fetch_paginated_data_with_time(endpoint, id_key_for_record, pagination_param_name, base_params=None):
-        """Общая функция для получения данных с пагинацией Bitget."""
-        all_records = []
-        last_id = None
-        
-        current_params = base_params.copy() if base_params else {}
-        # Устанавливаем временные рамки для первого запроса
-        if start_ts_ms:
-            current_params['startTime'] = start_ts_ms
-        if end_ts_ms:
-            current_params['endTime'] = end_ts_ms
-
-        stop_fetching = False
-        while not stop_fetching:
-            current_params['limit'] = 100
-
-            if last_id:
-                current_params[pagination_param_name] = last_id
+    def _iter_pages(category, endpoint, id_key_for_record, pagination_param_name, base_params=None):
+        """Пагинация Bitget: окна по времени от старых к новым, внутри окна - назад по ID."""
+        start_time = start_times.get(category, start_time_dt) or (end_time - timedelta(days=2*365))
+        for window_start, window_end in _time_windows(start_time, end_time, BITGET_HISTORY_WINDOW):
+            start_ts_ms = int(window_start.timestamp() * 1000)
+            current_params = dict(base_params or {}, startTime=start_ts_ms, endTime=int(window_end.timestamp() * 1000), limit=100)
+            while True:
+                response_data = _bitget_api_get(api_key, api_secret, passphrase, endpoint, current_params)
+                if response_data is None:
+                    raise Exception(f"Запрос {endpoint} не выполнен.")
+                data_content = response_data.get('data') or []
+                records = data_content if isinstance(data_content, list) else []
+
+                page = [record for record in records if int(record.get('cTime', 0)) >= start_ts_ms]
+                if len(page) < len(records) or len(records) < 100:
+                    yield page, window_end
+                    break
+                yield page, None
+
+                current_params[pagination_param_name] = records[-1].get(id_key_for_record)
                 # Удаляем временные параметры для последующих страниц, так как Bitget их игнорирует при наличии idLessThan
                 current_params.pop('startTime', None)
                 current_params.pop('endTime', None)
-            
-            response_data = _bitget_api_get(api_key, api_secret, passphrase, endpoint, current_params)
-            if not response_data or not response_data.get('data'):
-                break
-            
-            # ИЗМЕНЕНО: Корректная обработка разной структуры ответа API.
-            # Для сделок данные лежат в data['fills'], для остального - просто в data.
-            data_content = response_data['data']
-            records = []
-            if endpoint == '/openApi/spot/v1/trade/myTrades':
-                records = data_content.get('fills', [])
-            elif isinstance(data_content, list):
-                records = data_content
-            
-            if not records:
-                break # Выходим, если данных нет
-            for record in records:
-                record_ts = int(record.get('cTime', 0))
-                if start_ts_ms and record_ts < start_ts_ms:
-                    stop_fetching = True
-                    break
-                all_records.append(record)
 
-            if stop_fetching or len(records) < 100:
-                break
-            
-            last_id = records[-1].get(id_key_for_record)
-            time.sleep(0.2)
-        return all_records
-
-    all_txs = {
-        'deposits': [],
-        'withdrawals': [],
-        'trades': [],
-        'transfers': []
-    }
-    
-    # --- Deposits ---
-    try:
-        current_app.logger.info("\n--- [Bitget] Получение истории депозитов ---")
-        all_txs['deposits'] = _fetch_paginated_data_with_time('/api/v2/spot/wallet/deposit-records', 'id', 'idLessThan')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю депозитов Bitget: {e}")
-        
-    # --- Withdrawals ---
-    try:
-        current_app.logger.info("\n--- [Bitget] Получение истории выводов ---")
-        all_txs['withdrawals'] = _fetch_paginated_data_with_time('/api/v2/spot/wallet/withdrawal-records', 'withdrawId', 'idLessThan')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю выводов Bitget: {e}")
-        
-    # --- Transfers ---
-    try:
-        current_app.logger.info("\n--- [Bitget] Получение истории переводов ---")
-        all_txs['transfers'] = _fetch_paginated_data_with_time('/api/v2/asset/transfer-records', 'id', 'idLessThan')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю переводов Bitget: {e}")
-        
-    # --- Trades ---
-    try:
-        current_app.logger.info("\n--- [Bitget] Получение истории сделок (используя /api/v2/spot/trade/fills) ---")
-        all_txs['trades'] = _fetch_paginated_data_with_time('/api/v2/spot/trade/fills', 'tradeId', 'idLessThan')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю сделок Bitget: {e}")
-    
+    return _stream_endpoints_concurrently('Bitget', {
+        'deposits': ("историю депозитов", lambda: _iter_pages('deposits', '/api/v2/spot/wallet/deposit-records', 'id', 'idLessThan')),
+        'withdrawals': ("историю выводов", lambda: _iter_pages('withdrawals', '/api/v2/spot/wallet/withdrawal-records', 'withdrawId', 'idLessThan')),
+        'transfers': ("историю переводов", lambda: _iter_pages('transfers', '/api/v2/asset/transfer-records', 'id', 'idLessThan')),
+        'trades': ("историю сделок", lambda: _iter_pages('trades', '/api/v2/spot/trade/fills', 'tradeId', 'idLessThan')),
+    })
+
+def fetch_bitget_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
+    """
+    Агрегатор для получения всех типов транзакций с Bitget (депозиты, выводы, сделки).
+    """
+    all_txs = _collect_history_pages(stream_bitget_transaction_pages(api_key, api_secret, passphrase, start_time_dt, end_time_dt, platform))
     current_app.logger.info(f"--- [Bitget History] Найдено: {len(all_txs['deposits'])} депозитов, {len(all_txs['withdrawals'])} выводов, {len(all_txs['trades'])} сделок, {len(all_txs['transfers'])} переводов.")
     return all_txs
 
-def fetch_bingx_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict: # noqa
+# Длина окна истории сделок BingX: сделки всех пар окна загружаются до выдачи его водяного знака
+BINGX_TRADES_WINDOW = timedelta(days=90)
+
+def stream_bingx_transaction_pages(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None, start_times: dict = None): # noqa
     """
-    Агрегатор для получения всех типов транзакций с BingX (депозиты, выводы, сделки).
-    ОПТИМИЗИРОВАНО: Запрашивает историю сделок только для тех пар, которые есть у пользователя.
+    Потоково выдает историю транзакций BingX (депозиты, выводы, сделки) страницами HistoryPage.
+    ОПТИМИЗИРОВАНО: Запрашивает историю сделок только для пар из тикеров пользователя, которые есть
+    в каталоге пар BingX, и для пар, по которым уже были сделки.
     """
     current_app.logger.info(f"Получение истории транзакций с BingX (оптимизированный режим) с ключом: {api_key[:5]}...")
     if not api_key or not api_secret:
         raise Exception("Для BingX необходимы API ключ и секрет.")
 
-    start_ts_ms = int(start_time_dt.timestamp() * 1000) if start_time_dt else None
-    end_ts_ms = int(end_time_dt.timestamp() * 1000) if end_time_dt else None
+    end_time = end_time_dt or datetime.now(timezone.utc)
+    end_ts_ms = int(end_time.timestamp() * 1000)
+    start_times = start_times or {}
 
-    def _fetch_bingx_paginated_data(endpoint, start_time=None, end_time=None, extra_params=None):
+    def _start_ts_ms(category):
+        start_time = start_times.get(category, start_time_dt)
+        return int(start_time.timestamp() * 1000) if start_time else None
+
+    def _iter_bingx_pages(endpoint, start_time=None, end_time=None, extra_params=None, raise_errors=False):
         """
-        УПРОЩЕНО: Функция для получения данных с BingX.
-        Для сделок ('myTrades') используется пагинация по 'fromId'.
+        УПРОЩЕНО: Постраничное получение данных с BingX.
+        Для сделок ('fills') используется пагинация по 'fromId'.
         Для депозитов/выводов пагинация по времени не требуется, так как API возвращает все за 90 дней.
         """
-        all_records = []
         last_id = None
         while True:
             params = {'limit': 1000}
@@ -997,10 +1298,10 @@ def fetch_bingx_all_transactions(api_key: str, api_secret: str, passphrase: str
             if extra_params: params.update(extra_params)
             if last_id: params['fromId'] = last_id
 
-            response_data = _bingx_api_get(api_key, api_secret, endpoint, params)
+            response_data = _bingx_api_get(api_key, api_secret, endpoint, params, raise_errors=raise_errors)
             if not response_data or not response_data.get('data'):
-                break
-            
+                return
+
             # ИЗМЕНЕНО: Корректная обработка разной структуры ответа API.
             # Для сделок данные лежат в data['fills'], для остального - просто в data.
             data_content = response_data['data']
@@ -1009,43 +1310,30 @@ def fetch_bingx_all_transactions(api_key: str, api_secret: str, passphrase: str
                 records = data_content.get('fills', [])
             elif isinstance(data_content, list):
                 records = data_content
-            
-            if not records:
-                break # Выходим, если данных нет
-
-            all_records.extend(records)
-            
-            # Пагинация по ID поддерживается только для myTrades
-            if endpoint == '/openApi/spot/v1/fills':
-                if len(records) < params['limit']:
-                    break
-                last_id = records[-1].get('id') if records else None
-                if not last_id: break
-            else:
-                # Для других эндпоинтов выходим после первого запроса
-                break
-            
-            time.sleep(0.3) # Пауза между страницами
-
-        return all_records
-
-    all_txs = {'deposits': [], 'withdrawals': [], 'trades': []}
-    try:
-        current_app.logger.info("\n--- [BingX] Получение истории депозитов ---")
-        all_txs['deposits'] = _fetch_bingx_paginated_data('/openApi/wallets/v1/capital/deposit/history', start_time=start_ts_ms, end_time=end_ts_ms)
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю депозитов BingX: {e}")
-    try:
-        current_app.logger.info("\n--- [BingX] Получение истории выводов ---")
-        all_txs['withdrawals'] = _fetch_bingx_paginated_data('/openApi/wallets/v1/capital/withdraw/history', start_time=start_ts_ms, end_time=end_ts_ms)
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю выводов BingX: {e}")
-    try:
-        # --- ИЗМЕНЕНО: Оптимизация получения истории сделок ---
-        current_app.logger.info("\n--- [BingX] Получение истории сделок (оптимизированный режим) ---")
-        if not platform:
-            raise ValueError("Для оптимизированной синхронизации сделок BingX требуется объект платформы.")
 
+            if not records:
+                return # Выходим, если данных нет
+            yield records
+
+            # Пагинация по ID поддерживается только для сделок; для других эндпоинтов выходим после первого запроса
+            if endpoint != '/openApi/spot/v1/fills' or len(records) < params['limit']:
+                return
+            last_id = records[-1].get('id')
+            if not last_id:
+                return
+
+    def _iter_wallet_pages(category, endpoint):
+        for records in _iter_bingx_pages(endpoint, start_time=_start_ts_ms(category), end_time=end_ts_ms, raise_errors=True):
+            yield records, None
+        yield [], end_time
+
+    # --- ИЗМЕНЕНО: Оптимизация получения истории сделок ---
+    # Список пар собирается из БД до запуска параллельных запросов: объект платформы
+    # привязан к сессии текущего потока и не должен использоваться в воркерах.
+    symbols_to_check = set()
+    if not platform:
+        current_app.logger.error("Не удалось получить историю сделок BingX: для оптимизированной синхронизации сделок BingX требуется объект платформы.")
+    else:
         # --- ИЗМЕНЕНО: Более надежный способ сбора всех когда-либо использовавшихся тикеров ---
         # 1. Получаем тикеры из текущих/прошлых активов (даже с нулевым балансом)
         asset_tickers = {asset.ticker for asset in platform.assets}
@@ -1055,54 +1343,77 @@ def fetch_bingx_all_transactions(api_key: str, api_secret: str, passphrase: str
         tx_tickers_asset1 = {r[0] for r in db.session.query(Transaction.asset1_ticker).filter(Transaction.platform_id == platform.id, Transaction.asset1_ticker.isnot(None)).distinct().all()}
         tx_tickers_asset2 = {r[0] for r in db.session.query(Transaction.asset2_ticker).filter(Transaction.platform_id == platform.id, Transaction.asset2_ticker.isnot(None)).distinct().all()}
         current_app.logger.info(f"--- [BingX Trades] Тикеры из существующих транзакций: {tx_tickers_asset1.union(tx_tickers_asset2)}")
-        
+
         # 3. Объединяем все источники для получения полного списка
         user_tickers = asset_tickers.union(tx_tickers_asset1).union(tx_tickers_asset2)
         current_app.logger.info(f"--- [BingX Trades] Итоговый список тикеров для проверки: {user_tickers}")
-        if not user_tickers:
+
+        # ИЗМЕНЕНО: Генерируем только валидные торговые пары, где вторая валюта - одна из основных.
+        quote_currencies = ['USDT', 'USDC', 'BTC', 'ETH']
+        candidate_symbols = set()
+        for ticker in user_tickers:
+            for quote in quote_currencies:
+                # ИЗМЕНЕНО: Правильная проверка, чтобы избежать только идентичных пар (например, USDT-USDT),
+                # но разрешить пары, где базовый актив - одна из основных валют (например, ETH-USDT).
+                if ticker == quote: continue
+                candidate_symbols.add(f"{ticker}-{quote}")
+
+        # 4. Оставляем только пары, которые реально существуют на BingX (по каталогу пар).
+        # Без каталога проверяются все сочетания, как раньше.
+        catalogue = get_bingx_symbol_catalogue()
+        symbols_to_check = candidate_symbols & catalogue if catalogue is not None else candidate_symbols
+
+        # 5. Пары, по которым уже были сделки, проверяются всегда (даже если пара пропала из каталога)
+        traded_pairs = db.session.query(Transaction.asset1_ticker, Transaction.asset2_ticker).filter(
+            Transaction.platform_id == platform.id, Transaction.exchange_tx_id.like('bingx_trade_%')
+        ).distinct().all()
+        symbols_to_check |= {f"{base}-{quote}" for base, quote in traded_pairs if base and quote}
+        current_app.logger.info(f"--- [BingX Trades] Пар к проверке: {len(symbols_to_check)} из {len(candidate_symbols)} возможных сочетаний.")
+
+    def _iter_trade_pages():
+        if not symbols_to_check:
             current_app.logger.info("--- [BingX Trades] У пользователя нет активов или транзакций на этой платформе, история сделок не запрашивается.")
-            all_txs['trades'] = []
-        else:
-            # ИЗМЕНЕНО: Генерируем только валидные торговые пары, где вторая валюта - одна из основных.
-            quote_currencies = ['USDT', 'USDC', 'BTC', 'ETH']
-            symbols_to_check = set()
-            for ticker in user_tickers:
-                for quote in quote_currencies:
-                    # ИЗМЕНЕНО: Правильная проверка, чтобы избежать только идентичных пар (например, USDT-USDT),
-                    # но разрешить пары, где базовый актив - одна из основных валют (например, ETH-USDT).
-                    if ticker == quote: continue
-                    symbols_to_check.add(f"{ticker}-{quote}")
-            current_app.logger.info(f"--- [BingX Trades] Будут проверены следующие пары: {symbols_to_check}")
-
-            all_trades = []
-            app = current_app._get_current_object()
-            
-            def _fetch_trades_for_symbol_worker(symbol):
-                with app.app_context():
-                    return _fetch_bingx_paginated_data('/openApi/spot/v1/fills', start_time=start_ts_ms, end_time=end_ts_ms, extra_params={'symbol': symbol})
-
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                future_to_symbol = {}
-                for symbol in symbols_to_check:
-                    future = executor.submit(_fetch_trades_for_symbol_worker, symbol)
-                    future_to_symbol[future] = symbol
-                    time.sleep(0.3) # ИЗМЕНЕНО: Добавляем задержку 300мс между запросами, чтобы избежать rate limit.
-                
-                for future in as_completed(future_to_symbol):
-                    symbol = future_to_symbol[future]
-                    try:
-                        trades_for_symbol = future.result()
-                        if trades_for_symbol:
-                            current_app.logger.info(f"--- [BingX Trades] Найдено {len(trades_for_symbol)} сделок для пары {symbol}.")
-                            all_trades.extend(trades_for_symbol)
-                    except Exception as exc:
-                        if 'symbol is invalid' not in str(exc):
-                             current_app.logger.error(f'--- [BingX Worker] Ошибка при загрузке сделок для {symbol}: {exc}')
-            
-            all_txs['trades'] = all_trades
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю сделок BingX: {e}", exc_info=True)
+            yield [], end_time
+            return
+        current_app.logger.info(f"--- [BingX Trades] Будут проверены следующие пары: {symbols_to_check}")
+        trades_start = start_times.get('trades', start_time_dt) or (end_time - timedelta(days=2*365))
+
+        def _fetch_trades_for_symbol(symbol, window_start_ms, window_end_ms):
+            # Любая ошибка, кроме явного "symbol is invalid" (пара снята с торгов), прерывает эндпоинт,
+            # чтобы водяной знак сделок не сдвинулся поверх незагруженной пары.
+            try:
+                trades = [trade for records in _iter_bingx_pages('/openApi/spot/v1/fills', start_time=window_start_ms, end_time=window_end_ms, extra_params={'symbol': symbol}, raise_errors=True) for trade in records]
+            except BingXApiError as e:
+                if 'symbol' in str(e).lower() and 'invalid' in str(e).lower():
+                    current_app.logger.info(f"--- [BingX Trades] Пара {symbol} недоступна на BingX, пропускаем.")
+                    return []
+                raise
+            if trades:
+                current_app.logger.info(f"--- [BingX Trades] Найдено {len(trades)} сделок для пары {symbol}.")
+            return trades
+
+        # Период обходится окнами от старых к новым: после каждого окна, пройденного по всем парам,
+        # выдается водяной знак, поэтому прерванная первичная загрузка продолжается с последнего окна,
+        # а в памяти одновременно только сделки одной пары за одно окно.
+        for window_start, window_end in _time_windows(trades_start, end_time, BINGX_TRADES_WINDOW):
+            window_start_ms, window_end_ms = int(window_start.timestamp() * 1000), int(window_end.timestamp() * 1000)
+            # Темп запросов ограничивает rate_limiter, поэтому воркеров может быть больше двух.
+            for trades in _iter_ordered_parallel(lambda symbol: _fetch_trades_for_symbol(symbol, window_start_ms, window_end_ms), sorted(symbols_to_check), max_workers=4):
+                if trades:
+                    yield trades, None
+            yield [], window_end
+
+    return _stream_endpoints_concurrently('BingX', {
+        'deposits': ("историю депозитов", lambda: _iter_wallet_pages('deposits', '/openApi/wallets/v1/capital/deposit/history')),
+        'withdrawals': ("историю выводов", lambda: _iter_wallet_pages('withdrawals', '/openApi/wallets/v1/capital/withdraw/history')),
+        'trades': ("историю сделок", _iter_trade_pages),
+    })
 
+def fetch_bingx_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict: # noqa
+    """
+    Агрегатор для получения всех типов транзакций с BingX (депозиты, выводы, сделки).
+    """
+    all_txs = _collect_history_pages(stream_bingx_transaction_pages(api_key, api_secret, passphrase, start_time_dt, end_time_dt, platform))
     current_app.logger.info(f"--- [BingX History] Найдено: {len(all_txs['deposits'])} депозитов, {len(all_txs['withdrawals'])} выводов, {len(all_txs['trades'])} сделок.")
     return all_txs
 
@@ -1111,18 +1422,27 @@ def fetch_okx_account_assets(api_key: str, api_secret: str, passphrase: str = No
     current_app.logger.info(f"Получение реальных балансов с OKX (прямой API) с ключом: {api_key[:5]}...")
     if not api_key or not api_secret or not passphrase:
         raise Exception("Для OKX необходимы API ключ, секрет и парольная фраза.")
-    client = OKXClient(api_key, api_secret, passphrase)
+    client = OKXClient.for_credentials(api_key, api_secret, passphrase)
     return client.get_account_assets()
+def stream_okx_transaction_pages(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None, start_times: dict = None):
+    """Потоково выдает историю транзакций OKX страницами HistoryPage, используя OKXClient."""
+    current_app.logger.info(f"Получение истории транзакций с OKX с ключом: {api_key[:5]}...")
+    if not api_key or not api_secret or not passphrase:
+        raise Exception("Для OKX необходимы API ключ, секрет и парольная фраза.")
+    client = OKXClient.for_credentials(api_key, api_secret, passphrase)
+    return client.stream_transaction_pages(start_time_dt, end_time_dt, start_times)
+
 def fetch_okx_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
     """Получает все транзакции с OKX, используя OKXClient."""
     current_app.logger.info(f"Получение истории транзакций с OKX с ключом: {api_key[:5]}...")
     if not api_key or not api_secret or not passphrase:
         raise Exception("Для OKX необходимы API ключ, секрет и парольная фраза.")
-    client = OKXClient(api_key, api_secret, passphrase)
+    client = OKXClient.for_credentials(api_key, api_secret, passphrase)
     return client.get_all_transactions(start_time_dt, end_time_dt)
 
 def _kucoin_api_get(api_key: str, api_secret: str, passphrase: str, endpoint: str, params: dict = None): # noqa
     """Внутренняя функция для выполнения GET-запросов к KuCoin с подписью."""
+    rate_limiter.acquire('kucoin', endpoint)
     timestamp = _get_timestamp_ms()
     method = 'GET'
     
@@ -1148,7 +1468,7 @@ def _kucoin_api_get(api_key: str, api_secret: str, passphrase: str, endpoint: st
     
     url = f"{KUCOIN_BASE_URL}{endpoint}"
     try:
-        response_data = _make_request(method, url, headers=headers, params=params)
+        response_data = _make_request(method, url, headers=headers, params=params, exchange='kucoin', rate_limit_acquired=True)
         if response_data.get('code') != '200000':
             current_app.logger.warning(f"Предупреждение API KuCoin для {endpoint}: {response_data.get('msg')}")
             return None
@@ -1171,8 +1491,8 @@ def fetch_kucoin_account_assets(api_key: str, api_secret: str, passphrase: str =
     all_accounts_data = _kucoin_api_get(api_key, api_secret, passphrase, '/api/v1/accounts')
     if all_accounts_data and all_accounts_data.get('data'):
         for account in all_accounts_data['data']:
-            quantity = float(account.get('balance', 0))
-            if quantity > 1e-9:
+            quantity = _to_decimal(account.get('balance'))
+            if quantity > MIN_BALANCE:
                 # ИСПРАВЛЕНО: Приводим тип счета к нижнему регистру для совместимости
                 # с ответами v1 ('main') и v2 ('MAIN').
                 account_type_raw = account.get('type', 'unknown').lower()
@@ -1186,162 +1506,174 @@ def fetch_kucoin_account_assets(api_key: str, api_secret: str, passphrase: str =
                 account_type = account_type_map.get(account_type_raw, account_type_raw.capitalize())
                 
                 key = (account['currency'], account_type)
-                assets_map[key] = assets_map.get(key, 0.0) + quantity
+                assets_map[key] = assets_map.get(key, Decimal('0')) + quantity
 
     all_assets = []
     for (ticker, account_type), quantity in assets_map.items():
         all_assets.append({'ticker': ticker, 'quantity': str(quantity), 'account_type': account_type})
     return all_assets
 
-def fetch_kucoin_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
+# Предварительный просмотр журнала счета KuCoin: окна без движений по счету не запрашиваются подробно.
+# Журнал хранится ограниченное время, поэтому более старые окна считаются активными; депозит попадает
+# в журнал только после зачисления, поэтому для депозитов учитывается и активность сразу после окна.
+KUCOIN_HISTORY_WINDOW = timedelta(days=7)
+KUCOIN_LEDGER_RETENTION = timedelta(days=365)
+KUCOIN_DEPOSIT_CREDIT_SLACK = timedelta(days=1)
+
+def stream_kucoin_transaction_pages(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None, start_times: dict = None):
     """
-    Агрегатор для получения всех типов транзакций с KuCoin (депозиты, выводы, сделки).
-    ИСПРАВЛЕНО: Добавлена логика для обхода 24-часового ограничения API KuCoin
-    путем итерации по временному диапазону с шагом в 24 часа.
+    Потоково выдает историю транзакций KuCoin (депозиты, выводы, сделки, переводы) страницами HistoryPage.
+    API KuCoin ограничивает длину периода запроса, поэтому история запрашивается 7-дневными отрезками
+    (параллельно, но выдается по порядку - от старых к новым). Сначала журнал счета просматривается
+    одним запросом на отрезок, и подробные эндпоинты запрашиваются только для отрезков с движениями.
+    Дубликаты на границах отрезков отсекает уникальный ключ exchange_tx_id при записи.
     """
     current_app.logger.info(f"Получение истории транзакций с KuCoin (параллельный режим) с ключом: {api_key[:5]}...") # noqa
     if not api_key or not api_secret or not passphrase:
         raise Exception("Для KuCoin необходимы API ключ, секрет и парольная фраза.")
 
-    # ИСПРАВЛЕНО: Получаем реальный объект приложения, чтобы передать его контекст в другие потоки.
-    app = current_app._get_current_object()
+    loop_end_time = end_time_dt or datetime.now(timezone.utc)
+    start_times = start_times or {}
 
-    def _fetch_single_kucoin_chunk(args):
-        """
-        (Внутренняя функция для ThreadPoolExecutor) Получает все страницы данных для одного временного отрезка.
-        """
-        # ИСПРАВЛЕНО: Создаем контекст приложения, так как эта функция выполняется в отдельном потоке.
-        with app.app_context():
-            endpoint, base_params, chunk_start_time, chunk_end_time = args
-            chunk_records = []
-            current_page = 1
-            while True:
-                params = base_params.copy() if base_params else {}
-                params['currentPage'] = current_page
-                params['pageSize'] = 500
-                params['startAt'] = int(chunk_start_time.timestamp() * 1000)
-                params['endAt'] = int(chunk_end_time.timestamp() * 1000)
-
-                response_data = _kucoin_api_get(api_key, api_secret, passphrase, endpoint, params)
-                if not response_data or not response_data.get('data', {}).get('items'):
-                    break
-                
-                records = response_data['data']['items']
-                chunk_records.extend(records)
-                
-                if len(records) < params['pageSize']:
-                    break
-                
-                current_page += 1
-                time.sleep(0.3) # Задержка для соблюдения rate limit
-            return chunk_records
+    def _category_start(category):
+        return start_times.get(category, start_time_dt) or (loop_end_time - timedelta(days=2*365))
 
-    def _fetch_kucoin_paginated_data_in_chunks(endpoint, base_params=None):
+    def _fetch_single_kucoin_chunk(args):
+        """Получает все страницы данных для одного временного отрезка."""
+        endpoint, base_params, chunk_start_time, chunk_end_time = args
+        chunk_records = []
+        current_page = 1
+        while True:
+            params = base_params.copy() if base_params else {}
+            params['currentPage'] = current_page
+            params['pageSize'] = 500
+            params['startAt'] = int(chunk_start_time.timestamp() * 1000)
+            params['endAt'] = int(chunk_end_time.timestamp() * 1000)
+
+            response_data = _kucoin_api_get(api_key, api_secret, passphrase, endpoint, params)
+            if response_data is None:
+                raise Exception(f"Запрос {endpoint} за {chunk_start_time.strftime('%Y-%m-%d')} не выполнен.")
+            records = response_data.get('data', {}).get('items') or []
+            chunk_records.extend(records)
+
+            if len(records) < params['pageSize']:
+                break
+            current_page += 1
+        return chunk_records
+
+    def _ledger_has_activity(window):
+        """Есть ли в журнале счета записи за отрезок. При ошибке запроса отрезок считается активным."""
+        window_start, window_end = window
+        params = {'currentPage': 1, 'pageSize': 10, 'startAt': int(window_start.timestamp() * 1000), 'endAt': int(window_end.timestamp() * 1000)}
+        response_data = _kucoin_api_get(api_key, api_secret, passphrase, '/api/v1/accounts/ledgers', params)
+        if response_data is None:
+            return True
+        return bool(response_data.get('data', {}).get('items'))
+
+    # Предварительный просмотр журнала за общий период всех категорий
+    ledger_horizon = loop_end_time - KUCOIN_LEDGER_RETENTION
+    scan_start = max(min(_category_start(category) for category in ('deposits', 'withdrawals', 'trades', 'transfers')), ledger_horizon)
+    scan_windows = _time_windows(scan_start, loop_end_time, KUCOIN_HISTORY_WINDOW)
+    active_windows = [window for window, active in zip(scan_windows, _iter_ordered_parallel(_ledger_has_activity, scan_windows, max_workers=4)) if active]
+    current_app.logger.info(f"--- [KuCoin Prescan] Отрезков с движениями по счету: {len(active_windows)} из {len(scan_windows)}.")
+
+    def _has_activity(chunk_start, chunk_end):
+        if chunk_start < ledger_horizon:
+            return True
+        return any(window_start < chunk_end and window_end > chunk_start for window_start, window_end in active_windows)
+
+    def _iter_kucoin_chunk_pages(category, endpoint, base_params=None, slack=timedelta(0)):
         """
-        ОПТИМИЗИРОВАНО: Получает данные с KuCoin, запрашивая 24-часовые отрезки параллельно.
+        ОПТИМИЗИРОВАНО: Запрашивает 7-дневные отрезки с движениями по счету параллельно и выдает
+        их по порядку; пустые отрезки не запрашиваются. Конец отрезка служит водяным знаком.
         """
-        # 1. Генерируем список всех 24-часовых отрезков для запроса
-        time_chunks = []
-        loop_end_time = end_time_dt or datetime.now(timezone.utc)
-        loop_start_time = start_time_dt or (loop_end_time - timedelta(days=2*365))
-        current_chunk_end_time = loop_end_time
-        # ИСПРАВЛЕНО: Увеличиваем размер чанка до 7 дней, так как API KuCoin это позволяет.
-        # Это значительно сократит количество запросов.
-        chunk_delta = timedelta(days=7)
-        while current_chunk_end_time > loop_start_time:
-            current_chunk_start_time = max(loop_start_time, current_chunk_end_time - chunk_delta)
-            time_chunks.append((current_chunk_start_time, current_chunk_end_time))
-            current_chunk_end_time = current_chunk_start_time - timedelta(microseconds=1)
-
-        # 2. Запускаем запросы для всех отрезков параллельно
-        all_records = []
-        # ИСПРАВЛЕНО: Уменьшаем количество параллельных воркеров до 2, чтобы избежать ошибок 429 (Rate Limit).
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            # Подготавливаем аргументы для каждой задачи
-            tasks_args = [(endpoint, base_params, start, end) for start, end in time_chunks]
-            future_to_chunk = {executor.submit(_fetch_single_kucoin_chunk, args): args for args in tasks_args}
-            
-            for i, future in enumerate(as_completed(future_to_chunk)):
-                chunk_args = future_to_chunk[future]
-                try:
-                    chunk_result = future.result()
-                    if chunk_result:
-                        all_records.extend(chunk_result)
-                    current_app.logger.info(f"--- [KuCoin Worker] Чанк {chunk_args[2].strftime('%Y-%m-%d')} для {endpoint} успешно загружен ({i+1}/{len(time_chunks)}).")
-                except Exception as exc:
-                    current_app.logger.error(f'--- [KuCoin Worker] Ошибка при загрузке чанка {chunk_args}: {exc}')
-
-        # 3. Удаляем дубликаты, которые могли появиться на границах отрезков
-        unique_records_dict = {}
-        # ИСПРАВЛЕНО: Обновлен ключ для /api/v1/accounts/ledgers
-        id_key_map = {
-            '/api/v1/deposits': 'walletTxId', 
-            '/api/v1/withdrawals': 'id', 
-            '/api/v1/fills': 'tradeId', 
-            '/api/v1/accounts/ledgers': 'id'
-        }
-        id_key = id_key_map.get(endpoint)
-        if not id_key:
-            current_app.logger.warning(f"Ключ для дедупликации не найден для {endpoint}. Возможны дубликаты.")
-            return all_records
-            
-        for record in all_records:
-            unique_id = record.get(id_key)
-            if unique_id is not None:
-                unique_records_dict[unique_id] = record
-            else:
-                # Резервный вариант для записей без уникального ID
-                unique_records_dict[json.dumps(record, sort_keys=True)] = record
-        return list(unique_records_dict.values())
-
-    all_txs = {'deposits': [], 'withdrawals': [], 'trades': [], 'transfers': []}
-    try:
-        current_app.logger.info("\n--- [KuCoin] Получение истории депозитов ---")
-        all_txs['deposits'] = _fetch_kucoin_paginated_data_in_chunks('/api/v1/deposits')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю депозитов KuCoin: {e}")
-    try:
-        current_app.logger.info("\n--- [KuCoin] Получение истории выводов ---")
-        all_txs['withdrawals'] = _fetch_kucoin_paginated_data_in_chunks('/api/v1/withdrawals')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю выводов KuCoin: {e}")
-    try:
-        current_app.logger.info("\n--- [KuCoin] Получение истории сделок ---")
-        all_txs['trades'] = _fetch_kucoin_paginated_data_in_chunks('/api/v1/fills')
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю сделок KuCoin: {e}")
-    try:
-        current_app.logger.info("\n--- [KuCoin] Получение истории переводов (ledgers) ---")        
+        time_chunks = _time_windows(_category_start(category), loop_end_time, KUCOIN_HISTORY_WINDOW)
+        tasks_args = [(endpoint, base_params, start, end) for start, end in time_chunks]
+        active_flags = [_has_activity(start, end + slack) for start, end in time_chunks]
+        current_app.logger.info(f"--- [KuCoin History] {endpoint}: к загрузке {sum(active_flags)} отрезков из {len(time_chunks)}.")
+
+        def _fetch_chunk_if_active(task):
+            chunk_args, active = task
+            return _fetch_single_kucoin_chunk(chunk_args) if active else []
+
+        # Четыре эндпоинта KuCoin загружаются одновременно, поэтому на каждый достаточно 2 воркеров;
+        # общий темп запросов (с учетом веса эндпоинтов) ограничивает rate_limiter.
+        for chunk_args, chunk_records in zip(tasks_args, _iter_ordered_parallel(_fetch_chunk_if_active, zip(tasks_args, active_flags), max_workers=2)):
+            yield chunk_records, chunk_args[3]
+
+    return _stream_endpoints_concurrently('KuCoin', {
+        'deposits': ("историю депозитов", lambda: _iter_kucoin_chunk_pages('deposits', '/api/v1/deposits', slack=KUCOIN_DEPOSIT_CREDIT_SLACK)),
+        'withdrawals': ("историю выводов", lambda: _iter_kucoin_chunk_pages('withdrawals', '/api/v1/withdrawals')),
+        'trades': ("историю сделок", lambda: _iter_kucoin_chunk_pages('trades', '/api/v1/fills')),
         # Фильтруем по bizType, чтобы получить только переводы. Используем эндпоинт v1.
-        all_txs['transfers'] = _fetch_kucoin_paginated_data_in_chunks('/api/v1/accounts/ledgers', base_params={'bizType': 'TRANSFER'})
-    except Exception as e:
-        current_app.logger.error(f"Не удалось получить историю переводов KuCoin: {e}")
-    
+        'transfers': ("историю переводов (ledgers)", lambda: _iter_kucoin_chunk_pages('transfers', '/api/v1/accounts/ledgers', base_params={'bizType': 'TRANSFER'})),
+    })
+
+def fetch_kucoin_all_transactions(api_key: str, api_secret: str, passphrase: str = None, start_time_dt: datetime = None, end_time_dt: datetime = None, platform=None) -> dict:
+    """
+    Агрегатор для получения всех типов транзакций с KuCoin (депозиты, выводы, сделки).
+    """
+    all_txs = _collect_history_pages(stream_kucoin_transaction_pages(api_key, api_secret, passphrase, start_time_dt, end_time_dt, platform))
     current_app.logger.info(f"--- [KuCoin History] Найдено: {len(all_txs['deposits'])} депозитов, {len(all_txs['withdrawals'])} выводов, {len(all_txs['trades'])} сделок, {len(all_txs['transfers'])} переводов.")
     return all_txs
 
 # --- РЕФАКТОРИНГ: Классы-обработчики для синхронизации транзакций ---
 
 class BaseTransactionProcessor:
-    """Базовый класс для обработки транзакций с биржи."""
-    def __init__(self, platform, existing_tx_ids):
+    """
+    Базовый класс для обработки транзакций с биржи.
+    Новые транзакции накапливаются в буфере и записываются пачками через
+    INSERT ... ON CONFLICT (exchange_tx_id) DO NOTHING, поэтому загружать
+    все существующие exchange_tx_id платформы заранее не нужно.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, platform, existing_tx_ids=None):
         self.platform = platform
-        self.existing_tx_ids = existing_tx_ids
+        # Необязательный набор уже известных ID (для обратной совместимости); дубликаты отсекает БД.
+        self.existing_tx_ids = existing_tx_ids or set()
         self.added_count = 0
+        self._pending_rows = []
+        self._pending_ids = set()
+
+    CATEGORY_HANDLERS = {
+        'deposits': 'process_deposits',
+        'internal_deposits': 'process_internal_deposits',
+        'withdrawals': 'process_withdrawals',
+        'transfers': 'process_transfers',
+        'trades': 'process_trades',
+    }
 
     def process(self, fetched_data):
         """Основной метод, запускающий обработку всех типов транзакций."""
-        self.process_deposits(fetched_data.get('deposits', []))
-        self.process_internal_deposits(fetched_data.get('internal_deposits', []))
-        self.process_withdrawals(fetched_data.get('withdrawals', []))
-        self.process_transfers(fetched_data.get('transfers', []))
-        self.process_trades(fetched_data.get('trades', []))
+        for category in self.CATEGORY_HANDLERS:
+            self.process_page(category, fetched_data.get(category, []))
+        self.flush()
+
+    def process_page(self, category, records):
+        """Обрабатывает одну страницу записей указанной категории (без записи в БД, см. flush)."""
+        handler = self.CATEGORY_HANDLERS.get(category)
+        if handler and records:
+            getattr(self, handler)(records)
 
     def _add_transaction(self, tx_data):
-        """Вспомогательный метод для добавления новой транзакции в сессию."""
-        if tx_data['exchange_tx_id'] not in self.existing_tx_ids:
-            db.session.add(Transaction(platform_id=self.platform.id, **tx_data))
-            self.added_count += 1
+        """Вспомогательный метод: добавляет транзакцию в буфер пакетной вставки."""
+        tx_id = tx_data['exchange_tx_id']
+        if tx_id in self.existing_tx_ids or tx_id in self._pending_ids:
+            return
+        self._pending_ids.add(tx_id)
+        self._pending_rows.append(dict(tx_data, platform_id=self.platform.id))
+        if len(self._pending_rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные транзакции одной многострочной вставкой и учитывает реально добавленные."""
+        if not self._pending_rows:
+            return
+        self.added_count += bulk_insert_ignore(Transaction, self._pending_rows, ['exchange_tx_id'])
+        self._pending_rows = []
+        # Записанные ID больше не нужны: повторы отсечет уникальный ключ в БД
+        self._pending_ids = set()
 
     # Методы-заглушки, которые будут переопределены в дочерних классах
     def process_deposits(self, data): pass
@@ -1548,6 +1880,15 @@ SYNC_TRANSACTIONS_DISPATCHER = {
     'kucoin': fetch_kucoin_all_transactions,
 }
 
+# Потоковые версии: выдают историю страницами HistoryPage для постраничной записи в БД.
+STREAM_TRANSACTIONS_DISPATCHER = {
+    'bybit': stream_bybit_transaction_pages,
+    'bitget': stream_bitget_transaction_pages,
+    'bingx': stream_bingx_transaction_pages,
+    'okx': stream_okx_transaction_pages,
+    'kucoin': stream_kucoin_transaction_pages,
+}
+
 TRANSACTION_PROCESSOR_DISPATCHER = {
     'bybit': BybitTransactionProcessor,
     'bitget': BitgetTransactionProcessor,
@@ -1556,7 +1897,17 @@ TRANSACTION_PROCESSOR_DISPATCHER = {
     'okx': OkxTransactionProcessor,
 }
 
-from models import Transaction
+from models import Transaction, JsonCache
+from db_utils import bulk_insert_ignore
+
+# Загрузчики полных снимков спотовых тикеров и поле с последней ценой в сыром ответе (для price_oracle)
+SPOT_TICKER_SOURCES = {
+    'bybit': {'loader': _load_bybit_spot_tickers, 'price_field': 'lastPrice'},
+    'bitget': {'loader': _load_bitget_spot_tickers, 'price_field': 'lastPr'},
+    'bingx': {'loader': _load_bingx_spot_tickers, 'price_field': 'lastPrice'},
+    'kucoin': {'loader': _load_kucoin_spot_tickers, 'price_field': 'last'},
+    'okx': {'loader': _load_okx_spot_tickers, 'price_field': 'last'},
+}
 
 # Maps a platform name to the function that fetches its market prices.
 PRICE_TICKER_DISPATCHER = {
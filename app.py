@@ -28,6 +28,18 @@ def create_app():
     app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     app.config['ITEMS_PER_PAGE'] = 20
+    # Тикеры графика производительности, через запятую: PERFORMANCE_CHART_TICKERS=BTC,ETH,SOL
+    app.config['PERFORMANCE_CHART_TICKERS'] = [
+        ticker.strip().upper()
+        for ticker in (os.environ.get('PERFORMANCE_CHART_TICKERS') or 'BTC,ETH,SOL,TON,SUI,NEAR,XRP').split(',')
+        if ticker.strip()
+    ]
+    # Порядок бирж для поиска цены криптоактива (после биржи самой платформы), см. logic/price_oracle.py
+    app.config['PRICE_SOURCE_PRIORITY'] = [
+        exchange.strip().lower()
+        for exchange in (os.environ.get('PRICE_SOURCE_PRIORITY') or 'bybit,okx,bitget,kucoin,bingx').split(',')
+        if exchange.strip()
+    ]
     # --- Инициализация Fernet для шифрования ---
     # Инициализируем Fernet для шифрования/дешифрования API-ключей.
     # Это нужно делать здесь, после load_dotenv(), чтобы гарантировать,
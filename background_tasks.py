@@ -1,12 +1,12 @@
 from flask import current_app
-import time
 import json
 
 from logic.news_analysis import get_news_trends_for_portfolio
 from news_logic import get_crypto_news, get_securities_news
-from logic.platform_sync_logic import sync_platform_balances, sync_platform_transactions
+from logic.sync_engine import sync_platforms_concurrently
 from models import InvestmentPlatform, JsonCache
 from api_clients import fetch_usdt_rub_rate
+from analytics_logic import refresh_crypto_portfolio_history
 from extensions import db
 
 
@@ -56,14 +56,12 @@ def sync_all_platforms_in_background():
             current_app.logger.info("--- [BG_TASK] Нет активных крипто-платформ для синхронизации.")
             return
 
-        for platform in active_platforms:
-            current_app.logger.info(f"--- [BG_TASK] Синхронизация балансов для: {platform.name} ---")
-            sync_platform_balances(platform)
-            time.sleep(5)  # Пауза между разными типами синхронизации
+        current_app.logger.info(f"--- [BG_TASK] Параллельная синхронизация платформ: {', '.join(p.name for p in active_platforms)} ---")
+        sync_platforms_concurrently([platform.id for platform in active_platforms])
 
-            current_app.logger.info(f"--- [BG_TASK] Синхронизация транзакций для: {platform.name} ---")
-            sync_platform_transactions(platform)
-            time.sleep(10)  # Пауза между платформами, чтобы не превышать лимиты API
+        # Инкрементально дописываем историю крипто-портфеля с учетом новых транзакций
+        current_app.logger.info("--- [BG_TASK] Обновление истории крипто-портфеля ---")
+        refresh_crypto_portfolio_history()
 
         current_app.logger.info("--- [BG_TASK] Фоновое обновление платформ завершено успешно. ---")
     except Exception as e:
@@ -64,14 +64,15 @@ def refresh_performance_chart_command():
     print(message)
 
 @analytics_cli.command('refresh-all-history')
-def refresh_all_history_command():
+@click.option('--full', is_flag=True, help='Полный пересчет вместо инкрементального обновления.')
+def refresh_all_history_command(full):
     """Пересчитывает историю стоимости для всех портфелей."""
     print("--- НАЧАЛО ПЕРЕСЧЕТА ИСТОРИИ ПОРТФЕЛЕЙ ---")
     print("\n-> Пересчет истории крипто-портфеля...")
-    success, message = refresh_crypto_portfolio_history()
+    success, message = refresh_crypto_portfolio_history(full_rebuild=full)
     print(message)
     print("\n-> Пересчет истории портфеля ЦБ...")
-    success, message = refresh_securities_portfolio_history()
+    success, message = refresh_securities_portfolio_history(full_rebuild=full)
     print(message)
     print("\n--- ПЕРЕСЧЕТ ИСТОРИИ ПОРТФЕЛЕЙ ЗАВЕРШЕН ---")
 
@@ -0,0 +1,129 @@
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+
+# --- Пакетная запись в БД ---
+# Многострочные INSERT вместо поштучного db.session.add(): одна команда на пачку строк,
+# дубликаты отбрасывает сама БД по уникальному ключу, без предварительной загрузки
+# существующих ключей в память.
+
+# Предел числа параметров в одной команде (SQLite >= 3.32: 32766, PostgreSQL: 65535).
+MAX_BIND_PARAMS = 30000
+
+_DIALECT_INSERTS = {
+    'postgresql': pg_insert,
+    'sqlite': sqlite_insert,
+}
+
+
+def _normalize_rows(rows: list) -> list:
+    """Приводит строки к одному набору ключей (отсутствующие значения -> NULL), как требует многострочный VALUES."""
+    keys = set()
+    for row in rows:
+        keys.update(row.keys())
+    return [{key: row.get(key) for key in keys} for row in rows]
+
+
+def _chunks(rows: list, columns_count: int):
+    size = max(1, MAX_BIND_PARAMS // max(1, columns_count))
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def bulk_insert_ignore(model, rows: list, conflict_columns: list) -> int:
+    """
+    Вставляет строки пачками через INSERT ... ON CONFLICT (conflict_columns) DO NOTHING
+    (PostgreSQL и SQLite; для SQLite это аналог INSERT OR IGNORE по указанному ключу).
+    Возвращает количество реально вставленных строк. Коммит остается за вызывающим кодом.
+    """
+    if not rows:
+        return 0
+    rows = _normalize_rows(rows)
+    table = model.__table__
+    dialect_name = db.session.get_bind(mapper=model).dialect.name
+    insert_fn = _DIALECT_INSERTS.get(dialect_name)
+
+    if insert_fn is None:
+        # Резервный путь для прочих СУБД: построчная вставка в savepoint'ах.
+        inserted = 0
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert().values(**row))
+                inserted += 1
+            except IntegrityError:
+                pass
+        return inserted
+
+    inserted = 0
+    for chunk in _chunks(rows, len(rows[0])):
+        stmt = insert_fn(table).values(chunk).on_conflict_do_nothing(index_elements=conflict_columns)
+        result = db.session.execute(stmt)
+        inserted += max(result.rowcount or 0, 0)
+    return inserted
+
+
+def bulk_upsert(model, rows: list, conflict_columns: list, update_columns: list) -> int:
+    """
+    Вставляет или обновляет строки пачками через INSERT ... ON CONFLICT (conflict_columns)
+    DO UPDATE SET update_columns = excluded.update_columns. Дубликаты ключа внутри `rows`
+    схлопываются (побеждает последняя строка), т.к. PostgreSQL не позволяет обновить одну
+    строку дважды в одной команде. Возвращает число затронутых строк. Коммит остается за вызывающим кодом.
+    """
+    if not rows:
+        return 0
+    unique_rows = {tuple(row[col] for col in conflict_columns): row for row in rows}
+    rows = _normalize_rows(list(unique_rows.values()))
+    table = model.__table__
+    dialect_name = db.session.get_bind(mapper=model).dialect.name
+    insert_fn = _DIALECT_INSERTS.get(dialect_name)
+
+    if insert_fn is None:
+        # Резервный путь для прочих СУБД: merge() по первичному ключу не подходит, ищем по уникальному ключу.
+        for row in rows:
+            existing = model.query.filter_by(**{col: row[col] for col in conflict_columns}).first()
+            if existing:
+                for col in update_columns:
+                    setattr(existing, col, row.get(col))
+            else:
+                db.session.add(model(**row))
+        db.session.flush()
+        return len(rows)
+
+    affected = 0
+    for chunk in _chunks(rows, len(rows[0])):
+        stmt = insert_fn(table).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=conflict_columns,
+            set_={col: stmt.excluded[col] for col in update_columns}
+        )
+        result = db.session.execute(stmt)
+        affected += max(result.rowcount or 0, 0)
+    return affected
+
+
+def bulk_update_by_pk(model, rows: list) -> int:
+    """
+    Обновляет строки по первичному ключу одной командой UPDATE ... WHERE pk = :pk с пачкой параметров
+    (executemany). Каждая строка - первичный ключ и новые значения колонок; строки с разным набором
+    колонок выполняются отдельными командами. Возвращает число строк. Коммит остается за вызывающим кодом.
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    pk_name = list(table.primary_key.columns)[0].name
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(key for key in row if key != pk_name)), []).append(row)
+
+    for columns, group in groups.items():
+        # Имена параметров не должны совпадать с именами колонок в SET, поэтому добавляем префикс
+        stmt = table.update().where(table.c[pk_name] == bindparam(f'b_{pk_name}')).values(
+            {column: bindparam(f'b_{column}') for column in columns}
+        )
+        db.session.execute(stmt, [{f'b_{key}': value for key, value in row.items()} for row in group])
+    return len(rows)
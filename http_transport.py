@@ -0,0 +1,60 @@
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Общий HTTP-транспорт с пулом keep-alive соединений ---
+# Все внешние запросы (биржи, ЦБ РФ, CryptoCompare, RSS, MOEX ISS) идут через одну
+# сессию requests, поэтому TCP+TLS рукопожатие выполняется один раз на соединение,
+# а не на каждый запрос. Пулы urllib3 потокобезопасны, так что сессию можно
+# использовать из воркеров ThreadPoolExecutor.
+
+# Размер пула соединений для каждого хоста. Для бирж, которые опрашиваются
+# параллельно (чанки KuCoin, пары BingX), пул больше.
+HOST_POOL_SIZES = {
+    "https://api.bybit.com": 10,
+    "https://api.bitget.com": 10,
+    "https://open-api.bingx.com": 10,
+    "https://api.kucoin.com": 10,
+    "https://www.okx.com": 10,
+    "https://iss.moex.com": 6,
+    "https://www.cbr.ru": 2,
+    "https://min-api.cryptocompare.com": 4,
+}
+DEFAULT_POOL_SIZE = 4
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session() -> requests.Session:
+    """Создает сессию с отдельным адаптером (пулом) для каждого известного хоста."""
+    session = requests.Session()
+    # Адаптер по умолчанию для всех остальных хостов (RSS-ленты и т.п.)
+    default_adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE)
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+    # requests выбирает адаптер по самому длинному совпадающему префиксу URL
+    for base_url, pool_size in HOST_POOL_SIZES.items():
+        session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Возвращает общую для процесса HTTP-сессию, создавая ее при первом обращении."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+@contextmanager
+def shared_http_session():
+    """
+    Замена `with requests.Session() as session:` для кода, который ожидает
+    контекстный менеджер (например, вызовы apimoex). Общая сессия при выходе не закрывается.
+    """
+    yield get_http_session()
@@ -1,20 +1,108 @@
 from flask import current_app
 from datetime import datetime, timezone, timedelta
-from decimal import Decimal
+from decimal import Decimal, Context
 import json
+from collections import defaultdict, namedtuple
 
-from models import InvestmentPlatform, InvestmentAsset, Transaction
+from models import InvestmentPlatform, InvestmentAsset, Transaction, PlatformSyncState
 from extensions import db
+from db_utils import bulk_update_by_pk
 from api_clients import (
     SYNC_DISPATCHER, 
-    SYNC_TRANSACTIONS_DISPATCHER, 
-    PRICE_TICKER_DISPATCHER,
+    STREAM_TRANSACTIONS_DISPATCHER,
     TRANSACTION_PROCESSOR_DISPATCHER
 )
+from logic.price_oracle import get_usdt_prices
+
+# Точность колонок InvestmentAsset: quantity - Numeric(36, 18), current_price - Numeric(20, 8).
+# Значения с биржи приводятся к ней до сравнения с БД, чтобы не писать UPDATE из-за разницы в разрядах.
+QUANTITY_QUANTUM = Decimal('1e-18')
+PRICE_QUANTUM = Decimal('1e-8')
+# Контекст по точности колонки: стандартных 28 знаков не хватает для 18 знаков после запятой у больших количеств
+NUMERIC_CONTEXT = Context(prec=36)
+
+
+def _normalize(value: Decimal | None, quantum: Decimal) -> Decimal | None:
+    return Decimal(value).quantize(quantum, context=NUMERIC_CONTEXT) if value is not None else None
+
+
+STABLECOIN_TICKERS = ['USDT', 'USDC', 'DAI']
+MANUAL_ACCOUNT_TYPES = ['Manual', 'Manual Earn', 'Staking', 'Lending']
+
+# Результат сравнения балансов с БД: новые строки (словари колонок InvestmentAsset), обновления
+# ({'id', колонки}), id обнуляемых активов и число строк без изменений.
+BalanceDiff = namedtuple('BalanceDiff', ['inserts', 'updates', 'zeroed', 'unchanged'])
+
+
+def _load_asset_rows(platform_id: int) -> list:
+    """Загружает активы платформы одним запросом в виде легких кортежей (без ORM-объектов)."""
+    return db.session.query(
+        InvestmentAsset.id, InvestmentAsset.ticker, InvestmentAsset.asset_type, InvestmentAsset.quantity,
+        InvestmentAsset.current_price, InvestmentAsset.currency_of_price, InvestmentAsset.source_account_type
+    ).filter(InvestmentAsset.platform_id == platform_id).all()
+
+
+def compute_balance_diff(platform_id: int, asset_rows: list, fetched_assets_data: list, prices_by_ticker: dict,
+                         incomplete_account_types=()) -> BalanceDiff:
+    """
+    Сравнивает балансы с биржи с текущими строками активов и возвращает BalanceDiff.
+    Значения сравниваются после приведения к точности колонок. Активы, которых биржа не вернула,
+    обнуляются, кроме ручных счетов и счетов, баланс которых не удалось загрузить: у них обновляется только цена.
+    """
+    existing = {(row.ticker, row.source_account_type): row for row in asset_rows}
+    inserts, updates, zeroed = [], [], []
+    unchanged = 0
+
+    for asset_data in fetched_assets_data:
+        ticker = asset_data['ticker']
+        quantity = _normalize(Decimal(asset_data['quantity']), QUANTITY_QUANTUM)
+        account_type = asset_data.get('account_type', 'Spot')
+        current_price = Decimal('1.0') if ticker.upper() in STABLECOIN_TICKERS else prices_by_ticker.get(ticker)
+        current_price = _normalize(current_price, PRICE_QUANTUM)
+
+        row = existing.pop((ticker, account_type), None)
+        if row is None:
+            inserts.append(dict(
+                ticker=ticker, name=ticker, asset_type='crypto', quantity=quantity,
+                current_price=current_price, currency_of_price='USDT',
+                platform_id=platform_id, source_account_type=account_type
+            ))
+        elif (_normalize(row.quantity, QUANTITY_QUANTUM) != quantity
+                or _normalize(row.current_price, PRICE_QUANTUM) != current_price
+                or row.currency_of_price != 'USDT'):
+            updates.append({'id': row.id, 'quantity': quantity, 'current_price': current_price, 'currency_of_price': 'USDT'})
+        else:
+            unchanged += 1
+
+    for row in existing.values():
+        if row.source_account_type not in MANUAL_ACCOUNT_TYPES and row.source_account_type not in incomplete_account_types:
+            if row.quantity != 0:
+                zeroed.append(row.id)
+            else:
+                unchanged += 1
+            continue
+        new_price = _normalize(prices_by_ticker.get(row.ticker), PRICE_QUANTUM)
+        if new_price is not None and _normalize(row.current_price, PRICE_QUANTUM) != new_price:
+            updates.append({'id': row.id, 'quantity': row.quantity, 'current_price': new_price, 'currency_of_price': 'USDT'})
+        else:
+            unchanged += 1
+
+    return BalanceDiff(inserts, updates, zeroed, unchanged)
+
+
+def apply_balance_diff(diff: BalanceDiff):
+    """Применяет BalanceDiff пакетными командами (INSERT и UPDATE с пачкой параметров). Коммит за вызывающим кодом."""
+    if diff.inserts:
+        db.session.execute(InvestmentAsset.__table__.insert(), diff.inserts)
+    bulk_update_by_pk(InvestmentAsset, diff.updates)
+    bulk_update_by_pk(InvestmentAsset, [{'id': asset_id, 'quantity': Decimal(0)} for asset_id in diff.zeroed])
+
 
 def sync_platform_balances(platform: InvestmentPlatform):
     """
     Основная логика для синхронизации балансов активов для одной платформы.
+    Активы платформы читаются один раз, изменения считаются в compute_balance_diff
+    и записываются пакетно в одной транзакции.
     """
     sync_function = SYNC_DISPATCHER.get(platform.name.lower())
     if not sync_function:
@@ -24,67 +112,25 @@ def sync_platform_balances(platform: InvestmentPlatform):
     try:
         api_key, api_secret, passphrase = platform.api_key, platform.api_secret, platform.passphrase
         fetched_assets_data = sync_function(api_key=api_key, api_secret=api_secret, passphrase=passphrase)
-        
-        prices_by_ticker = {}
-        price_fetcher_config = PRICE_TICKER_DISPATCHER.get(platform.name.lower())
-        if price_fetcher_config:
-            db_tickers = {asset.ticker for asset in platform.assets if asset.asset_type == 'crypto'}
-            api_tickers = {asset_data['ticker'] for asset_data in fetched_assets_data}
-            all_tickers_to_price = db_tickers.union(api_tickers)
-            tickers_to_fetch = [t for t in all_tickers_to_price if t.upper() not in ['USDT', 'USDC', 'DAI']]
-            symbols_for_api = [f"{ticker}{price_fetcher_config['suffix']}" for ticker in tickers_to_fetch]
-
-            if symbols_for_api:
-                price_data = price_fetcher_config['func'](target_symbols=symbols_for_api)
-                for item in price_data:
-                    prices_by_ticker[item['ticker']] = Decimal(item['price'])
-
-        existing_db_assets = {(asset.ticker, asset.source_account_type): asset for asset in platform.assets}
-        updated_count, added_count, removed_count = 0, 0, 0
-
-        for asset_data in fetched_assets_data:
-            ticker = asset_data['ticker']
-            quantity = Decimal(asset_data['quantity'])
-            account_type = asset_data.get('account_type', 'Spot')
-            current_price = prices_by_ticker.get(ticker)
-            if ticker.upper() in ['USDT', 'USDC', 'DAI']:
-                current_price = Decimal('1.0')
-            composite_key = (ticker, account_type)
-
-            if composite_key in existing_db_assets:
-                db_asset = existing_db_assets.pop(composite_key)
-                if db_asset.quantity != quantity or db_asset.current_price != current_price or db_asset.currency_of_price != 'USDT':
-                    db_asset.quantity = quantity
-                    db_asset.current_price = current_price
-                    db_asset.currency_of_price = 'USDT'
-                    updated_count += 1
-            else:
-                new_asset = InvestmentAsset(
-                    ticker=ticker, name=ticker, asset_type='crypto', quantity=quantity,
-                    current_price=current_price, currency_of_price='USDT',
-                    platform_id=platform.id, source_account_type=account_type
-                )
-                db.session.add(new_asset)
-                added_count += 1
-        
-        manual_account_types_to_preserve = ['Manual', 'Manual Earn', 'Staking', 'Lending']
-        for composite_key, db_asset in existing_db_assets.items():
-            if db_asset.source_account_type not in manual_account_types_to_preserve:
-                if db_asset.quantity != 0:
-                    db_asset.quantity = Decimal(0)
-                    removed_count += 1
-            else:
-                new_price = prices_by_ticker.get(db_asset.ticker)
-                if new_price is not None and db_asset.current_price != new_price:
-                    db_asset.current_price = new_price
-                    db_asset.currency_of_price = 'USDT'
-                    updated_count += 1
 
-        status_msg = f"Success: {added_count} added, {updated_count} updated, {removed_count} zeroed."
+        asset_rows = _load_asset_rows(platform.id)
+        db_tickers = {row.ticker for row in asset_rows if row.asset_type == 'crypto'}
+        api_tickers = {asset_data['ticker'] for asset_data in fetched_assets_data}
+        prices_by_ticker = get_usdt_prices(db_tickers | api_tickers, preferred_exchange=platform.name.lower())
+
+        # Счета, баланс которых биржа не вернула (ошибка или таймаут), не обнуляем - только обновляем цену
+        incomplete_account_types = getattr(fetched_assets_data, 'incomplete_account_types', set())
+        if incomplete_account_types:
+            current_app.logger.warning(f"[BG_SYNC] '{platform.name}': балансы счетов {sorted(incomplete_account_types)} не получены, их активы не обнуляются.")
+
+        diff = compute_balance_diff(platform.id, asset_rows, fetched_assets_data, prices_by_ticker, incomplete_account_types)
+        apply_balance_diff(diff)
+
+        status_msg = f"Success: {len(diff.inserts)} added, {len(diff.updates)} updated, {len(diff.zeroed)} zeroed."
         platform.last_sync_status = status_msg
         platform.last_synced_at = datetime.now(timezone.utc)
         db.session.commit()
-        current_app.logger.info(f"[BG_SYNC] Balance sync for '{platform.name}' successful. {status_msg}")
+        current_app.logger.info(f"[BG_SYNC] Balance sync for '{platform.name}' successful. {status_msg} Unchanged: {diff.unchanged}.")
         return True, status_msg
 
     except Exception as e:
@@ -96,34 +142,93 @@ def sync_platform_balances(platform: InvestmentPlatform):
         current_app.logger.error(f"[BG_SYNC] Balance sync error for '{platform.name}': {e}", exc_info=True)
         return False, status_msg
 
+# Перекрытие при инкрементальной синхронизации эндпоинта. Депозиты и выводы фильтруются биржами
+# по времени создания, а в историю попадают только после завершения, поэтому для них берем сутки;
+# сделки и переводы появляются сразу, им достаточно нескольких минут на рассинхронизацию часов.
+ENDPOINT_SYNC_OVERLAP = {
+    'deposits': timedelta(days=1),
+    'internal_deposits': timedelta(days=1),
+    'withdrawals': timedelta(days=1),
+}
+DEFAULT_SYNC_OVERLAP = timedelta(minutes=10)
+INITIAL_SYNC_DEPTH = timedelta(days=2*365)
+
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    if value and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _endpoint_start_time(state: PlatformSyncState | None, category: str, fallback_start: datetime) -> datetime:
+    """Начало периода для эндпоинта: его собственный водяной знак минус перекрытие, иначе общий старт."""
+    synced_until = _as_utc(state.synced_until) if state else None
+    if not synced_until:
+        return fallback_start
+    return synced_until - ENDPOINT_SYNC_OVERLAP.get(category, DEFAULT_SYNC_OVERLAP)
+
+
 def sync_platform_transactions(platform: InvestmentPlatform):
     """
     Основная логика для синхронизации транзакций для одной платформы.
+    История поступает страницами: каждая страница сразу записывается в БД и фиксируется вместе
+    с водяным знаком своего эндпоинта (PlatformSyncState), поэтому каждый эндпоинт загружает только
+    свою дельту, прерванная загрузка продолжается с места остановки, а эндпоинт с ошибкой
+    в следующий раз повторяется со своего водяного знака.
     """
-    sync_function = SYNC_TRANSACTIONS_DISPATCHER.get(platform.name.lower())
-    if not sync_function:
+    stream_function = STREAM_TRANSACTIONS_DISPATCHER.get(platform.name.lower())
+    if not stream_function:
         current_app.logger.warning(f"[BG_SYNC] Нет функции синхронизации транзакций для платформы '{platform.name}'.")
         return False, f"No transaction sync function for {platform.name}"
 
     try:
         api_key, api_secret, passphrase = platform.api_key, platform.api_secret, platform.passphrase
         end_time_dt = datetime.now(timezone.utc)
-        buffer_timedelta = timedelta(days=1)
-        last_sync = platform.last_tx_synced_at
+        # Эндпоинты без собственного состояния: от общей отметки платформы (данные до появления
+        # PlatformSyncState) или первичная загрузка за 2 года.
+        last_sync = _as_utc(platform.last_tx_synced_at)
+        fallback_start = (last_sync - timedelta(days=1)) if last_sync else (end_time_dt - INITIAL_SYNC_DEPTH)
 
-        if last_sync and last_sync.tzinfo is None:
-            last_sync = last_sync.replace(tzinfo=timezone.utc)
-        start_time_dt = (last_sync - buffer_timedelta) if last_sync else (end_time_dt - timedelta(days=2*365))
+        states = {state.endpoint: state for state in platform.sync_states}
+        start_times = {category: _endpoint_start_time(state, category, fallback_start) for category, state in states.items()}
 
-        fetched_data = sync_function(api_key=api_key, api_secret=api_secret, passphrase=passphrase, start_time_dt=start_time_dt, end_time_dt=end_time_dt, platform=platform)
-        existing_tx_ids = {tx.exchange_tx_id for tx in platform.transactions}
-        
         processor_class = TRANSACTION_PROCESSOR_DISPATCHER.get(platform.name.lower())
-        added_count = 0
-        if processor_class:
-            processor = processor_class(platform, existing_tx_ids)
-            processor.process(fetched_data)
-            added_count = processor.added_count
+        processor = processor_class(platform) if processor_class else None
+        fetched_counts = defaultdict(int)
+        failed_endpoints = {}
+        pages = stream_function(
+            api_key=api_key, api_secret=api_secret, passphrase=passphrase,
+            start_time_dt=fallback_start, end_time_dt=end_time_dt, platform=platform, start_times=start_times
+        )
+        for page in pages:
+            fetched_counts[page.category] += len(page.records)
+            if processor:
+                processor.process_page(page.category, page.records)
+                processor.flush()
+
+            if page.watermark or page.error:
+                state = states.get(page.category)
+                if state is None:
+                    state = PlatformSyncState(platform_id=platform.id, endpoint=page.category)
+                    db.session.add(state)
+                    states[page.category] = state
+                if page.error:
+                    state.last_error = page.error[:1000]
+                    failed_endpoints[page.category] = page.error
+                else:
+                    state.synced_until = page.watermark
+                    if page.watermark >= end_time_dt:
+                        state.last_success_at = end_time_dt
+                        state.last_error = None
+            db.session.commit()
+
+        added_count = processor.added_count if processor else 0
+        current_app.logger.info(f"[BG_SYNC] '{platform.name}': получено записей по категориям: {dict(fetched_counts)}")
+
+        if failed_endpoints:
+            status_msg = f"Partial: {added_count} new transactions found; failed: {', '.join(sorted(failed_endpoints))}."
+            current_app.logger.warning(f"[BG_SYNC] Transaction sync for '{platform.name}' incomplete. {status_msg}")
+            return False, status_msg
 
         platform.last_tx_synced_at = end_time_dt
         db.session.commit()
@@ -135,4 +240,4 @@ def sync_platform_transactions(platform: InvestmentPlatform):
         db.session.rollback()
         status_msg = f"Error: {e}"
         current_app.logger.error(f"[BG_SYNC] Transaction sync error for '{platform.name}': {e}", exc_info=True)
-        return False, status_msg
\ No newline at end of file
+        return False, status_msg
@@ -0,0 +1,212 @@
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+from flask import current_app
+
+from extensions import db
+from models import HistoricalPrice, MoexHistoricalPrice, JsonCache
+from db_utils import bulk_upsert
+from api_clients import fetch_bybit_historical_price_range
+from securities_logic import fetch_moex_historical_price_range
+
+# --- Хранилище дневных цен: криптоактивы (HistoricalPrice) и бумаги MOEX (MoexHistoricalPrice) ---
+# Read-through кэш: вызывающий код запрашивает диапазон дат, с биржи загружаются только
+# даты за пределами уже покрытого диапазона, результат пакетно записывается в БД.
+# Храним только закрытые дни (< сегодня): цена текущего дня еще меняется и всегда
+# берется из свежего ответа биржи. Покрытый диапазон по каждому тикеру хранится в
+# JsonCache, чтобы не запрашивать повторно периоды без торгов (например, до листинга).
+
+COVERAGE_CACHE_KEY = 'historical_price_coverage'
+# Дневные свечи Bybit закрываются в 00:00 UTC, торговый день MOEX - по московскому времени (UTC+3 без перехода).
+MOSCOW_TZ = timezone(timedelta(hours=3))
+MOEX_COVERAGE_CACHE_KEY = 'moex_historical_price_coverage'
+
+
+def _load_coverage(cache_key: str = COVERAGE_CACHE_KEY) -> tuple[dict, JsonCache | None]:
+    entry = JsonCache.query.filter_by(cache_key=cache_key).first()
+    try:
+        raw = json.loads(entry.json_data) if entry else {}
+    except (json.JSONDecodeError, TypeError):
+        raw = {}
+    coverage = {ticker: (date.fromisoformat(bounds[0]), date.fromisoformat(bounds[1])) for ticker, bounds in raw.items()}
+    return coverage, entry
+
+
+def _save_coverage(entry: JsonCache | None, coverage: dict, cache_key: str = COVERAGE_CACHE_KEY):
+    if not entry:
+        entry = JsonCache(cache_key=cache_key)
+        db.session.add(entry)
+    entry.json_data = json.dumps({ticker: [bounds[0].isoformat(), bounds[1].isoformat()] for ticker, bounds in coverage.items()})
+
+
+def _missing_ranges(covered: tuple | None, start_date: date, end_date: date) -> list[tuple[date, date]]:
+    """
+    Возвращает отрезки, которые нужно загрузить, чтобы покрыть [start_date, end_date].
+    Покрытие хранится одним непрерывным интервалом, поэтому отрезки всегда примыкают к нему:
+    запрос далеко правее покрытия догружает и промежуток между ними (иначе он считался бы покрытым).
+
+    >>> _missing_ranges((date(2024, 1, 1), date(2024, 1, 31)), date(2024, 3, 1), date(2024, 3, 10))
+    [(datetime.date(2024, 2, 1), datetime.date(2024, 3, 10))]
+    >>> _missing_ranges((date(2024, 3, 1), date(2024, 3, 31)), date(2024, 1, 1), date(2024, 1, 10))
+    [(datetime.date(2024, 1, 1), datetime.date(2024, 2, 29))]
+    >>> _missing_ranges((date(2024, 1, 1), date(2024, 1, 31)), date(2024, 1, 5), date(2024, 1, 20))
+    []
+    """
+    if covered is None:
+        return [(start_date, end_date)]
+    covered_from, covered_to = covered
+    ranges = []
+    if start_date < covered_from:
+        ranges.append((start_date, covered_from - timedelta(days=1)))
+    if end_date > covered_to:
+        ranges.append((covered_to + timedelta(days=1), end_date))
+    return ranges
+
+
+def _extend_coverage(coverage: dict, key: str, range_start: date, range_end: date):
+    """Расширяет покрытый диапазон успешно загруженным отрезком, примыкающим к нему."""
+    if range_start > range_end:
+        return
+    covered = coverage.get(key)
+    coverage[key] = (min(covered[0], range_start), max(covered[1], range_end)) if covered else (range_start, range_end)
+
+
+def first_uncovered_dates(keys, start_date: date, end_date: date, cache_key: str = COVERAGE_CACHE_KEY) -> dict[str, date]:
+    """
+    Возвращает {ключ: первый день в [start_date, end_date], за который хранилище цен еще не загружено}.
+    Ключи, покрытые на всем отрезке, в ответ не попадают (даже если цен нет - например, до листинга).
+    По этим датам вызывающий код понимает, что оценка дня сделана без цены из-за сбоя загрузки.
+    """
+    coverage, _ = _load_coverage(cache_key)
+    result = {}
+    for key in keys:
+        covered = coverage.get(key)
+        if covered is None or covered[0] > start_date:
+            result[key] = start_date
+        elif covered[1] < end_date:
+            result[key] = covered[1] + timedelta(days=1)
+    return result
+
+
+def get_daily_prices(tickers: list, start_date: date, end_date: date, quote: str = 'USDT') -> dict[str, dict[date, Decimal]]:
+    """
+    Возвращает дневные цены закрытия {тикер: {дата: цена}} за [start_date, end_date].
+    Недостающие даты догружаются с Bybit (параллельно, темп задает rate_limiter)
+    и сохраняются в HistoricalPrice; уже сохраненные дни повторно не запрашиваются.
+    """
+    tickers = sorted(set(tickers))
+    result = defaultdict(dict)
+    if not tickers or start_date > end_date:
+        return result
+
+    last_closed_date = datetime.now(timezone.utc).date() - timedelta(days=1)
+    coverage, coverage_entry = _load_coverage()
+
+    ranges_to_fetch = {}
+    for ticker in tickers:
+        ranges = _missing_ranges(coverage.get(ticker), start_date, end_date)
+        if ranges:
+            ranges_to_fetch[ticker] = ranges
+
+    live_prices = defaultdict(dict)
+    if ranges_to_fetch:
+        current_app.logger.info(f"--- [PriceStore] Догрузка истории цен: {{{', '.join(f'{t}: {len(r)}' for t, r in ranges_to_fetch.items())}}}")
+        app = current_app._get_current_object()
+
+        def _fetch_ranges_worker(ticker, ranges):
+            with app.app_context():
+                fetched, loaded_ranges = {}, []
+                for range_start, range_end in ranges:
+                    try:
+                        fetched.update(fetch_bybit_historical_price_range(f"{ticker}{quote}", range_start, range_end, raise_errors=True))
+                        loaded_ranges.append((range_start, range_end))
+                    except Exception as e:
+                        current_app.logger.warning(f"--- [PriceStore] Не удалось загрузить {ticker} за {range_start}..{range_end}: {e}")
+                return fetched, loaded_ranges
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=min(8, len(ranges_to_fetch))) as executor:
+            future_to_ticker = {executor.submit(_fetch_ranges_worker, ticker, ranges): ticker for ticker, ranges in ranges_to_fetch.items()}
+            for future in as_completed(future_to_ticker):
+                ticker = future_to_ticker[future]
+                fetched, loaded_ranges = future.result()
+                for price_date, price in fetched.items():
+                    if price_date <= last_closed_date:
+                        rows.append({'ticker': ticker, 'date': price_date, 'price_usdt': price})
+                    else:
+                        live_prices[ticker][price_date] = price
+
+                # Расширяем покрытый диапазон только успешно загруженными закрытыми днями.
+                # Недостающие отрезки примыкают к покрытому диапазону, поэтому он остается непрерывным.
+                for range_start, range_end in loaded_ranges:
+                    _extend_coverage(coverage, ticker, range_start, min(range_end, last_closed_date))
+
+        bulk_upsert(HistoricalPrice, rows, ['ticker', 'date'], ['price_usdt'])
+        _save_coverage(coverage_entry, coverage)
+        db.session.commit()
+        current_app.logger.info(f"--- [PriceStore] Сохранено {len(rows)} дневных цен.")
+
+    stored = db.session.query(HistoricalPrice.ticker, HistoricalPrice.date, HistoricalPrice.price_usdt).filter(
+        HistoricalPrice.ticker.in_(tickers),
+        HistoricalPrice.date >= start_date,
+        HistoricalPrice.date <= end_date
+    ).all()
+    for ticker, price_date, price in stored:
+        result[ticker][price_date] = price
+    for ticker, prices in live_prices.items():
+        result[ticker].update(prices)
+    return result
+
+
+def get_moex_daily_prices(isin_to_secid: dict[str, str], start_date: date, end_date: date) -> dict[str, dict[date, Decimal]]:
+    """
+    Возвращает дневные цены закрытия бумаг MOEX {isin: {дата: цена}} за [start_date, end_date].
+    Работает так же, как get_daily_prices: недостающие даты (вместе с промежутком до уже покрытого
+    диапазона) догружаются через fetch_moex_historical_price_range и сохраняются в MoexHistoricalPrice.
+    """
+    result = defaultdict(dict)
+    if not isin_to_secid or start_date > end_date:
+        return result
+
+    last_closed_date = datetime.now(MOSCOW_TZ).date() - timedelta(days=1)
+    coverage, coverage_entry = _load_coverage(MOEX_COVERAGE_CACHE_KEY)
+
+    rows = []
+    live_prices = defaultdict(dict)
+    fetched_any = False
+    for isin, secid in isin_to_secid.items():
+        for range_start, range_end in _missing_ranges(coverage.get(isin), start_date, end_date):
+            fetched_any = True
+            try:
+                fetched = fetch_moex_historical_price_range([secid], range_start, range_end, raise_errors=True).get(secid, {})
+            except Exception as e:
+                current_app.logger.warning(f"--- [PriceStore] Не удалось загрузить {isin} ({secid}) за {range_start}..{range_end}: {e}")
+                continue
+            for price_date, price in fetched.items():
+                if price_date <= last_closed_date:
+                    rows.append({'isin': isin, 'date': price_date, 'price_rub': price})
+                else:
+                    live_prices[isin][price_date] = price
+            # Отрезок из _missing_ranges примыкает к покрытию (включая промежуток до запрошенных дат),
+            # поэтому расширение не помечает незагруженные дни как сохраненные.
+            _extend_coverage(coverage, isin, range_start, min(range_end, last_closed_date))
+
+    if fetched_any:
+        bulk_upsert(MoexHistoricalPrice, rows, ['isin', 'date'], ['price_rub'])
+        _save_coverage(coverage_entry, coverage, MOEX_COVERAGE_CACHE_KEY)
+        db.session.commit()
+        current_app.logger.info(f"--- [PriceStore] Сохранено {len(rows)} дневных цен MOEX.")
+
+    stored = db.session.query(MoexHistoricalPrice.isin, MoexHistoricalPrice.date, MoexHistoricalPrice.price_rub).filter(
+        MoexHistoricalPrice.isin.in_(list(isin_to_secid.keys())),
+        MoexHistoricalPrice.date >= start_date,
+        MoexHistoricalPrice.date <= end_date
+    ).all()
+    for isin, price_date, price in stored:
+        result[isin][price_date] = price
+    for isin, prices in live_prices.items():
+        result[isin].update(prices)
+    return result
@@ -0,0 +1,88 @@
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app
+
+from api_clients import SPOT_TICKER_SOURCES
+from ticker_cache import get_ticker_snapshot
+
+# --- Сводный ценовой оракул по всем биржам ---
+# Цена тикера в USDT ищется сначала на бирже, где лежит актив, затем по остальным биржам
+# в порядке PRICE_SOURCE_PRIORITY. Снимки тикеров берутся из ticker_cache (не чаще раза
+# за окно TTL на биржу), поэтому один и тот же тикер на пяти платформах не запрашивается
+# пять раз, а актив, которого нет на своей бирже, получает цену с другой.
+
+STABLECOINS = {'USDT', 'USDC', 'DAI'}
+QUOTE = 'USDT'
+DEFAULT_PRICE_SOURCE_PRIORITY = ['bybit', 'okx', 'bitget', 'kucoin', 'bingx']
+
+# {биржа: (сырой снимок, индекс {базовый тикер: цена})} - индекс пересчитывается только при смене снимка
+_indexes = {}
+
+
+def normalize_symbol(symbol: str) -> str:
+    """Приводит символ пары к единому виду: 'BTC-USDT', 'btc_usdt', 'BTC/USDT' -> 'BTCUSDT'."""
+    return symbol.upper().replace('-', '').replace('_', '').replace('/', '')
+
+
+def _price_index(exchange: str) -> dict[str, Decimal]:
+    """Возвращает индекс {базовый тикер: цена в USDT} по актуальному снимку тикеров биржи."""
+    source = SPOT_TICKER_SOURCES[exchange]
+    snapshot = get_ticker_snapshot(exchange, source['loader'])
+    cached = _indexes.get(exchange)
+    if cached and cached[0] is snapshot:
+        return cached[1]
+
+    index = {}
+    for symbol, item in snapshot.items():
+        normalized = normalize_symbol(symbol)
+        if not normalized.endswith(QUOTE) or normalized == QUOTE:
+            continue
+        try:
+            price = Decimal(str(item.get(source['price_field'])))
+        except (InvalidOperation, TypeError):
+            continue
+        if price > 0:
+            index[normalized[:-len(QUOTE)]] = price
+    _indexes[exchange] = (snapshot, index)
+    return index
+
+
+def get_source_priority(preferred_exchange: str | None = None) -> list[str]:
+    """Порядок опроса бирж: сначала предпочтительная (биржа платформы), затем приоритет из конфигурации."""
+    priority = current_app.config.get('PRICE_SOURCE_PRIORITY') or DEFAULT_PRICE_SOURCE_PRIORITY
+    order = [preferred_exchange] if preferred_exchange else []
+    order += [exchange for exchange in priority if exchange != preferred_exchange]
+    return [exchange for exchange in order if exchange in SPOT_TICKER_SOURCES]
+
+
+def get_usdt_prices(tickers, preferred_exchange: str | None = None) -> dict[str, Decimal]:
+    """
+    Возвращает цены {тикер: цена в USDT} для переданных тикеров. Стейблкоины стоят 1.
+    Биржи опрашиваются по очереди только для тикеров, которые еще не нашлись;
+    ошибка одной биржи не мешает взять цену с остальных. Ненайденных тикеров в ответе нет.
+    """
+    prices = {}
+    remaining = set()
+    for ticker in tickers:
+        if ticker.upper() in STABLECOINS:
+            prices[ticker] = Decimal('1.0')
+        else:
+            remaining.add(ticker)
+
+    for exchange in get_source_priority(preferred_exchange):
+        if not remaining:
+            break
+        try:
+            index = _price_index(exchange)
+        except Exception as e:
+            current_app.logger.warning(f"--- [PriceOracle] Не удалось получить тикеры {exchange}: {e}")
+            continue
+        for ticker in list(remaining):
+            price = index.get(ticker.upper())
+            if price is not None:
+                prices[ticker] = price
+                remaining.discard(ticker)
+
+    if remaining:
+        current_app.logger.info(f"--- [PriceOracle] Цена не найдена ни на одной бирже: {sorted(remaining)}")
+    return prices
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from extensions import db
+from models import InvestmentPlatform
+from logic.platform_sync_logic import sync_platform_balances, sync_platform_transactions
+
+# --- Асинхронный движок синхронизации платформ ---
+# Балансы и транзакции всех платформ синхронизируются одновременно: каждая задача
+# выполняется в отдельном потоке (run_in_executor) со своим контекстом приложения
+# и своей сессией БД. Клиенты бирж остаются синхронными (requests), а лимиты запросов
+# соблюдает общий rate_limiter, поэтому время синхронизации определяется самой медленной
+# биржей, а не суммой всех.
+
+SYNC_STEPS = {
+    'balances': sync_platform_balances,
+    'transactions': sync_platform_transactions,
+}
+
+
+def _run_sync_step(app, platform_id: int, step: str):
+    """Выполняет один шаг синхронизации (балансы или транзакции) для платформы в отдельном потоке."""
+    with app.app_context():
+        platform = db.session.get(InvestmentPlatform, platform_id)
+        if not platform:
+            return False, f"Платформа {platform_id} не найдена."
+        current_app.logger.info(f"--- [SyncEngine] Синхронизация ({step}) для: {platform.name} ---")
+        return SYNC_STEPS[step](platform)
+
+
+async def _sync_platforms_async(app, platform_ids: list) -> dict:
+    jobs = [(platform_id, step) for platform_id in platform_ids for step in SYNC_STEPS]
+    loop = asyncio.get_running_loop()
+    # Собственный пул по числу задач: пул asyncio по умолчанию зависит от числа CPU
+    # и на маленьком сервере выстроил бы платформы в очередь.
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        outcomes = await asyncio.gather(
+            *(loop.run_in_executor(executor, _run_sync_step, app, platform_id, step) for platform_id, step in jobs),
+            return_exceptions=True
+        )
+
+    results = {platform_id: {} for platform_id in platform_ids}
+    for (platform_id, step), outcome in zip(jobs, outcomes):
+        if isinstance(outcome, Exception):
+            outcome = (False, f"Error: {outcome}")
+        results[platform_id][step] = outcome
+    return results
+
+
+def sync_platforms_concurrently(platform_ids: list) -> dict:
+    """
+    Синхронизирует балансы и транзакции указанных платформ параллельно.
+    Возвращает словарь {platform_id: {'balances': (success, msg), 'transactions': (success, msg)}}.
+    """
+    if not platform_ids:
+        return {}
+    app = current_app._get_current_object()
+    started_at = time.monotonic()
+    results = asyncio.run(_sync_platforms_async(app, list(platform_ids)))
+    current_app.logger.info(f"--- [SyncEngine] Синхронизация {len(platform_ids)} платформ завершена за {time.monotonic() - started_at:.1f} с.")
+    return results
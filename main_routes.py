@@ -27,6 +27,7 @@ from securities_logic import fetch_moex_market_leaders, fetch_moex_securities_me
 from news_logic import get_crypto_news, get_securities_news
 from logic.news_analysis import get_news_trends_for_portfolio
 from logic.platform_sync_logic import sync_platform_balances, sync_platform_transactions
+from logic.price_oracle import get_usdt_prices
 
 main_bp = Blueprint('main', __name__)
 
@@ -418,13 +419,9 @@ def ui_investment_platform_detail(platform_id):
     # ОПТИМИЗАЦИЯ: Сначала собираем все тикеры, затем делаем один запрос на получение цен.
     manual_tickers_to_fetch = [t for t, q_str in manual_earn_balances.items() if Decimal(q_str) > 0 and t.upper() not in ['USDT', 'USDC', 'DAI']]
     manual_prices = {}
-    price_fetcher_config = PRICE_TICKER_DISPATCHER.get(platform.name.lower())
-    if price_fetcher_config and manual_tickers_to_fetch:
+    if manual_tickers_to_fetch:
         try:
-            symbols_for_api = [f"{ticker}{price_fetcher_config['suffix']}" for ticker in manual_tickers_to_fetch]
-            ticker_data_list = price_fetcher_config['func'](target_symbols=symbols_for_api)
-            for item in ticker_data_list:
-                manual_prices[item['ticker']] = Decimal(item['price'])
+            manual_prices = get_usdt_prices(manual_tickers_to_fetch, preferred_exchange=platform.name.lower())
         except Exception as e:
             current_app.logger.error(f"Ошибка получения цен для ручных Earn балансов: {e}")
 
@@ -625,17 +622,16 @@ def ui_add_investment_asset_form(platform_id):
                 if ticker.upper() in ['USDT', 'USDC', 'DAI']:
                     current_price = Decimal('1.0')
                 else:
-                    price_fetcher_config = _get_sync_function(platform.name, PRICE_TICKER_DISPATCHER)
-                    if price_fetcher_config:
-                        try:
-                            api_symbol = f"{ticker}{price_fetcher_config['suffix']}"
-                            ticker_data_list = price_fetcher_config['func'](target_symbols=[api_symbol])
-                            if ticker_data_list:
-                                current_price = Decimal(ticker_data_list[0]['price'])
-                                flash(f'Цена для {ticker} была автоматически получена: {current_price} USDT.', 'info')
-                        except Exception as e:
-                            current_app.logger.warning(f"Не удалось получить цену для {ticker} при ручном добавлении: {e}")
+                    try:
+                        fetched_price = get_usdt_prices([ticker], preferred_exchange=platform.name.lower()).get(ticker)
+                        if fetched_price is not None:
+                            current_price = fetched_price
+                            flash(f'Цена для {ticker} была автоматически получена: {current_price} USDT.', 'info')
+                        else:
                             flash(f'Не удалось автоматически получить цену для {ticker}.', 'warning')
+                    except Exception as e:
+                        current_app.logger.warning(f"Не удалось получить цену для {ticker} при ручном добавлении: {e}")
+                        flash(f'Не удалось автоматически получить цену для {ticker}.', 'warning')
                 
                 new_asset = InvestmentAsset(platform_id=platform.id, ticker=ticker, name=ticker, asset_type='crypto', quantity=quantity, current_price=current_price, currency_of_price=currency_of_price, source_account_type=source_account_type)
                 db.session.add(new_asset)
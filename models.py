@@ -20,6 +20,7 @@ class InvestmentPlatform(db.Model):
     
     assets = db.relationship('InvestmentAsset', back_populates='platform', cascade="all, delete-orphan", lazy='dynamic')
     transactions = db.relationship('Transaction', back_populates='platform', cascade="all, delete-orphan", lazy='dynamic')
+    sync_states = db.relationship('PlatformSyncState', back_populates='platform', cascade="all, delete-orphan", lazy='dynamic')
 
     @property
     def api_secret(self):
@@ -208,6 +209,39 @@ class MoexHistoricalPrice(db.Model):
     price_rub = db.Column(db.Numeric(20, 8), nullable=False)
     __table_args__ = (db.UniqueConstraint('isin', 'date', name='_moex_isin_date_uc'),)
 
+class MoexSecurityMetadata(db.Model):
+    """Кэш метаданных бумаг MOEX (ISIN/SECID -> SECID, доска, группа). Пустой secid означает, что бумага не найдена."""
+    __tablename__ = 'moex_security_metadata'
+    id = db.Column(db.Integer, primary_key=True)
+    # Исходный запрос (ISIN или SECID в верхнем регистре), по которому искали бумагу
+    lookup_key = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    secid = db.Column(db.String(32))
+    isin = db.Column(db.String(32), index=True)
+    name = db.Column(db.String(255))
+    asset_type = db.Column(db.String(32))
+    board = db.Column(db.String(32))
+    sec_group = db.Column(db.String(64))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f'<MoexSecurityMetadata {self.lookup_key} -> {self.secid}>'
+
+class PlatformSyncState(db.Model):
+    """Состояние синхронизации истории транзакций по отдельному эндпоинту (категории) платформы."""
+    __tablename__ = 'platform_sync_state'
+    id = db.Column(db.Integer, primary_key=True)
+    platform_id = db.Column(db.Integer, db.ForeignKey('investment_platform.id'), nullable=False, index=True)
+    endpoint = db.Column(db.String(64), nullable=False) # Категория истории: deposits, withdrawals, trades, ...
+    synced_until = db.Column(db.DateTime) # До этого момента история эндпоинта полностью записана
+    last_success_at = db.Column(db.DateTime) # Когда эндпоинт последний раз загрузился до конца
+    last_error = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    platform = db.relationship('InvestmentPlatform', back_populates='sync_states')
+    __table_args__ = (db.UniqueConstraint('platform_id', 'endpoint', name='_platform_endpoint_uc'),)
+
+    def __repr__(self):
+        return f'<PlatformSyncState {self.platform_id}:{self.endpoint} -> {self.synced_until}>'
+
 class JsonCache(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cache_key = db.Column(db.String(128), nullable=False, unique=True, index=True)
@@ -2,13 +2,13 @@ import json
 from datetime import datetime, timedelta, timezone
 import time
 from flask import current_app
-import requests
 import logging
 import feedparser
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from models import JsonCache
 from extensions import db
+from http_transport import get_http_session
 from api_clients import fetch_cryptocompare_news
 from translation_logic import translate_text
 # ИЗМЕНЕНО: Импортируем новую функцию для анализа тональности через LLM
@@ -30,7 +30,7 @@ def _fetch_rss_news(feed_url: str, limit: int = 50) -> list:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
         # 1. Используем requests для получения контента, что решает проблемы с редиректами
-        response = requests.get(feed_url, headers=request_headers, timeout=15)
+        response = get_http_session().get(feed_url, headers=request_headers, timeout=15)
         response.raise_for_status()
 
         # 2. Передаем полученный контент в feedparser
@@ -0,0 +1,168 @@
+import threading
+import time
+
+# --- Централизованный реестр ограничений скорости запросов к биржам ---
+# Каждая пара (биржа, класс эндпоинта) получает свой token bucket. Вызывающий код
+# идет с той скоростью, которую позволяет квота, вместо фиксированных time.sleep,
+# а ответы 429 / заголовки лимитов приостанавливают весь bucket, чтобы параллельные
+# потоки не устраивали "шторм" повторных запросов.
+
+PUBLIC_MARKET = 'public_market'
+PRIVATE_WALLET = 'private_wallet'
+PRIVATE_TRADE = 'private_trade'
+
+# (скорость пополнения в единицах веса в секунду, емкость bucket).
+# Значения взяты из опубликованных лимитов бирж с небольшим запасом.
+RATE_LIMITS = {
+    'bybit': {
+        PUBLIC_MARKET: (20, 20),   # 600 запросов / 5 с на IP
+        PRIVATE_WALLET: (5, 5),    # эндпоинты /v5/asset/*: ~5-10 запросов/с на UID
+        PRIVATE_TRADE: (10, 10),   # /v5/execution/list, /v5/account/*: 10 запросов/с
+    },
+    'bitget': {
+        PUBLIC_MARKET: (20, 20),   # 20 запросов/с на IP
+        PRIVATE_WALLET: (10, 10),  # deposit/withdrawal/transfer-records: 10 запросов/с
+        PRIVATE_TRADE: (10, 10),   # /api/v2/spot/trade/fills: 10 запросов/с
+    },
+    'bingx': {
+        PUBLIC_MARKET: (10, 10),
+        PRIVATE_WALLET: (5, 5),
+        PRIVATE_TRADE: (5, 5),     # /openApi/spot/v1/fills: 5 запросов/с
+    },
+    'kucoin': {
+        # KuCoin считает вес запросов: публичный пул 2000 / 30 с, приватный спотовый пул 4000 / 30 с.
+        # Приватный пул делится между кошельковыми и торговыми эндпоинтами.
+        PUBLIC_MARKET: (60, 120),
+        PRIVATE_WALLET: (60, 120),
+        PRIVATE_TRADE: (60, 120),
+    },
+    'okx': {
+        PUBLIC_MARKET: (10, 20),   # /api/v5/market/tickers: 20 запросов / 2 с
+        PRIVATE_WALLET: (3, 6),    # deposit/withdrawal-history: 6 запросов / с
+        PRIVATE_TRADE: (5, 10),    # /api/v5/trade/fills-history: 10 запросов / 2 с
+    },
+}
+DEFAULT_RATE_LIMIT = (5, 5)
+
+# Вес отдельных эндпоинтов (по умолчанию 1). Используется для бирж с весовыми лимитами.
+ENDPOINT_WEIGHTS = {
+    'kucoin': {
+        '/api/v1/market/allTickers': 15,
+        '/api/v1/accounts': 5,
+        '/api/v1/deposits': 5,
+        '/api/v1/withdrawals': 5,
+        '/api/v1/fills': 10,
+        '/api/v1/accounts/ledgers': 2,
+    },
+}
+
+_PUBLIC_MARKERS = ('/market/', '/ticker/', '/common/', '/public/')
+_TRADE_MARKERS = ('/trade/', '/execution/', '/fills', '/order')
+
+
+def classify_endpoint(path: str) -> str:
+    """Определяет класс эндпоинта (публичный рынок, приватный кошелек, приватная торговля) по пути."""
+    if any(marker in path for marker in _PUBLIC_MARKERS):
+        return PUBLIC_MARKET
+    if any(marker in path for marker in _TRADE_MARKERS):
+        return PRIVATE_TRADE
+    return PRIVATE_WALLET
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket с возможностью принудительной паузы."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, cost: float = 1):
+        """Блокирует поток, пока в bucket не появится `cost` токенов, и списывает их."""
+        cost = min(float(cost), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = max(self.blocked_until - now, (cost - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Запрещает запросы на `seconds` секунд и обнуляет накопленные токены."""
+        with self._lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0.0
+            self.updated_at = now
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(exchange: str, endpoint_class: str) -> TokenBucket:
+    """Возвращает (создавая при необходимости) bucket для пары (биржа, класс эндпоинта)."""
+    key = (exchange, endpoint_class)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                rate, capacity = RATE_LIMITS.get(exchange, {}).get(endpoint_class, DEFAULT_RATE_LIMIT)
+                bucket = TokenBucket(rate, capacity)
+                _buckets[key] = bucket
+    return bucket
+
+
+def acquire(exchange: str, path: str):
+    """Ожидает разрешения на запрос к `path` биржи `exchange` с учетом веса эндпоинта."""
+    weight = ENDPOINT_WEIGHTS.get(exchange, {}).get(path, 1)
+    get_bucket(exchange, classify_endpoint(path)).acquire(weight)
+
+
+def _header_float(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def observe_response(exchange: str, path: str, status_code: int, headers) -> float | None:
+    """
+    Учитывает заголовки ответа (Retry-After и специфичные для бирж заголовки лимитов).
+    Если квота исчерпана, ставит bucket на паузу. Возвращает длительность паузы в секундах или None.
+    """
+    bucket = get_bucket(exchange, classify_endpoint(path))
+    pause_seconds = None
+
+    retry_after = _header_float(headers, 'Retry-After')
+    if retry_after is not None:
+        pause_seconds = retry_after
+    elif exchange == 'bybit':
+        remaining = _header_float(headers, 'X-Bapi-Limit-Status')
+        reset_ts_ms = _header_float(headers, 'X-Bapi-Limit-Reset-Timestamp')
+        if remaining is not None and remaining <= 0 and reset_ts_ms:
+            pause_seconds = max(0.0, reset_ts_ms / 1000 - time.time())
+    elif exchange == 'kucoin':
+        remaining = _header_float(headers, 'gw-ratelimit-remaining')
+        reset_ms = _header_float(headers, 'gw-ratelimit-reset')
+        if remaining is not None and remaining <= 0 and reset_ms:
+            pause_seconds = reset_ms / 1000
+
+    if pause_seconds is None and status_code == 429:
+        pause_seconds = 1.0
+
+    if pause_seconds:
+        bucket.pause(pause_seconds)
+    return pause_seconds
@@ -7,7 +7,6 @@ from decimal import Decimal, InvalidOperation
 
 import apimoex
 import pandas as pd
-import requests
 from flask import (Blueprint, flash, redirect, render_template, request,
                    url_for, current_app)
 from sqlalchemy import asc, desc
@@ -15,8 +14,10 @@ from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 
 # Импортируем модели и db из новых централизованных файлов
-from models import InvestmentPlatform, InvestmentAsset, Transaction, MoexHistoricalPrice, HistoricalPriceCache
+from models import InvestmentPlatform, InvestmentAsset, Transaction, MoexHistoricalPrice, HistoricalPriceCache, MoexSecurityMetadata
 from extensions import db
+from db_utils import bulk_insert_ignore, bulk_upsert
+from http_transport import shared_http_session
 from news_logic import get_securities_news
 # ИМПОРТ ДЛЯ НОВОЙ ФУНКЦИИ ЗАГРУЗКИ PDF
 from pdf_parsers import parse_bcs_report_pdf
@@ -27,18 +28,69 @@ securities_bp = Blueprint('securities', __name__, url_prefix='/securities', temp
 
 # --- Функции для работы с MOEX API ---
 
+# Метаданные бумаг почти не меняются, поэтому кэшируются надолго; промахи (бумага не найдена)
+# перепроверяются чаще, т.к. бумага могла только что появиться на бирже.
+MOEX_METADATA_TTL = timedelta(days=30)
+MOEX_METADATA_MISS_TTL = timedelta(days=1)
+
 def fetch_moex_securities_metadata(tickers: list[str]) -> dict[str, dict]:
     """
     Получает метаданные (SECID, ISIN, NAME, TYPE) для списка тикеров с MOEX.
     Принимает на вход как SECID, так и ISIN.
     Возвращает словарь, где ключ - исходный тикер из запроса.
+    Сначала ищет в кэше MoexSecurityMetadata одним запросом; в ISS уходят только
+    неизвестные или устаревшие тикеры, результат (включая промахи) сохраняется в кэш.
     """
     if not tickers:
         return {}
 
+    keys_by_query = {ticker_query: ticker_query.upper().strip() for ticker_query in tickers}
+    now = datetime.now(timezone.utc)
+    cached_rows = {
+        row.lookup_key: row for row in
+        MoexSecurityMetadata.query.filter(MoexSecurityMetadata.lookup_key.in_(set(keys_by_query.values()))).all()
+    }
+
+    metadata, queries_to_fetch = {}, []
+    for ticker_query, lookup_key in keys_by_query.items():
+        row = cached_rows.get(lookup_key)
+        updated_at = row.updated_at if row else None
+        if updated_at and updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        ttl = MOEX_METADATA_TTL if row and row.secid else MOEX_METADATA_MISS_TTL
+        if not updated_at or now - updated_at > ttl:
+            queries_to_fetch.append(ticker_query)
+        elif row.secid:
+            metadata[ticker_query] = {
+                'ticker': row.secid, 'isin': row.isin, 'name': row.name,
+                'asset_type': row.asset_type, 'board': row.board, 'group': row.sec_group
+            }
+
+    if queries_to_fetch:
+        fetched = _fetch_moex_securities_metadata_from_iss(queries_to_fetch)
+        metadata.update(fetched)
+        rows = []
+        for ticker_query in queries_to_fetch:
+            meta = fetched.get(ticker_query, {})
+            rows.append({
+                'lookup_key': keys_by_query[ticker_query], 'secid': meta.get('ticker'), 'isin': meta.get('isin'),
+                'name': meta.get('name'), 'asset_type': meta.get('asset_type'), 'board': meta.get('board'),
+                'sec_group': meta.get('group'), 'updated_at': now
+            })
+        try:
+            bulk_upsert(MoexSecurityMetadata, rows, ['lookup_key'], ['secid', 'isin', 'name', 'asset_type', 'board', 'sec_group', 'updated_at'])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"--- [MOEX Meta Fetch] Не удалось сохранить метаданные в кэш: {e}")
+    return metadata
+
+def _fetch_moex_securities_metadata_from_iss(tickers: list[str]) -> dict[str, dict]:
+    """Запрашивает метаданные бумаг напрямую в ISS (по одному запросу на тикер)."""
+
     # Используем один запрос для всех тикеров для эффективности
     metadata = {}
-    with requests.Session() as session:
+    with shared_http_session() as session:
         # apimoex.find_securities может принимать список, но для надежности лучше по одному
         for ticker_query in tickers:
             try:
@@ -70,13 +122,14 @@ def fetch_moex_securities_metadata(tickers: list[str]) -> dict[str, dict]:
                 print(f"INFO: Не удалось найти метаданные для '{ticker_query}' на MOEX: {e}")
     return metadata
 
-def fetch_moex_historical_price_range(secids: list[str], start_date: date, end_date: date) -> dict[str, dict[date, Decimal]]:
+def fetch_moex_historical_price_range(secids: list[str], start_date: date, end_date: date, raise_errors: bool = False) -> dict[str, dict[date, Decimal]]:
     """
     Получает диапазон исторических цен закрытия для списка SECID с MOEX.
     Возвращает словарь {secid: {дата: цена}}.
+    При raise_errors=True ошибка по любому SECID пробрасывается вызывающему коду.
     """
     all_prices = defaultdict(dict)
-    with requests.Session() as session:
+    with shared_http_session() as session:
         for secid in secids:
             try:
                 print(f"--- [MOEX History Range] Запрос истории для {secid} с {start_date} по {end_date}...")
@@ -94,13 +147,43 @@ def fetch_moex_historical_price_range(secids: list[str], start_date: date, end_d
                         all_prices[secid][trade_date] = Decimal(str(record['CLOSE']))
             except Exception as e:
                 print(f"--- [MOEX History Range] Ошибка при получении истории для {secid}: {e}")
+                if raise_errors:
+                    raise
             time.sleep(0.2) # Пауза между запросами по тикерам
     return all_prices
 
+def _moex_engine_market(group: str) -> tuple[str, str]:
+    """Разбирает группу бумаги ISS (например, 'stock_bonds') на движок и рынок."""
+    group_parts = (group or '').split('_')
+    engine, market = 'stock', 'shares' # Значения по умолчанию
+    if len(group_parts) == 2:
+        engine, market = group_parts
+    # Особый случай для фондов, где рынок называется 'stock'
+    if market in ['etf', 'ppif']:
+        market = 'stock'
+    return engine, market
+
+def fetch_moex_board_history(session, engine: str, market: str, board: str, trade_date: date) -> dict[str, Decimal]:
+    """
+    Загружает итоги торгов всей доски за одну дату одним постраничным запросом
+    к /iss/history/engines/{engine}/markets/{market}/boards/{board}/securities.
+    Возвращает словарь {secid: цена закрытия}; для неторгового дня словарь пуст.
+    """
+    url = f"https://iss.moex.com/iss/history/engines/{engine}/markets/{market}/boards/{board}/securities.json"
+    query = {'date': trade_date.isoformat(), 'history.columns': 'SECID,TRADEDATE,CLOSE'}
+    history = apimoex.ISSClient(session, url, query).get_all().get('history', [])
+    return {
+        record['SECID']: Decimal(str(record['CLOSE']))
+        for record in history
+        if record.get('CLOSE') is not None and record.get('TRADEDATE') == trade_date.isoformat()
+    }
+
 def fetch_moex_historical_prices(isins: list[str], target_date: date) -> dict[str, Decimal]:
     """
-    Получает исторические цены закрытия для списка ISIN на конкретную дату.
-    Использует кэш в таблице MoexHistoricalPrice.
+    Получает исторические цены закрытия для списка ISIN на конкретную дату
+    (последняя торговая сессия не позже target_date, но не глубже 7 дней).
+    Использует кэш в таблице MoexHistoricalPrice. Недостающие цены загружаются
+    итогами торгов целых досок за дату, т.е. одним запросом на доску, а не на бумагу.
     """
     prices = {}
     if not isins:
@@ -117,34 +200,44 @@ def fetch_moex_historical_prices(isins: list[str], target_date: date) -> dict[st
     # 2. Определяем, что нужно запросить у API
     cached_isins = set(prices.keys())
     isins_to_fetch = [isin for isin in isins if isin not in cached_isins]
+    if not isins_to_fetch:
+        return prices
 
-    # 3. Запрашиваем недостающие данные
-    if isins_to_fetch:
-        print(f"--- [MOEX History] Запрос исторических цен на {target_date} для {len(isins_to_fetch)} ISIN...")
-        with requests.Session() as session:
-            for isin in isins_to_fetch:
+    # 3. Группируем недостающие бумаги по доскам
+    securities_meta = fetch_moex_securities_metadata(isins_to_fetch)
+    isins_by_board = defaultdict(dict)
+    for isin in isins_to_fetch:
+        meta = securities_meta.get(isin, {})
+        if meta.get('ticker') and meta.get('board'):
+            engine, market = _moex_engine_market(meta.get('group'))
+            isins_by_board[(engine, market, meta['board'])][meta['ticker'].upper()] = isin
+
+    # 4. Для каждой доски идем назад от target_date, пока не найдем цены всех бумаг
+    print(f"--- [MOEX History] Запрос исторических цен на {target_date} для {len(isins_to_fetch)} ISIN ({len(isins_by_board)} досок)...")
+    rows = []
+    with shared_http_session() as session:
+        for (engine, market, board), isin_by_secid in isins_by_board.items():
+            pending = dict(isin_by_secid)
+            for days_back in range(8):
+                if not pending:
+                    break
+                trade_date = target_date - timedelta(days=days_back)
                 try:
-                    meta_list = apimoex.find_securities(session, isin, columns=('secid',))
-                    if not meta_list: continue
-                    secid = meta_list[0]['secid']
-                    # Запрашиваем данные за небольшой диапазон до целевой даты, чтобы найти последнюю торговую сессию
-                    start_date_for_request = target_date - timedelta(days=7)
-                    history = apimoex.get_market_history(
-                        session, 
-                        security=secid, 
-                        start=start_date_for_request.isoformat(), 
-                        end=target_date.isoformat(), 
-                        columns=('CLOSE',)
-                    )
-                    if history:
-                        # API возвращает данные в хронологическом порядке, берем последнюю запись
-                        price = Decimal(str(history[-1]['CLOSE']))
-                        prices[isin] = price
-                        db.session.add(MoexHistoricalPrice(isin=isin, date=target_date, price_rub=price))
+                    board_prices = fetch_moex_board_history(session, engine, market, board, trade_date)
                 except Exception as e:
-                    print(f"--- [MOEX History] Ошибка при получении исторической цены для {isin} на {target_date}: {e}")
-                time.sleep(0.1)
-        db.session.commit()
+                    print(f"--- [MOEX History] Ошибка при получении итогов торгов {board} на {trade_date}: {e}")
+                    break
+                for secid in [secid for secid in pending if secid in board_prices]:
+                    isin = pending.pop(secid)
+                    prices[isin] = board_prices[secid]
+                    # Цену на сегодня не кэшируем: итоги текущего дня еще не подведены
+                    if target_date < date.today():
+                        rows.append({'isin': isin, 'date': target_date, 'price_rub': board_prices[secid]})
+                    if trade_date != target_date:
+                        rows.append({'isin': isin, 'date': trade_date, 'price_rub': board_prices[secid]})
+
+    bulk_insert_ignore(MoexHistoricalPrice, rows, ['isin', 'date'])
+    db.session.commit()
     return prices
 
 def fetch_moex_securities_prices(securities_meta: dict) -> dict[str, Decimal]:
@@ -165,17 +258,7 @@ def fetch_moex_securities_prices(securities_meta: dict) -> dict[str, Decimal]:
         if meta.get('board') and meta.get('ticker') and meta.get('group'):
             secid = meta['ticker'].upper()
             board = meta['board']
-            
-            # Разбираем группу на движок и рынок
-            group_parts = meta['group'].split('_')
-            engine, market = 'stock', 'shares' # Значения по умолчанию
-            if len(group_parts) == 2:
-                engine, market = group_parts
-            
-            # Особый случай для фондов, где рынок называется 'stock'
-            if market in ['etf', 'ppif']:
-                market = 'stock'
-
+            engine, market = _moex_engine_market(meta['group'])
             requests_by_key[(board, market, engine)].append(secid)
             secid_to_isin_map[secid] = isin
     
@@ -187,7 +270,7 @@ def fetch_moex_securities_prices(securities_meta: dict) -> dict[str, Decimal]:
     marketdata_columns = ['SECID', 'LAST', 'MARKETPRICE', 'MARKETPRICE2', 'LCLOSE', 'PREVADMITTEDQUOTE', 'PREVPRICE', 'ACCRUEDINT']
     securities_columns = ['SECID', 'FACEVALUE']
 
-    with requests.Session() as session:
+    with shared_http_session() as session:
         for (board, market, engine), secids_on_board in requests_by_key.items():
             print(f"\n--- [MOEX Price Fetch] Запрос для: доска='{board}', рынок='{market}', движок='{engine}'...")
             try:
@@ -248,7 +331,7 @@ def fetch_moex_market_leaders(tickers: list[str]) -> list[dict]:
     indices = [t for t in tickers if t.startswith('IMOEX') or t.startswith('RTSI')]
     stocks = [t for t in tickers if t not in indices]
 
-    with requests.Session() as session:
+    with shared_http_session() as session:
         try:
             # Запрос для акций
             if stocks:
@@ -957,12 +1040,7 @@ def ui_upload_broker_transactions_report(platform_id):
         parsed_txs = _parse_broker_transactions_report(filepath)
         if not parsed_txs:
             raise ValueError("Не удалось извлечь ни одной транзакции из файла.")
-        existing_tx_ids = {tx.exchange_tx_id for tx in platform.transactions}
-        added_count = 0
-        for tx_data in parsed_txs:
-            if tx_data['exchange_tx_id'] not in existing_tx_ids:
-                db.session.add(Transaction(platform_id=platform.id, **tx_data))
-                added_count += 1
+        added_count = bulk_insert_ignore(Transaction, [dict(tx_data, platform_id=platform.id) for tx_data in parsed_txs], ['exchange_tx_id'])
         db.session.commit()
         flash(f'Отчет о транзакциях успешно загружен. Добавлено {added_count} новых сделок.', 'success')
     except Exception as e:
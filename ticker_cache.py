@@ -0,0 +1,60 @@
+import threading
+import time
+
+# --- Общий кэш снимков спотовых тикеров бирж ---
+# Эндпоинты тикеров отдают весь список пар биржи, а вызывающему коду обычно нужны
+# несколько символов. Снимок каждой биржи хранится в памяти процесса короткое время
+# и индексирован по символу. Обновление single-flight: пока один поток загружает
+# снимок, остальные ждут его результата, а не запускают параллельные загрузки.
+
+TICKER_SNAPSHOT_TTL = 20  # секунд
+
+
+class TickerSnapshot:
+    """Снимок тикеров одной биржи {символ: сырые данные тикера} с временем загрузки."""
+
+    def __init__(self):
+        self.tickers = {}
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_fresh(self, ttl: float) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < ttl
+
+    def get(self, loader, ttl: float) -> dict:
+        """
+        Возвращает актуальный снимок; при устаревании загружает его через loader() -> {символ: тикер}.
+        Ошибки загрузки пробрасываются и не кэшируются.
+        """
+        if self.is_fresh(ttl):
+            return self.tickers
+        with self._lock:
+            # Пока ждали блокировку, снимок мог обновить другой поток
+            if self.is_fresh(ttl):
+                return self.tickers
+            tickers = loader()
+            self.tickers = tickers
+            self.loaded_at = time.monotonic()
+            return tickers
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_ticker_snapshot(exchange: str, loader, ttl: float = TICKER_SNAPSHOT_TTL) -> dict:
+    """Возвращает снимок тикеров биржи `exchange`, загружая его через `loader` не чаще раза в `ttl` секунд."""
+    snapshot = _snapshots.get(exchange)
+    if snapshot is None:
+        with _snapshots_lock:
+            snapshot = _snapshots.setdefault(exchange, TickerSnapshot())
+    return snapshot.get(loader, ttl)
+
+
+def invalidate(exchange: str | None = None):
+    """Сбрасывает снимок одной биржи (или всех), чтобы следующий запрос загрузил свежие данные."""
+    with _snapshots_lock:
+        targets = [_snapshots.get(exchange)] if exchange else list(_snapshots.values())
+    for snapshot in targets:
+        if snapshot is not None:
+            snapshot.loaded_at = None